@@ -1,5 +1,5 @@
 from django.contrib import admin
-from ..api.models import Profile, Availability, Game, Game_Role, Session, Session_Profile, Report, Profile_Connected_Game_Account, Feedback, Banned_User
+from ..api.models import Profile, Availability, Game, Game_Role, Session, Session_Profile, Report, Profile_Connected_Game_Account, Feedback, Banned_User, Profile_Affinity, Profile_Preference, Matchmaking_Shard, Session_History
 from django.db.models import Count
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import User
@@ -21,6 +21,10 @@ admin.site.register(Session_Profile)
 admin.site.register(Profile_Connected_Game_Account)
 admin.site.register(Feedback)
 admin.site.register(Banned_User)
+admin.site.register(Profile_Affinity)
+admin.site.register(Profile_Preference)
+admin.site.register(Matchmaking_Shard)
+admin.site.register(Session_History)
 
 
 def ban_users(self, request, queryset):
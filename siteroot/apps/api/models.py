@@ -5,6 +5,7 @@ from django.db.models.signals import post_save
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
 from django.conf import settings
+from django.utils import timezone
 
 # We are building on top of djangos default user model as it provides authentication already, adding our required fields for meshwell.
 class Profile(models.Model):
@@ -79,9 +80,32 @@ class Profile(models.Model):
 	received_ratings = models.IntegerField(null=False, blank=False, default=0,)
 	in_queue = models.BooleanField(null=False, blank=False, default=False,)
 
+	# Every 15 minute slot of the week touched by the user's availabilities (see mysite/weekly_slots.py).
+	availability_mask = models.BinaryField(null=False, blank=True, default=b'', editable=False,)
+
+	# Incremented whenever the user's reports change, so every process stops using its cached blocklist (see mysite/blocklist.py).
+	blocklist_version = models.PositiveIntegerField(default=0, editable=False,)
+
+	# Incremented whenever anything shown on the user's dashboard changes, so every process stops using its cached sections (see mysite/dashboard_cache.py).
+	dashboard_version = models.PositiveIntegerField(default=0, editable=False,)
+
+	# Incremented whenever the user's preference model is retrained, so every process stops using its cached model (see mysite/preferences.py).
+	preference_version = models.PositiveIntegerField(default=0, editable=False,)
+
 	# The users id on discord, which will never change. Current max length is 19, but set to 20 for safe measure (64bit Integer).
 	discord_id = models.CharField(max_length=20, null=True, blank=True,)
 
+	# Fields that are only changed by update queries, which saving a profile loaded before the update mustn't undo.
+	UPDATED_FIELDS = ('availability_mask', 'blocklist_version', 'dashboard_version', 'preference_version')
+
+	def save(self, *args, **kwargs):
+		'''
+		Saves the profile, leaving out the fields in UPDATED_FIELDS unless they are given in update_fields.
+		'''
+		if not self._state.adding and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+			kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields if not field.primary_key and field.name not in self.UPDATED_FIELDS]
+		super().save(*args, **kwargs)
+
 
 @receiver(post_save, sender=User)
 def create_profile(sender, instance=None, created=False, **kwargs):
@@ -297,9 +321,30 @@ class Session(models.Model):
 	# Whether or not this session is competitive.
 	competitive = models.BooleanField(default=False,)
 
+	# Server region this session is played on, or None for sessions created before sessions had a region, which are open to every region.
+	region = models.CharField(
+		max_length=20,
+		choices=Profile.PREF_SERVER_CHOICES,
+		blank=True,
+		null=True,
+	)
+
 	# Whether or not this session has space available.
 	space_available = models.BooleanField(default=True,)
 
+	# Incremented whenever the players of this session, or their commends, change.
+	roster_version = models.PositiveIntegerField(default=0,)
+
+	# Number of players in this session, and how many of them haven't been rated yet.
+	player_count = models.IntegerField(default=0,)
+	unrated_player_count = models.IntegerField(default=0,)
+
+	# Sum of each commend per received rating, over the rated players in this session (see mysite/session_aggregates.py).
+	teamwork_ratio_sum = models.FloatField(default=0.0,)
+	communication_ratio_sum = models.FloatField(default=0.0,)
+	skill_ratio_sum = models.FloatField(default=0.0,)
+	sportsmanship_ratio_sum = models.FloatField(default=0.0,)
+
 
 class Session_Profile(models.Model):
 	'''
@@ -335,6 +380,151 @@ class Session_Profile(models.Model):
 	# Meshwell rating of the profile.
 	rating = models.IntegerField(blank=True, null=True)
 
+	# Datetime that the profile entered the queue, used to widen their search the longer they wait.
+	queued_at = models.DateTimeField(default=timezone.now,)
+
+
+class Profile_Affinity(models.Model):
+	'''
+	Net effect of previous sessions on how a profile feels about playing with another profile.
+	Each session the profile rated above 3 adds one for every other player in it, and each rated below 3 takes one away.
+	'''
+	def __str__(self):
+		return str.join(', ', (str(self.profile), str(self.other_profile), str(self.net_score)))
+
+	class Meta:
+		unique_together = ('profile', 'other_profile')
+
+	# Profile that rated the sessions.
+	profile = models.ForeignKey(
+		'Profile',
+		on_delete=models.CASCADE,
+		blank=False,
+		null=False,
+		related_name='affinities',
+	)
+
+	# Profile that was played with.
+	other_profile = models.ForeignKey(
+		'Profile',
+		on_delete=models.CASCADE,
+		blank=False,
+		null=False,
+		related_name='+',
+	)
+
+	# Sum of the effect of each rated session the two profiles played together.
+	net_score = models.IntegerField(default=0,)
+
+
+class Profile_Preference(models.Model):
+	'''
+	Model of how a profile rates sessions, trained offline from past ratings (see mysite/preferences.py).
+	The predicted rating of a session, centred on a neutral rating of 3 and scaled to between -1 and 1, is the bias
+	plus the weights multiplied by the average commend ratios of the other players in it.
+	'''
+	def __str__(self):
+		return str.join(', ', (str(self.profile), str(self.samples), str(self.trained_at)))
+
+	# Profile whose ratings were modelled.
+	profile = models.OneToOneField(
+		'Profile',
+		on_delete=models.CASCADE,
+		related_name='preference',
+	)
+
+	# Weight of each of the other players' average commend ratios, and the constant term.
+	teamwork_weight = models.FloatField(default=0.0,)
+	communication_weight = models.FloatField(default=0.0,)
+	skill_weight = models.FloatField(default=0.0,)
+	sportsmanship_weight = models.FloatField(default=0.0,)
+	bias = models.FloatField(default=0.0,)
+
+	# Number of rated sessions the model was trained on, and when.
+	samples = models.PositiveIntegerField(default=0,)
+	trained_at = models.DateTimeField(default=timezone.now,)
+
+
+class Matchmaking_Shard(models.Model):
+	'''
+	Running totals of the matchmaking worker for one (game, region, competitive) shard of the queue (see mysite/matchmaking.py).
+	'''
+	def __str__(self):
+		return str.join(', ', (str(self.game.name), str(self.region), str(self.competitive)))
+
+	class Meta:
+		unique_together = ('game', 'region', 'competitive')
+
+	# Game, region and playlist type of the shard.
+	game = models.ForeignKey(
+		'Game',
+		on_delete=models.CASCADE,
+		blank=False,
+		null=False,
+	)
+	region = models.CharField(
+		max_length=20,
+		choices=Profile.PREF_SERVER_CHOICES,
+	)
+	competitive = models.BooleanField(default=False,)
+
+	# Ticks run, queue entries attempted and queue entries matched, in total.
+	ticks = models.PositiveIntegerField(default=0,)
+	attempted = models.PositiveIntegerField(default=0,)
+	matched = models.PositiveIntegerField(default=0,)
+
+	# Results of the most recent tick.
+	last_attempted = models.PositiveIntegerField(default=0,)
+	last_matched = models.PositiveIntegerField(default=0,)
+	last_elapsed = models.FloatField(default=0.0,)
+	last_tick = models.DateTimeField(blank=True, null=True,)
+
+
+class Session_Change(models.Model):
+	'''
+	An entry in the feed of sessions that may have made space for queued players, read by the matchmaking worker (see mysite/session_changes.py).
+	'''
+	def __str__(self):
+		return str.join(', ', (str(self.session_id), str(self.datetime_created)))
+
+	# Session that was created, or that a player left.
+	session = models.ForeignKey(
+		'Session',
+		on_delete=models.CASCADE,
+		blank=False,
+		null=False,
+	)
+
+	# Datetime that the change was recorded.
+	datetime_created = models.DateTimeField(auto_now_add=True,)
+
+
+class Session_History(models.Model):
+	'''
+	Snapshot of a finished session for one of its players, taken when the session ends (see mysite/session_history.py),
+	so their history shows the session as it was rather than as its players' commends are now.
+	History is paged through the player's session profiles (see get_session_history in mysite/views.py), which also
+	covers sessions that haven't been finalised yet, so only what the snapshot freezes is stored here.
+	'''
+	def __str__(self):
+		return str.join(', ', (str(self.session_profile.profile), str(self.session_profile.session_id)))
+
+	# Player's entry in the session, which still holds their rating of it.
+	session_profile = models.OneToOneField(
+		'Session_Profile',
+		on_delete=models.CASCADE,
+		related_name='history',
+	)
+
+	# Viability of the session for the player when it ended.
+	viability = models.FloatField()
+
+	# JSON list of the players shown in the session, each [player tag, teamwork, sportsmanship, skill, communication commends].
+	roster = models.TextField()
+
+	# Datetime that the snapshot was taken.
+	finalised_at = models.DateTimeField()
+
 
 class Report(models.Model):
 	'''
@@ -1,4 +1,963 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import User
+from rest_framework.authtoken.models import Token
+from django.core.cache import cache
+from django.utils import timezone
+from apps.api.models import Profile, Profile_Affinity, Profile_Connected_Game_Account, Availability, Session, Session_Profile, Game, Game_Role, Report, Session_History, Matchmaking_Shard
+from mysite import views, session_aggregates, dashboard_cache, simulator, team_formation, weekly_slots
+from mysite.forms import UserAvailabilityForm
+from mysite.affinity import record_session_rating, rebuild_affinities
+from mysite.matchmaking import Shard, match_queue_entry, ShardReport, IncrementalMatcher, record_shard_metrics, get_queue_buckets, form_bucket_sessions, run_matchmaking_tick, run_shard_ticks, run_batch_matchmaking_tick, get_shard_metrics
+from mysite.session_index import session_index
+from mysite.game_registry import game_registry
+from mysite.sweeper import sweep
+from mysite.preferences import get_preference, train_preferences
+from mysite.session_history import finalise_sessions
+from mysite.teammate_search import CommendTree
+import datetime, json, math, random, re
+from unittest import mock
+import numpy as np
 
-# Tests have not been created.
-# That's university projects for you...
+
+class MatchmakingTestCase(TestCase):
+	'''
+	Sets up a game and a queueing player with an availability two days from now.
+	'''
+	def setUp(self):
+		session_index.clear()
+		game_registry.clear()
+		cache.clear()
+		self.game = Game.objects.create(name='Rainbow Six Siege', max_players=5)
+		self.start = (timezone.now() + datetime.timedelta(days=2)).replace(hour=10, minute=0, second=0, microsecond=0)
+		self.profile = self.create_profile('queueing_player')
+		Availability.objects.create(
+			profile=self.profile,
+			start_time=datetime.time(9, 0),
+			end_time=datetime.time(14, 0),
+			pref_day=self.start.strftime('%A'),
+		)
+		# Pick up the availability mask compiled from it.
+		self.profile.refresh_from_db()
+
+	def create_profile(self, username, rank=1000):
+		'''
+		Creates a user with a connected account for the test game.
+		'''
+		user = User.objects.create_user(username, password='password')
+		Profile_Connected_Game_Account.objects.create(
+			profile=user.profile,
+			game=self.game,
+			game_player_tag=username,
+			cas_rank=rank,
+			comp_rank=rank,
+		)
+		return user.profile
+
+	def create_session(self, players):
+		'''
+		Creates an upcoming session inside the queueing player's availability, containing the given profiles.
+		'''
+		session = Session(game=self.game, start=self.start, end_time=datetime.time(13, 0))
+		for player in players:
+			session_aggregates.add_player(session, player)
+		session.save()
+		for player in players:
+			Session_Profile.objects.create(session=session, profile=player)
+		return session
+
+
+class GetSuitableSessionsQueryTests(MatchmakingTestCase):
+	'''
+	The matchmaking candidate filter must use a fixed number of queries, however many sessions there are.
+	'''
+	# Availabilities, accounts, reports, sessions, rosters, roster accounts, viability, preference, affinities.
+	query_budget = 9
+
+	def setUp(self):
+		super().setUp()
+
+		# Give the queueing player some history, so recommendations are looked up too.
+		past = Session.objects.create(game=self.game, start=timezone.now() - datetime.timedelta(days=7), end_time=datetime.time(13, 0))
+		self.teammate = self.create_profile('teammate')
+		Session_Profile.objects.create(session=past, profile=self.profile, rating=5)
+		Session_Profile.objects.create(session=past, profile=self.teammate)
+		record_session_rating(self.profile, past, 5)
+
+		# A player that has been reported, who should never be matched with.
+		self.reported = self.create_profile('reported')
+		Report.objects.create(session=past, user_reported=self.reported, sent_by=self.profile)
+
+	def add_sessions(self, count):
+		for i in range(count):
+			players = [self.create_profile('player_%s_%s' % (i, j)) for j in range(3)]
+			self.create_session(players + [self.teammate])
+		self.create_session([self.reported])
+		session_index.rebuild()
+
+	def test_single_session(self):
+		self.add_sessions(1)
+		with self.assertNumQueries(self.query_budget):
+			sessions = views.get_suitable_sessions(self.profile)
+		self.assertEqual(len(sessions), 1)
+		self.assertEqual(sessions[0][2], 1)
+
+	def test_many_sessions(self):
+		self.add_sessions(10)
+		with self.assertNumQueries(self.query_budget):
+			sessions = views.get_suitable_sessions(self.profile)
+		self.assertEqual(len(sessions), 10)
+
+	def test_blocklist_cached(self):
+		self.add_sessions(1)
+		views.get_suitable_sessions(self.profile)
+		# The blocklist, viability and preference are cached.
+		with self.assertNumQueries(self.query_budget - 3):
+			views.get_suitable_sessions(self.profile)
+
+		# Reporting someone drops the cached blocklist of every process, once they load the profile again.
+		Report.objects.create(session=Session.objects.first(), user_reported=self.teammate, sent_by=self.profile)
+		self.profile.refresh_from_db()
+		self.assertEqual(self.profile.blocklist_version, 2)
+		self.assertIsNone(views.get_suitable_sessions(self.profile))
+
+		# Saving a profile loaded before the report doesn't undo the new version.
+		stale = Profile.objects.get(pk=self.profile.pk)
+		Report.objects.create(session=Session.objects.first(), user_reported=self.reported, sent_by=self.profile)
+		stale.save()
+		self.profile.refresh_from_db()
+		self.assertEqual(self.profile.blocklist_version, 3)
+
+
+class ViabilityParityTests(MatchmakingTestCase):
+	'''
+	Viabilities from the session aggregates must match the original per-player formula.
+	The aggregates sum each player's ratios as they join, in a different order to the formula, so the two
+	only agree to within floating point rounding, which is well inside VIABILITY_PLACES decimal places.
+	'''
+	VIABILITY_PLACES = 9
+
+	def calc_per_player_viability(self, user_profile, session):
+		'''
+		The original calc_match_viablity, scoring each player in the session other than the user in turn.
+		'''
+		modifiers = dict(zip(('Teamwork', 'Communication', 'Skill', 'Sportsmanship'), views.get_commend_weights(user_profile)))
+		players = [ses_p.profile for ses_p in Session_Profile.objects.filter(session=session).exclude(profile=user_profile).select_related('profile')]
+		total_viability = 0.0
+		for player in players:
+			num_sess = player.received_ratings
+			if num_sess > 0:
+				total_viability += (player.teamwork_commends / num_sess) * modifiers['Teamwork']
+				total_viability += (player.communication_commends / num_sess) * modifiers['Communication']
+				total_viability += (player.skill_commends / num_sess) * modifiers['Skill']
+				total_viability += (player.sportsmanship_commends / num_sess) * modifiers['Sportsmanship']
+			else:
+				total_viability += 0.5
+		return total_viability / len(players) if players else 0.5
+
+	def create_rated_profile(self, username, received_ratings, commends):
+		profile = self.create_profile(username)
+		profile.received_ratings = received_ratings
+		profile.teamwork_commends, profile.communication_commends, profile.skill_commends, profile.sportsmanship_commends = commends
+		profile.save()
+		return profile
+
+	def test_mixed_roster(self):
+		rng = random.Random(7)
+		self.profile.commend_priority_1, self.profile.commend_priority_2 = 'Skill', 'Teamwork'
+		self.profile.commend_priority_3, self.profile.commend_priority_4 = 'Sportsmanship', 'Communication'
+		self.profile.save()
+
+		sessions = []
+		for i in range(6):
+			players = []
+			for j in range(i % 4 + 1):
+				# Every other player hasn't been rated yet.
+				received_ratings = rng.randint(1, 20) if j % 2 == 0 else 0
+				players.append(self.create_rated_profile('player_%s_%s' % (i, j), received_ratings, [rng.randint(0, received_ratings) for k in range(4)]))
+			# The user is left out of sessions they are in.
+			if i % 3 == 0:
+				players.append(self.profile)
+			sessions.append(self.create_session(players))
+		sessions.append(self.create_session([]))
+
+		viabilities = views.calc_sessions_viability(self.profile, sessions)
+		for session, viability in zip(sessions, viabilities):
+			self.assertAlmostEqual(viability, self.calc_per_player_viability(self.profile, session), places=self.VIABILITY_PLACES)
+			self.assertEqual(views.calc_match_viablity(self.profile, session), viability)
+
+
+class DashboardQueryTests(MatchmakingTestCase):
+	'''
+	The dashboard must use a fixed number of queries, however many past sessions the user has.
+	'''
+	# Session, user, profile, accounts, availabilities, history page, viability, rosters, roster accounts,
+	# next session, queue entry, queue viability.
+	query_budget = 12
+
+	def add_past_sessions(self, count):
+		for i in range(count):
+			past = Session.objects.create(game=self.game, start=timezone.now() - datetime.timedelta(days=i + 1), end_time=datetime.time(13, 0))
+			Session_Profile.objects.create(session=past, profile=self.profile, rating=4)
+			for j in range(3):
+				Session_Profile.objects.create(session=past, profile=self.create_profile('player_%s_%s' % (i, j)))
+
+	def get_dashboard(self):
+		self.client.force_login(self.profile.user)
+		self.profile.in_queue = True
+		self.profile.save()
+		self.create_session([self.profile])
+		cache.clear()
+		# Games are loaded once per process.
+		game_registry.get_games()
+		with self.assertNumQueries(self.query_budget):
+			response = self.client.get('/dashboard/')
+		self.assertEqual(response.status_code, 200)
+		return response.context
+
+	def test_single_session(self):
+		self.add_past_sessions(1)
+		context = self.get_dashboard()
+		self.assertEqual(len(context['prev_sessions']), 1)
+		self.assertEqual(len(context['prev_sessions']['0']['players']), 4)
+		self.assertEqual(context['prev_sessions']['0']['session']['rating'], 4)
+		self.assertEqual(context['queue']['session']['game_name'], self.game.name)
+
+	def test_many_sessions(self):
+		self.add_past_sessions(5)
+		context = self.get_dashboard()
+		self.assertEqual(len(context['prev_sessions']), 5)
+		# Most recent first.
+		starts = [context['prev_sessions'][str(i)]['session']['start'] for i in range(5)]
+		self.assertEqual(starts, sorted(starts, reverse=True))
+
+	def test_sections_cached(self):
+		self.add_past_sessions(1)
+		self.get_dashboard()
+		# Only the session, user, profile and queue entry are loaded once the sections are cached.
+		with self.assertNumQueries(4):
+			self.client.get('/dashboard/')
+
+		# Changing a teammate's commends drops the cached sections.
+		teammate = Profile.objects.get(user__username='player_0_0')
+		teammate.teamwork_commends = 3
+		teammate.save()
+		context = self.client.get('/dashboard/').context
+		self.assertEqual(context['prev_sessions']['0']['players']['1']['teamwork_commends'], 3)
+
+		# As does a new availability.
+		Availability.objects.create(profile=self.profile, start_time=datetime.time(18, 0), end_time=datetime.time(20, 0), pref_day='Monday')
+		self.assertEqual(len(self.client.get('/dashboard/').context['availabilities']), 2)
+
+		# Changes made by another process are seen through the version in the database, without any signal in this one.
+		Availability.objects.filter(profile=self.profile, pref_day='Monday').update(pref_day='Friday')
+		self.assertIn('Monday', [a.pref_day for a in self.client.get('/dashboard/').context['availabilities']])
+		dashboard_cache.invalidate_dashboards([self.profile.id])
+		self.assertIn('Friday', [a.pref_day for a in self.client.get('/dashboard/').context['availabilities']])
+
+
+class DashboardInvalidationTests(MatchmakingTestCase):
+	'''
+	Dashboards are only dropped by profile saves that change what they show.
+	'''
+	def get_versions(self, profiles):
+		return [Profile.objects.get(pk=profile.pk).dashboard_version for profile in profiles]
+
+	def test_queue_saves_skipped(self):
+		teammate = self.create_profile('teammate')
+		past = Session.objects.create(game=self.game, start=timezone.now() - datetime.timedelta(days=1), end_time=datetime.time(13, 0))
+		for player in (self.profile, teammate):
+			Session_Profile.objects.create(session=past, profile=player)
+		# Someone the teammate played with in another session, whose history shows the teammate's commends.
+		old_teammate = self.create_profile('old_teammate')
+		older = Session.objects.create(game=self.game, start=timezone.now() - datetime.timedelta(days=3), end_time=datetime.time(13, 0))
+		for player in (teammate, old_teammate):
+			Session_Profile.objects.create(session=older, profile=player)
+		versions = self.get_versions([self.profile, teammate, old_teammate])
+
+		# Entering the queue only saves in_queue.
+		self.client.force_login(self.profile.user)
+		self.client.get('/dashboard/enter_queue/')
+		self.assertEqual(self.get_versions([teammate, old_teammate]), versions[1:])
+
+		# Rating commends the teammate, dropping the dashboards of everyone who has played with them.
+		response = self.client.post('/dashboard/session/%s/rate/' % past.id, {'rating': 4, 'player_0_id': teammate.id, 'player_0_name': 'teammate', 'player_0_commends': ['Skill']})
+		self.assertTrue(response.json()['form_is_valid'])
+		teammate.refresh_from_db()
+		self.assertEqual((teammate.skill_commends, teammate.received_ratings), (1, 1))
+		for version, old in zip(self.get_versions([self.profile, teammate, old_teammate]), versions):
+			self.assertGreater(version, old)
+
+
+class MatchmakingWorkerTests(MatchmakingTestCase):
+	'''
+	Queued players are matched by the worker, not by the queue request.
+	'''
+	def test_queued_player_is_matched(self):
+		session = self.create_session([self.create_profile('host')])
+		self.client.force_login(self.profile.user)
+		self.client.get('/dashboard/enter_queue/')
+
+		queue_entry = Session_Profile.objects.get(profile=self.profile)
+		self.assertIsNone(queue_entry.session)
+
+		self.assertEqual(run_matchmaking_tick(batch_size=10), (1, 1))
+		queue_entry.refresh_from_db()
+		self.assertEqual(queue_entry.session, session)
+
+
+class BatchMatchmakingTests(MatchmakingTestCase):
+	'''
+	Batch mode groups queued players into new sessions when there are none to join.
+	'''
+	def test_queued_players_form_session(self):
+		friend = self.create_profile('friend')
+		Availability.objects.create(
+			profile=friend,
+			start_time=datetime.time(11, 0),
+			end_time=datetime.time(16, 0),
+			pref_day=self.start.strftime('%A'),
+		)
+		for profile in (self.profile, friend):
+			self.client.force_login(profile.user)
+			self.client.get('/dashboard/enter_queue/')
+
+		reports, attempted, matched = run_batch_matchmaking_tick(batch_size=10, time_budget=0.1)
+		self.assertEqual(len(reports), 1)
+		self.assertEqual(reports[0].placed, 2)
+		self.assertEqual((attempted, matched), (0, 0))
+
+		session = Session_Profile.objects.get(profile=self.profile).session
+		self.assertEqual(Session_Profile.objects.get(profile=friend).session, session)
+		self.assertEqual(session.start.time(), datetime.time(11, 0))
+		self.assertEqual(session.end_time, datetime.time(14, 0))
+
+	def test_no_empty_sessions(self):
+		friend = self.create_profile('friend')
+		Availability.objects.create(profile=friend, start_time=datetime.time(11, 0), end_time=datetime.time(16, 0), pref_day=self.start.strftime('%A'))
+		for profile in (self.profile, friend):
+			self.client.force_login(profile.user)
+			self.client.get('/dashboard/enter_queue/')
+		bucket, entries = list(get_queue_buckets().items())[0]
+
+		# Another worker placed both players after the bucket was loaded, so nobody joins the session formed for them.
+		elsewhere = self.create_session([])
+		Session_Profile.objects.filter(pk__in=[entry.pk for entry in entries]).update(session=elsewhere)
+		sessions = Session.objects.count()
+		report = form_bucket_sessions(bucket, entries, time_budget=0.1)
+		self.assertEqual((report.teams, report.placed), (1, 0))
+		self.assertEqual(Session.objects.count(), sessions)
+
+
+class TeamFormationTests(TestCase):
+	'''
+	Team formation stays within its time budget, including while forming teams greedily.
+	'''
+	def form_teams(self, time_budget):
+		player_count = 40
+		scores = np.random.RandomState(0).rand(player_count, player_count)
+		compatible = np.ones((player_count, player_count), dtype=bool)
+		masks = [(1 << weekly_slots.SLOTS_PER_WEEK) - 1] * player_count
+		return team_formation.form_teams(scores, compatible, masks, 5, time_budget)
+
+	def test_greedy_teams(self):
+		formation = self.form_teams(1.0)
+		self.assertEqual(sorted(player for team in formation.teams for player in team), list(range(40)))
+		self.assertGreaterEqual(formation.score, formation.greedy_score)
+
+	def test_budget_spent(self):
+		# Only the longest waiting player's team is formed once the budget has run out.
+		formation = self.form_teams(0)
+		self.assertEqual(len(formation.teams), 1)
+		self.assertIn(0, formation.teams[0])
+		self.assertEqual(formation.moves, 0)
+
+
+class ShardedMatchmakingTests(MatchmakingTestCase):
+	'''
+	Players are only matched into sessions of their own region, and each shard reports its own metrics.
+	'''
+	def test_region_shards(self):
+		shard = Shard(self.game.id, Profile.USWEST, False)
+		europe = self.create_session([self.create_profile('europe_host')])
+		europe.region = Profile.EUROPE
+		europe.save()
+		self.client.force_login(self.profile.user)
+		self.client.get('/dashboard/enter_queue/')
+
+		self.assertEqual(run_matchmaking_tick(batch_size=10), (1, 0))
+		metrics = get_shard_metrics()[shard]
+		self.assertEqual((metrics.queue_depth, metrics.match_rate), (1, 0.0))
+
+		local = self.create_session([self.create_profile('local_host')])
+		local.region = Profile.USWEST
+		local.save()
+		self.assertEqual(run_matchmaking_tick(batch_size=10, shards=[shard]), (1, 1))
+		self.assertEqual(Session_Profile.objects.get(profile=self.profile).session, local)
+		metrics = get_shard_metrics()[shard]
+		self.assertEqual((metrics.queue_depth, metrics.attempted, metrics.match_rate), (0, 2, 0.5))
+
+	def test_index_kept_between_ticks(self):
+		self.client.force_login(self.profile.user)
+		self.client.get('/dashboard/enter_queue/')
+		run_matchmaking_tick(batch_size=10)
+		built_at = session_index.built_at
+
+		# Sessions created in this process reach the index through its signals, without a rebuild.
+		session = self.create_session([self.create_profile('host')])
+		self.assertEqual(run_matchmaking_tick(batch_size=10), (1, 1))
+		self.assertEqual(Session_Profile.objects.get(profile=self.profile).session, session)
+		self.assertEqual(session_index.built_at, built_at)
+
+	def test_metrics_created_once(self):
+		shard = Shard(self.game.id, Profile.USWEST, False)
+		for attempted in (3, 4):
+			record_shard_metrics(ShardReport(shard, attempted, 1, 0, 0.5))
+		metrics = Matchmaking_Shard.objects.get(game=self.game, region=Profile.USWEST, competitive=False)
+		self.assertEqual((metrics.ticks, metrics.attempted, metrics.matched, metrics.last_attempted), (2, 7, 2, 4))
+
+
+@override_settings(MATCHMAKING_SEARCH_SCHEDULE=((0, 100, 0), (60, 300, 0), (120, 300, 1)))
+class SearchWindowTests(MatchmakingTestCase):
+	'''
+	The ranks and regions searched for a queued player widen the longer they wait.
+	'''
+	def test_window_widens(self):
+		session = self.create_session([self.create_profile('distant_host', rank=1250)])
+		session.region = Profile.USEAST
+		session.save()
+		self.client.force_login(self.profile.user)
+		self.client.get('/dashboard/enter_queue/')
+		queue_entry = Session_Profile.objects.get(profile=self.profile)
+
+		# Too far away in rank, then in region, until the player has waited long enough for both.
+		for waited, matched in ((0, 0), (90, 0), (150, 1)):
+			Session_Profile.objects.filter(pk=queue_entry.pk).update(queued_at=timezone.now() - datetime.timedelta(seconds=waited))
+			self.assertEqual(run_matchmaking_tick(batch_size=10), (1, matched))
+		queue_entry.refresh_from_db()
+		self.assertEqual(queue_entry.session, session)
+
+
+class IncrementalMatcherTests(MatchmakingTestCase):
+	'''
+	After the first tick, only queued players that could fit a new or changed session are rematched.
+	'''
+	def test_changed_sessions(self):
+		bystander = self.create_profile('bystander')
+		Availability.objects.create(profile=bystander, start_time=datetime.time(18, 0), end_time=datetime.time(22, 0), pref_day=self.start.strftime('%A'))
+		for profile in (self.profile, bystander):
+			self.client.force_login(profile.user)
+			self.client.get('/dashboard/enter_queue/')
+
+		matcher = IncrementalMatcher(batch_size=10)
+		self.assertEqual([(report.attempted, report.matched) for report in matcher.tick()], [(2, 0)])
+		self.assertEqual(matcher.tick(), [])
+
+		# A session outside the bystander's availability, then one in another region, only affect the queueing player.
+		self.create_session([self.create_profile('host')])
+		far = self.create_session([self.create_profile('far_host')])
+		far.region = Profile.ASIA
+		far.save()
+		reports = matcher.tick()
+		self.assertEqual([(report.shard, report.attempted, report.matched) for report in reports], [(Shard(self.game.id, Profile.USWEST, False), 1, 1)])
+		self.assertEqual(matcher.tick(), [])
+
+
+class SweeperTests(MatchmakingTestCase):
+	'''
+	The sweeper reclaims orphaned queue entries and dead sessions, but leaves anything still in use.
+	'''
+	def test_sweep(self):
+		old = timezone.now() - datetime.timedelta(days=2)
+		orphan = Session_Profile.objects.create(profile=self.create_profile('orphan'), queued_at=old)
+		self.client.force_login(self.profile.user)
+		self.client.get('/dashboard/enter_queue/')
+		Session_Profile.objects.filter(profile=self.profile).update(queued_at=old)
+
+		dead = Session.objects.create(game=self.game, start=old, end_time=datetime.time(13, 0))
+		played = Session.objects.create(game=self.game, start=old, end_time=datetime.time(13, 0))
+		Session_Profile.objects.create(session=played, profile=self.create_profile('played'))
+		upcoming = self.create_session([])
+
+		self.assertEqual(tuple(sweep(batch_size=1, queue_entry_age=60, session_age=60)), (1, 1, 1))
+		self.assertFalse(Session_Profile.objects.filter(pk=orphan.pk).exists())
+		self.assertTrue(Session_Profile.objects.filter(profile=self.profile, session__isnull=True).exists())
+		self.assertEqual(set(Session.objects.values_list('id', flat=True)), {played.id, upcoming.id})
+		self.assertFalse(Session.objects.get(pk=played.pk).space_available)
+		self.assertEqual(tuple(sweep(batch_size=1, queue_entry_age=60, session_age=60)), (0, 0, 0))
+
+	def test_enter_queue_without_availability(self):
+		Availability.objects.filter(profile=self.profile).delete()
+		self.client.force_login(self.profile.user)
+		self.client.get('/dashboard/enter_queue/')
+		self.assertFalse(Session_Profile.objects.filter(profile=self.profile).exists())
+
+
+class SessionHistoryTests(MatchmakingTestCase):
+	'''
+	Sessions that have ended are shown on the dashboard as they were when they were finalised.
+	'''
+	def test_finalised_history(self):
+		teammate = self.create_profile('teammate')
+		ended = Session.objects.create(game=self.game, start=timezone.now() - datetime.timedelta(days=2), end_time=datetime.time(23, 59))
+		for player in (self.profile, teammate):
+			session_aggregates.add_player(ended, player)
+			Session_Profile.objects.create(session=ended, profile=player)
+		ended.save()
+		running = Session.objects.create(game=self.game, start=timezone.now() - datetime.timedelta(minutes=1), end_time=(timezone.localtime() + datetime.timedelta(hours=1)).time())
+		Session_Profile.objects.create(session=running, profile=self.profile)
+
+		# Only the session that has ended is finalised, once.
+		self.assertEqual(finalise_sessions(batch_size=1), 2)
+		self.assertEqual(finalise_sessions(batch_size=1), 0)
+		history = Session_History.objects.get(session_profile__profile=self.profile)
+		self.assertEqual(history.session_profile.session, ended)
+		self.assertEqual(json.loads(history.roster), [['queueing_player', 0, 0, 0, 0], ['teammate', 0, 0, 0, 0]])
+
+		# Later commends don't change the history.
+		teammate.teamwork_commends = 3
+		teammate.save()
+		self.client.force_login(self.profile.user)
+		prev_sessions = self.client.get('/dashboard/').context['prev_sessions']
+		ended_entry = [entry for entry in prev_sessions.values() if entry['session']['id'] == ended.id][0]
+		self.assertEqual(ended_entry['players']['1']['teamwork_commends'], 0)
+		self.assertEqual(ended_entry['session']['viability'], math.floor(history.viability * 100))
+
+
+@override_settings(SESSION_HISTORY_PAGE_SIZE=2)
+class SessionHistoryPageTests(MatchmakingTestCase):
+	'''
+	Session history is paged by session start, most recent first.
+	'''
+	def test_pages(self):
+		sessions = []
+		for days in (1, 2, 2, 3, 4):
+			session = Session.objects.create(game=self.game, start=(timezone.now() - datetime.timedelta(days=days)).replace(microsecond=0), end_time=datetime.time(13, 0))
+			Session_Profile.objects.create(session=session, profile=self.profile)
+			sessions.append(session)
+
+		# The dashboard only shows the first page, and every page after it is reached from the last.
+		self.client.force_login(self.profile.user)
+		context = self.client.get('/dashboard/').context
+		seen = [value['session']['id'] for value in context['prev_sessions'].values()]
+		before = context['prev_sessions_next']
+		while before:
+			response = self.client.get('/dashboard/session/history/', {'before': before})
+			self.assertEqual(response.status_code, 200)
+			before = response.json()['next_page']
+			seen.extend(int(pk) for pk in re.findall(r'/dashboard/session/(\d+)/rate/', response.json()['html_session_rows']))
+		self.assertEqual(seen, [sessions[0].id, sessions[2].id, sessions[1].id, sessions[3].id, sessions[4].id])
+
+		# A cursor that can't be read gives the first page.
+		self.assertIsNone(views.parse_history_cursor('nonsense'))
+		self.assertIn('js-rate-session', self.client.get('/dashboard/session/history/', {'before': 'nonsense'}).json()['html_session_rows'])
+
+
+class TeammateSearchTests(MatchmakingTestCase):
+	'''
+	The commend tree finds the same players as scoring everyone, and seeds sessions for players with none to join.
+	'''
+	def test_matches_brute_force(self):
+		rng = random.Random(0)
+		vectors = [[rng.choice([0.0, 0.5, rng.random()]) for i in range(4)] for j in range(500)]
+		tree = CommendTree(range(len(vectors)), vectors, leaf_size=4)
+		for removed in rng.sample(range(len(vectors)), 50):
+			tree.remove(removed)
+		for i in range(20):
+			weights = [rng.random() for j in range(4)]
+			exclude = set(rng.sample(range(len(vectors)), 50))
+			scores = sorted((-sum(w * v for w, v in zip(weights, vector)), id) for id, vector in enumerate(vectors) if id not in tree.removed and id not in exclude)
+			self.assertEqual([id for score, id in tree.best(weights, 10, exclude)], [id for score, id in scores[:10]])
+
+	def test_seeds_session(self):
+		friend = self.create_profile('friend')
+		Availability.objects.create(profile=friend, start_time=datetime.time(11, 0), end_time=datetime.time(16, 0), pref_day=self.start.strftime('%A'))
+		for profile in (self.profile, friend):
+			self.client.force_login(profile.user)
+			self.client.get('/dashboard/enter_queue/')
+
+		reports = run_shard_ticks(batch_size=10, seed_time_budget=0.1)
+		self.assertEqual([(report.attempted, report.matched, report.seeded) for report in reports], [(2, 2, 2)])
+		self.assertEqual(Session_Profile.objects.get(profile=friend).session, Session_Profile.objects.get(profile=self.profile).session)
+
+
+class SimulatorTests(TestCase):
+	'''
+	The simulator matches its queue with the matchmaking worker's ticks, in each of the worker's modes.
+	'''
+	def setUp(self):
+		session_index.clear()
+		game_registry.clear()
+		cache.clear()
+
+	def test_modes(self):
+		population = simulator.generate_population(60, 6, seed=1)
+		for mode in simulator.MODES:
+			with mock.patch('mysite.matchmaking.match_queue_entry', wraps=match_queue_entry) as matched:
+				stats = simulator.replay_events(population, 20, seed=1, mode=mode, tick_events=5, time_budget=0.01, seed_sessions=True)
+			self.assertEqual(len(stats['tick'].latencies), 4)
+			self.assertTrue(matched.called)
+			self.assertEqual(len(stats['enter'].latencies) + len(stats['exit'].latencies), 20)
+		simulator.remove_population(population)
+		self.assertFalse(Game.objects.filter(name=simulator.SIMULATION_GAME).exists())
+
+
+class PreferenceTests(MatchmakingTestCase):
+	'''
+	Preference models trained from past ratings recommend sessions with players like those the player enjoyed.
+	'''
+	def test_trained_preference_recommends(self):
+		# A well commended teammate, and a stranger with the same commends whose session can only be recommended by the model.
+		teammate = self.create_profile('teammate')
+		stranger = self.create_profile('stranger')
+		Profile.objects.filter(pk__in=[teammate.pk, stranger.pk]).update(received_ratings=1, teamwork_commends=1, communication_commends=1, skill_commends=1, sportsmanship_commends=1)
+		stranger.refresh_from_db()
+
+		for i in range(3):
+			past = Session.objects.create(game=self.game, start=timezone.now() - datetime.timedelta(days=7), end_time=datetime.time(13, 0))
+			Session_Profile.objects.create(session=past, profile=self.profile, rating=5)
+			Session_Profile.objects.create(session=past, profile=teammate)
+		session = self.create_session([stranger])
+
+		# Without a model, the session isn't recommended, and the lack of one is cached.
+		self.assertEqual(views.get_match_recommendation_level(self.profile, session), 0)
+		with self.assertNumQueries(0):
+			self.assertIsNone(get_preference(self.profile))
+
+		# Training moves the profile to a new version, so every process picks the model up once it reloads the profile.
+		self.assertEqual(train_preferences(regularisation=1.0), (1, 3))
+		self.assertIsNone(get_preference(self.profile))
+		self.profile.refresh_from_db()
+		self.assertIsNotNone(get_preference(self.profile))
+		self.assertEqual(views.get_match_recommendation_level(self.profile, session), 1)
+
+
+class GameRegistryTests(MatchmakingTestCase):
+	'''
+	Games and roles are read from the registry without queries, and reloaded as they change.
+	'''
+	def test_reloaded_on_change(self):
+		# Games and roles are loaded together.
+		with self.assertNumQueries(2):
+			self.assertEqual([game.name for game in game_registry.get_games()], ['Rainbow Six Siege'])
+		with self.assertNumQueries(0):
+			self.assertEqual(game_registry.get_game(self.game.id).image_url, self.game.image.url)
+
+		self.game.max_players = 6
+		self.game.save()
+		self.assertEqual(game_registry.get_game(self.game.id).max_players, 6)
+		other = Game.objects.create(name='Overwatch')
+		self.assertEqual([game.name for game in game_registry.get_games()], ['Rainbow Six Siege', 'Overwatch'])
+		other.delete()
+		with self.assertRaises(Game.DoesNotExist):
+			game_registry.get_game(other.id)
+
+	def test_reloaded_on_miss(self):
+		game_registry.get_games()
+		# Games added by another process don't send signals to this one.
+		Game.objects.bulk_create([Game(name='Overwatch')])
+		added = Game.objects.get(name='Overwatch')
+		self.assertEqual(game_registry.get_game(added.id).name, 'Overwatch')
+
+	def test_roles(self):
+		support = Game_Role.objects.create(game=self.game, name='Support', description='Keeps the team going.')
+		with self.assertNumQueries(2):
+			self.assertEqual([role.name for role in game_registry.get_roles(self.game.id)], ['Support'])
+		with self.assertNumQueries(0):
+			self.assertEqual(game_registry.get_role(support.id).name, 'Support')
+
+		# Roles are reloaded as they change, or can't be found.
+		support.name = 'Healer'
+		support.save()
+		self.assertEqual(game_registry.get_role(support.id).name, 'Healer')
+		Game_Role.objects.bulk_create([Game_Role(game=self.game, name='Entry', description='Goes in first.')])
+		entry = Game_Role.objects.get(name='Entry')
+		self.assertEqual(game_registry.get_role(entry.id).name, 'Entry')
+		Game_Role.objects.filter(pk=entry.pk).delete()
+		support.delete()
+		self.assertEqual(game_registry.get_roles(), [])
+		with self.assertRaises(Game_Role.DoesNotExist):
+			game_registry.get_role(support.id)
+
+	def test_api_lists_roles(self):
+		Game_Role.objects.create(game=self.game, name='Support', description='Keeps the team going.')
+		admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+		token = Token.objects.get(user=admin)
+		game_registry.get_roles()
+		with self.assertNumQueries(1):
+			# Only the token and its user are loaded.
+			response = self.client.get('/api/game_role/', HTTP_AUTHORIZATION='Token %s' % token.key)
+		self.assertEqual([role['name'] for role in response.json()], ['Support'])
+
+
+class AffinityTests(MatchmakingTestCase):
+	'''
+	Affinities kept up to date as sessions are rated must match those rebuilt from scratch.
+	'''
+	def test_rebuild_matches_incremental(self):
+		teammate = self.create_profile('teammate')
+		ratings = (5, 1, 4, 3)
+		for rating in ratings:
+			past = Session.objects.create(game=self.game, start=timezone.now() - datetime.timedelta(days=7), end_time=datetime.time(13, 0))
+			Session_Profile.objects.create(session=past, profile=self.profile, rating=rating)
+			Session_Profile.objects.create(session=past, profile=teammate)
+			record_session_rating(self.profile, past, rating)
+
+		incremental = list(Profile_Affinity.objects.values_list('profile_id', 'other_profile_id', 'net_score'))
+		self.assertEqual(incremental, [(self.profile.id, teammate.id, 1)])
+		rebuild_affinities()
+		self.assertEqual(list(Profile_Affinity.objects.values_list('profile_id', 'other_profile_id', 'net_score')), incremental)
+
+		session = self.create_session([teammate])
+		self.assertEqual(views.get_match_recommendation_level(self.profile, session), 1)
+
+
+class SessionIndexTests(MatchmakingTestCase):
+	'''
+	The session index holds every open upcoming session with its players, kept current as they join and leave.
+	'''
+	def setUp(self):
+		super().setUp()
+		self.day = self.start.isoweekday() % 7 + 1
+
+	def candidates(self, games=None, competitive=False, day=None, end_time=datetime.time(14, 0), regions=None):
+		return session_index.candidates(games or [self.game.id], competitive, day or self.day, end_time, regions=regions)
+
+	def test_built_on_first_use(self):
+		host = self.create_profile('host')
+		open_session = self.create_session([host])
+		full = self.create_session([self.create_profile('full')])
+		full.space_available = False
+		full.save()
+		ended = Session.objects.create(game=self.game, start=timezone.now() - datetime.timedelta(days=1), end_time=datetime.time(13, 0))
+
+		# Nothing is indexed until the index is first used, when the database is read once.
+		self.assertIsNone(session_index.built_at)
+		self.assertEqual(self.candidates(), [open_session.id])
+		self.assertNotIn(ended.id, session_index.entries)
+		self.assertEqual(session_index.roster(open_session.id), frozenset([host.id]))
+		with self.assertNumQueries(0):
+			self.assertEqual(self.candidates(), [open_session.id])
+
+	def test_join_and_leave(self):
+		session_index.rebuild()
+		host = self.create_profile('host')
+		session = self.create_session([host])
+		self.assertEqual(self.candidates(), [session.id])
+		self.assertEqual(session_index.roster(session.id), frozenset([host.id]))
+
+		joined = Session_Profile.objects.create(session=session, profile=self.profile)
+		self.assertEqual(session_index.roster(session.id), frozenset([host.id, self.profile.id]))
+		joined.delete()
+		self.assertEqual(session_index.roster(session.id), frozenset([host.id]))
+
+		# Full sessions leave the index, and come back with their players when they open up again.
+		session.space_available = False
+		session.save()
+		self.assertEqual(self.candidates(), [])
+		Session_Profile.objects.create(session=session, profile=self.profile)
+		session.space_available = True
+		session.save()
+		self.assertEqual(self.candidates(), [session.id])
+		self.assertEqual(session_index.roster(session.id), frozenset([host.id, self.profile.id]))
+
+		session_id = session.id
+		Session_Profile.objects.filter(session=session).delete()
+		session.delete()
+		self.assertEqual(self.candidates(), [])
+		self.assertEqual(session_index.members, {})
+		self.assertEqual(session_index.roster(session_id), frozenset())
+
+	def test_buckets(self):
+		session_index.rebuild()
+		session = self.create_session([])
+		competitive = Session.objects.create(game=self.game, start=self.start, end_time=datetime.time(13, 0), competitive=True)
+		europe = Session.objects.create(game=self.game, start=self.start, end_time=datetime.time(13, 0), region=Profile.EUROPE)
+		other_game = Game.objects.create(name='Overwatch', max_players=6)
+		other = Session.objects.create(game=other_game, start=self.start, end_time=datetime.time(13, 0))
+		next_day = Session.objects.create(game=self.game, start=self.start + datetime.timedelta(days=1), end_time=datetime.time(13, 0))
+
+		# Sessions without a region are open to every region.
+		self.assertEqual(self.candidates(regions=[Profile.USWEST]), [session.id])
+		self.assertEqual(self.candidates(), sorted([session.id, europe.id]))
+		self.assertEqual(self.candidates(competitive=True), [competitive.id])
+		self.assertEqual(self.candidates(games=[self.game.id, other_game.id], regions=[Profile.USWEST]), sorted([session.id, other.id]))
+		self.assertEqual(self.candidates(day=self.day % 7 + 1, regions=[Profile.USWEST]), [next_day.id])
+
+		# Sessions must have been running for an hour by the end of the availability.
+		self.assertEqual(self.candidates(end_time=datetime.time(10, 59), regions=[Profile.USWEST]), [])
+		self.assertEqual(self.candidates(end_time=datetime.time(11, 0), regions=[Profile.USWEST]), [session.id])
+
+
+class SessionIndexRankTests(MatchmakingTestCase):
+	'''
+	Sessions with players outside the MMR range are pruned by the session index, and brought back when ranks change.
+	'''
+	def test_rank_window(self):
+		session_index.rebuild()
+		close = self.create_session([self.create_profile('close', rank=1050)])
+		far_player = self.create_profile('far', rank=1500)
+		far = self.create_session([far_player])
+		empty = self.create_session([])
+		day = self.start.isoweekday() % 7 + 1
+
+		def candidates():
+			return session_index.candidates([self.game.id], False, day, datetime.time(14, 0), {self.game.id: 1000}, 100)
+
+		self.assertEqual(candidates(), sorted([close.id, empty.id]))
+
+		account = Profile_Connected_Game_Account.objects.get(profile=far_player)
+		account.cas_rank = 950
+		account.save()
+		self.assertEqual(candidates(), sorted([close.id, far.id, empty.id]))
+
+
+class ViabilityCacheTests(MatchmakingTestCase):
+	'''
+	Cached viabilities are used until the session's players change.
+	'''
+	def test_join_invalidates(self):
+		host = self.create_profile('host')
+		host.teamwork_commends = host.communication_commends = host.skill_commends = host.sportsmanship_commends = 4
+		host.received_ratings = 4
+		host.save()
+		session = self.create_session([host])
+		self.assertEqual(views.calc_match_viablity(self.profile, session), 1.0)
+		with self.assertNumQueries(0):
+			self.assertEqual(views.calc_match_viablity(self.profile, session), 1.0)
+
+		avail = Availability.objects.get(profile=self.profile)
+		newcomer = self.create_profile('newcomer')
+		views.join_session(Session_Profile.objects.create(profile=newcomer), session, avail)
+		self.assertEqual(session.roster_version, 1)
+		self.assertEqual(views.calc_match_viablity(self.profile, session), 0.75)
+
+
+class JoinSessionTests(MatchmakingTestCase):
+	'''
+	Sessions fill up at exactly max_players, and are moved to fit the joining player's availability.
+	'''
+	def test_fills_at_max_players(self):
+		session = self.create_session([self.create_profile('player_%s' % i) for i in range(self.game.max_players - 1)])
+		session.start = session.start.replace(hour=8)
+		session.save()
+		avail = Availability.objects.get(profile=self.profile)
+
+		self.assertTrue(views.join_session(Session_Profile.objects.create(profile=self.profile), session, avail))
+		session.refresh_from_db()
+		self.assertFalse(session.space_available)
+		self.assertEqual(session.start.time(), datetime.time(9, 0))
+
+		late = self.create_profile('late')
+		self.assertFalse(views.join_session(Session_Profile.objects.create(profile=late), session, avail))
+		self.assertEqual(Session_Profile.objects.filter(session=session).count(), self.game.max_players)
+
+
+class ManualMatchmakingTests(MatchmakingTestCase):
+	'''
+	The manual matchmaking list is paged, and sessions are joined by their id.
+	'''
+	def test_pages(self):
+		sessions = [self.create_session([self.create_profile('player_%s' % i)]) for i in range(3)]
+		self.client.force_login(self.profile.user)
+
+		with self.settings(MANUAL_MATCHMAKING_PAGE_SIZE=2):
+			first = self.client.get('/dashboard/manual_matchmaking/').json()
+			second = self.client.get('/dashboard/manual_matchmaking/', {'page': 1}).json()
+		self.assertEqual(first['next_page'], 1)
+		self.assertIsNone(second['next_page'])
+		self.assertIn('js-load-more-matches', first['html_match_list'])
+		self.assertEqual(second['html_match_list'].count('/join/'), 1)
+
+		self.client.get('/dashboard/manual_matchmaking/%s/join/' % sessions[1].id)
+		self.assertEqual(Session_Profile.objects.get(profile=self.profile).session, sessions[1])
+
+
+class AvailabilityOverlapTests(MatchmakingTestCase):
+	'''
+	New availabilities can't overlap the user's existing ones, compared in exact times.
+	'''
+	def get_form(self, start_time, end_time, instance=None):
+		data = {'pref_day': self.start.strftime('%A'), 'start_time': start_time, 'end_time': end_time}
+		return UserAvailabilityForm(data, instance=instance, user=User.objects.get(pk=self.profile.user.pk))
+
+	def test_overlap(self):
+		self.assertFalse(self.get_form('13:00', '15:00').is_valid())
+		self.assertFalse(self.get_form('10:00', '11:00').is_valid())
+		self.assertTrue(self.get_form('14:00', '15:00').is_valid())
+
+	def test_within_slot(self):
+		# Ranges that share a 15 minute slot, but not any time, don't overlap.
+		Availability.objects.create(profile=self.profile, start_time=datetime.time(16, 0), end_time=datetime.time(16, 5), pref_day=self.start.strftime('%A'))
+		self.assertTrue(self.get_form('16:10', '16:20').is_valid())
+		self.assertTrue(self.get_form('14:00', '16:00').is_valid())
+		self.assertFalse(self.get_form('16:04', '16:20').is_valid())
+
+	def test_session_needs_an_hour(self):
+		avail = Availability(start_time=datetime.time(10, 0), end_time=datetime.time(11, 0), pref_day=self.start.strftime('%A'))
+		# Only 46 minutes overlap, although the session touches every slot of the availability.
+		session = Session(game=self.game, start=timezone.make_aware(datetime.datetime.combine(self.start.date(), datetime.time(10, 14))), end_time=datetime.time(12, 0))
+		self.assertFalse(views.is_time_acceptable(session, avail))
+		session.start = session.start.replace(minute=0)
+		self.assertTrue(views.is_time_acceptable(session, avail))
+
+	def test_session_without_end_time(self):
+		# Sessions without an end time run until the end of the day.
+		avail = Availability(start_time=datetime.time(22, 0), end_time=datetime.time(23, 30), pref_day=self.start.strftime('%A'))
+		session = Session(game=self.game, start=timezone.make_aware(datetime.datetime.combine(self.start.date(), datetime.time(22, 0))), end_time=None)
+		self.assertTrue(views.is_time_acceptable(session, avail))
+		avail.start_time = datetime.time(23, 0)
+		self.assertFalse(views.is_time_acceptable(session, avail))
+
+		# They are matched like any other session.
+		session = self.create_session([self.create_profile('host')])
+		session.end_time = None
+		session.save()
+		self.assertEqual([match[1][0] for match in views.get_suitable_sessions(self.profile)], [session])
+
+	def test_masks_rule_out(self):
+		# Sessions outside the mask aren't checked in exact times, even if they overlap.
+		avail = Availability.objects.get(profile=self.profile)
+		session = self.create_session([])
+		self.assertTrue(views.is_time_acceptable(session, avail))
+		self.assertFalse(views.is_time_acceptable(session, avail, 0))
+
+	def test_edit_own_availability(self):
+		avail = Availability.objects.get(profile=self.profile)
+		self.assertTrue(self.get_form('08:00', '15:00', instance=avail).is_valid())
+
+	def test_mask_follows_deletes(self):
+		Availability.objects.filter(profile=self.profile).delete()
+		self.assertTrue(self.get_form('10:00', '11:00').is_valid())
+
+
+class SessionAggregateTests(MatchmakingTestCase):
+	'''
+	Session commend aggregates kept up to date as players join and are rated must match those rebuilt from scratch.
+	'''
+	def test_maintained_matches_rebuilt(self):
+		host = self.create_profile('host')
+		host.teamwork_commends = 2
+		host.received_ratings = 4
+		host.save()
+		host.refresh_from_db()
+		session = self.create_session([host])
+		avail = Availability.objects.get(profile=self.profile)
+		views.join_session(Session_Profile.objects.create(profile=self.create_profile('newcomer')), session, avail)
+
+		# Host is rated again.
+		old_ratios = session_aggregates.get_profile_ratios(host)
+		host.skill_commends += 1
+		host.received_ratings += 1
+		host.save()
+		session_aggregates.update_player_ratios(host, old_ratios)
+
+		session.refresh_from_db()
+		maintained = [getattr(session, field) for field in ('player_count', 'unrated_player_count') + session_aggregates.RATIO_FIELDS]
+		session_aggregates.rebuild_session_aggregates(Session.objects.filter(pk=session.pk))
+		session.refresh_from_db()
+		rebuilt = [getattr(session, field) for field in ('player_count', 'unrated_player_count') + session_aggregates.RATIO_FIELDS]
+		for value, expected in zip(maintained, rebuilt):
+			self.assertAlmostEqual(value, expected)
+
+		# Host is worth 0.5 * 2/5 + 0.125 * 1/5, the newcomer 0.5.
+		self.assertAlmostEqual(views.calc_match_viablity(self.profile, session), (0.2 + 0.025 + 0.5) / 2)
@@ -1,7 +1,9 @@
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import viewsets
+from rest_framework.response import Response
 from ..api import serializers
 from ..api.models import Profile, Availability, Game, Game_Role, Session, Session_Profile, Report, Profile_Connected_Game_Account, Feedback,Banned_User
+from mysite.game_registry import game_registry
 
 '''
 Methods available to the ReST API.
@@ -52,6 +54,13 @@ class Game_RoleViewSet(viewsets.ModelViewSet):
 	queryset = Game_Role.objects.all()
 	serializer_class = serializers.Game_RoleSerializer
 
+	def list(self, request, *args, **kwargs):
+		'''
+		Lists every game role from the game registry, rather than the database.
+		'''
+		serializer = self.get_serializer(game_registry.get_roles(), many=True)
+		return Response(serializer.data)
+
 
 class SessionViewSet(viewsets.ModelViewSet):
 	'''
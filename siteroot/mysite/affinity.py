@@ -0,0 +1,80 @@
+'''
+Maintains the Profile_Affinity table used to recommend sessions.
+Affinities are updated as sessions are rated (see RateSessionForm.save), so recommending a session
+only has to look up the affinities of the user towards its current players.
+'''
+import collections
+from apps.api.models import Session_Profile, Profile_Affinity
+from django.db import transaction
+from django.db.models import F
+
+
+def get_rating_effect(rating):
+	'''
+	Returns how a session rating affects the affinity towards each other player in the session.
+	'''
+	if rating is None:
+		return 0
+	rating = int(rating)
+	if rating > 3:
+		return 1
+	elif rating < 3:
+		return -1
+	return 0
+
+
+def record_session_rating(profile, session, rating):
+	'''
+	Applies a profile's rating of a session to its affinity towards the other players in it.
+	'''
+	effect = get_rating_effect(rating)
+	if effect == 0:
+		return
+
+	other_profiles = set(Session_Profile.objects.filter(session=session).exclude(profile=profile).values_list('profile_id', flat=True))
+	if not other_profiles:
+		return
+
+	with transaction.atomic():
+		affinities = Profile_Affinity.objects.select_for_update().filter(profile=profile, other_profile__in=other_profiles)
+		existing = set(affinities.values_list('other_profile_id', flat=True))
+		if existing:
+			affinities.update(net_score=F('net_score') + effect)
+		Profile_Affinity.objects.bulk_create(
+			Profile_Affinity(profile_id=profile.id, other_profile_id=other_profile, net_score=effect)
+			for other_profile in other_profiles - existing
+		)
+
+
+def rebuild_affinities():
+	'''
+	Recalculates every affinity from the ratings stored against each session, replacing the table.
+	Only the first rating a profile gave a session is counted.
+	Returns the number of affinities stored.
+	'''
+	# The effect of each rated session on the profile that rated it.
+	effects = {}
+	for profile_id, session_id, rating in Session_Profile.objects.exclude(rating=None).exclude(session=None).order_by('id').values_list('profile_id', 'session_id', 'rating'):
+		effects.setdefault((profile_id, session_id), get_rating_effect(rating))
+
+	# The players of each rated session.
+	rosters = collections.defaultdict(set)
+	session_ids = set(session_id for profile_id, session_id in effects)
+	for session_id, profile_id in Session_Profile.objects.filter(session__id__in=session_ids).values_list('session_id', 'profile_id'):
+		rosters[session_id].add(profile_id)
+
+	scores = collections.Counter()
+	for (profile_id, session_id), effect in effects.items():
+		if effect == 0:
+			continue
+		for other_profile in rosters[session_id]:
+			if other_profile != profile_id:
+				scores[profile_id, other_profile] += effect
+
+	with transaction.atomic():
+		Profile_Affinity.objects.all().delete()
+		Profile_Affinity.objects.bulk_create((
+			Profile_Affinity(profile_id=profile_id, other_profile_id=other_profile, net_score=net_score)
+			for (profile_id, other_profile), net_score in scores.items()
+		), batch_size=1000)
+	return len(scores)
@@ -0,0 +1,47 @@
+'''
+Cached sets of the profiles each profile has reported, which matchmaking never places them with.
+Blocklists are cached against the profile's blocklist_version, which is incremented in the database whenever
+one of their reports is created or deleted (including through the admin). Every process, such as the matchmaking
+worker, therefore stops using a stale blocklist as soon as it loads the profile again, whichever process made the report.
+'''
+from apps.api.models import Profile, Report
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+
+def get_blocklist_key(profile):
+	'''
+	Returns the cache key of a profile's blocklist.
+	'''
+	return 'blocklist:%s:%s' % (profile.id, profile.blocklist_version)
+
+
+def get_blocked_profiles(profile):
+	'''
+	Returns a frozenset of the ids of the profiles that the given profile has reported.
+	'''
+	key = get_blocklist_key(profile)
+	blocked = cache.get(key)
+	if blocked is None:
+		blocked = frozenset(Report.objects.filter(sent_by=profile.id).values_list('user_reported_id', flat=True))
+		cache.set(key, blocked, settings.BLOCKLIST_CACHE_TIMEOUT)
+	return blocked
+
+
+def invalidate_blocked_profiles(profile_id):
+	'''
+	Increments a profile's blocklist version, so its blocklist is reloaded on next use by every process.
+	'''
+	Profile.objects.filter(pk=profile_id).update(blocklist_version=F('blocklist_version') + 1)
+
+
+@receiver(post_save, sender=Report)
+@receiver(post_delete, sender=Report)
+def invalidate_report_sender(sender, instance=None, **kwargs):
+	'''
+	Drops the blocklist of the profile that sent a report when the report changes.
+	'''
+	invalidate_blocked_profiles(instance.sent_by_id)
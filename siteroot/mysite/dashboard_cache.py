@@ -0,0 +1,113 @@
+'''
+Cached sections of each profile's dashboard (connected accounts, availabilities and previous sessions),
+which change much less often than the dashboard is loaded.
+Sections are cached against the profile's dashboard_version, which is incremented in the database as the rows they
+are built from are saved or deleted, including through the admin and by the matchmaking worker. Every process
+therefore stops using stale sections as soon as it loads the profile again, whichever process made the change.
+ - Availabilities increment the version of their profile.
+ - Connected accounts increment the version of their profile, and of everyone who has played with it, as previous
+   sessions show the account's player tag.
+ - Session profiles increment the version of everyone in the session.
+ - Profiles increment their own version and that of everyone who has played with them, as previous sessions show
+   the profile's commends, and viabilities depend on their commends and commend priorities. This is only done when
+   one of DASHBOARD_FIELDS is saved, so saves on the matchmaking path that only change in_queue don't pay for it.
+   Session ratings update commends with update queries, and increment the versions of every rated player's teammates
+   at once with invalidate_teammate_dashboards after their transaction.
+Previous sessions are also only cached until the profile's next session starts, when it becomes a previous session.
+'''
+from apps.api.models import Profile, Profile_Connected_Game_Account, Availability, Session_Profile
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+# Profile fields that the cached sections are built from.
+DASHBOARD_FIELDS = frozenset((
+	'teamwork_commends', 'communication_commends', 'skill_commends', 'sportsmanship_commends', 'received_ratings',
+	'commend_priority_1', 'commend_priority_2', 'commend_priority_3', 'commend_priority_4',
+))
+
+
+def get_section_key(profile, section):
+	'''
+	Returns the cache key of a section of a profile's dashboard.
+	'''
+	return 'dashboard:%s:%s:%s' % (section, profile.id, profile.dashboard_version)
+
+
+def get_section(profile, section, build, *args):
+	'''
+	Returns a section of a profile's dashboard, calling build(*args) to build it if it isn't cached.
+	build returns the section and the seconds it can be cached for, or None for DASHBOARD_CACHE_TIMEOUT.
+	'''
+	key = get_section_key(profile, section)
+	value = cache.get(key)
+	if value is None:
+		value, timeout = build(*args)
+		cache.set(key, value, settings.DASHBOARD_CACHE_TIMEOUT if timeout is None else timeout)
+	return value
+
+
+def invalidate_dashboards(profile_ids):
+	'''
+	Increments the dashboard versions of the given profiles, so their sections are rebuilt on next use by every process.
+	'''
+	Profile.objects.filter(pk__in=set(profile_ids)).update(dashboard_version=F('dashboard_version') + 1)
+
+
+def get_teammate_ids(profile_ids):
+	'''
+	Returns the ids of the profiles that have been in a session with any of the given profiles, including themselves.
+	'''
+	profile_ids = set(profile_ids)
+	teammates = set(Session_Profile.objects.filter(session__session_profile__profile__id__in=profile_ids).values_list('profile_id', flat=True))
+	return teammates | profile_ids
+
+
+def invalidate_teammate_dashboards(profile_ids):
+	'''
+	Increments the dashboard versions of the given profiles and of everyone who has played with them.
+	'''
+	invalidate_dashboards(get_teammate_ids(profile_ids))
+
+
+@receiver(post_save, sender=Availability)
+@receiver(post_delete, sender=Availability)
+def invalidate_availabilities(sender, instance=None, **kwargs):
+	'''
+	Drops the dashboard of the profile whose availability changed.
+	'''
+	invalidate_dashboards([instance.profile_id])
+
+
+@receiver(post_save, sender=Profile_Connected_Game_Account)
+@receiver(post_delete, sender=Profile_Connected_Game_Account)
+def invalidate_connected_account(sender, instance=None, **kwargs):
+	'''
+	Drops the dashboards of the profile whose account changed, and of the profiles whose previous sessions show it.
+	'''
+	invalidate_teammate_dashboards([instance.profile_id])
+
+
+@receiver(post_save, sender=Session_Profile)
+@receiver(post_delete, sender=Session_Profile)
+def invalidate_session_profile(sender, instance=None, **kwargs):
+	'''
+	Drops the dashboards of everyone in the session whose players or ratings changed.
+	'''
+	profile_ids = [instance.profile_id]
+	# Queue entries aren't shown until they are placed in a session.
+	if instance.session_id is not None:
+		profile_ids.extend(Session_Profile.objects.filter(session__id=instance.session_id).values_list('profile_id', flat=True))
+	invalidate_dashboards(profile_ids)
+
+
+@receiver(post_save, sender=Profile)
+def invalidate_profile(sender, instance=None, created=False, update_fields=None, **kwargs):
+	'''
+	Drops the dashboards of a changed profile and of everyone who has played with them, if a field they show was saved.
+	'''
+	if created or (update_fields is not None and not DASHBOARD_FIELDS.intersection(update_fields)):
+		return
+	invalidate_teammate_dashboards([instance.id])
@@ -4,8 +4,13 @@ from django import forms
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.models import User
 from django.contrib.auth.forms import UserCreationForm, UserChangeForm, AuthenticationForm
-from apps.api.models import Profile, Feedback, Profile_Connected_Game_Account, Availability, Session, Session_Profile, Report, Game
+from apps.api.models import Profile, Feedback, Profile_Connected_Game_Account, Availability, Session, Session_Profile, Report
 from mysite import views
+from mysite.affinity import record_session_rating
+from mysite.game_registry import game_registry
+from mysite.viability_cache import bump_roster_versions
+from mysite import dashboard_cache, session_aggregates, weekly_slots
+from django.db import transaction
 from django.forms import ModelForm
 from django.utils.safestring import mark_safe
 from django.utils.timezone import localdate, now
@@ -330,40 +335,23 @@ class UserAvailabilityForm(forms.ModelForm):
 
 			# If the start time is overlapping, it is removed from cleaned data.
 			# This else ensures that we only continue with checks if the times are valid.
-			else:
-				# In case we're editing.
-				if self.instance is not None:
-					avail_pk = self.instance.pk
-				else:
-					avail_pk = -1
-				# Check availability already existing.
-				avail_start = Availability.objects.filter(
+			# Availabilities that don't share a slot with the user's compiled mask can't overlap any of theirs.
+			elif cleaned_data.get('pref_day') in weekly_slots.DAYS and weekly_slots.get_range_mask(cleaned_data.get('pref_day'), start_time, end_time, touched=True) & weekly_slots.from_bytes(self.user.profile.availability_mask):
+				# The user's other availabilities that overlap this one, compared in exact times.
+				# Availabilities that only touch end to start don't overlap.
+				overlapping = Availability.objects.filter(
 					profile=self.user.profile,
-					start_time__range=(
-						cleaned_data.get('start_time'),
-						cleaned_data.get('end_time'),
-					),
 					pref_day=cleaned_data.get('pref_day'),
-				).exclude(pk=avail_pk)
+					start_time__lt=end_time,
+					end_time__gt=start_time,
+				)
 
-				avail_end = Availability.objects.filter(
-					profile=self.user.profile,
-					end_time__range=(
-						cleaned_data.get('start_time'),
-						cleaned_data.get('end_time'),
-					),
-					pref_day=cleaned_data.get('pref_day'),
-				).exclude(pk=avail_pk)
-
-				avail_inside = Availability.objects.filter(
-					profile=self.user.profile,
-					start_time__lte=cleaned_data.get('start_time'),
-					end_time__gte=cleaned_data.get('end_time'),
-					pref_day=cleaned_data.get('pref_day'),
-				).exclude(pk=avail_pk)
+				# In case we're editing, leave out the availability being edited.
+				if self.instance is not None and self.instance.pk is not None:
+					overlapping = overlapping.exclude(pk=self.instance.pk)
 
 				# Error if overlap occurs.
-				if any ([avail_start, avail_inside, avail_end]):
+				if overlapping.exists():
 					raise forms.ValidationError("An availability already exists for this time and day, or you are overlapping.")
 
 		# Always return the cleaned data!
@@ -396,8 +384,8 @@ class RateSessionForm(forms.Form):
 		players = Session_Profile.objects.filter(session=self.session).exclude(profile=self.profile.id)
 		self.player_count = len(players)
 		for i, player in enumerate(players):
-            # Get teammates ign so the user knows who they are.
-            ign = Profile_Connected_Game_Account.filter(game=self.session.game.id, profile=player.profile.id).first()
+			# Get teammates ign so the user knows who they are.
+			ign = Profile_Connected_Game_Account.objects.filter(game=self.session.game_id, profile=player.profile.id).first()
 			self.fields['player_%s_id' % i] = forms.CharField(initial=player.profile.id, label='')
 			self.fields['player_%s_id' % i].widget = forms.HiddenInput()
 			self.fields['player_%s_name' % i] = forms.CharField(disabled=True, label='Player', initial=player.profile.user.username)
@@ -421,30 +409,50 @@ class RateSessionForm(forms.Form):
 		session_profile.rating = self.cleaned_data.get('rating')
 		session_profile.save()
 
-		# Apply commendations and reports.
-		for i in range(0, self.player_count):
-			# Get profile.
-			persons_profile = Profile.objects.get(pk=self.cleaned_data['player_%s_id' % i])
-			commends = self.cleaned_data.get('player_%s_commends' % i)
-			print(commends)
-			
-			# Apply commendations and reports.
-			if commends is not None:
-				for com in commends:
-					if com == 'Skill':
-						persons_profile.skill_commends += 1
-					elif com == 'Sportsmanship':
-						persons_profile.sportsmanship_commends += 1
-					elif com == 'Communication':
-						persons_profile.communication_commends += 1
-					elif com == 'Teamwork':
-						persons_profile.teamwork_commends += 1
-
-			if self.cleaned_data['player_%s_report' % i]:
-				report = Report.objects.create(session=self.session, user_reported=persons_profile, sent_by=self.profile, report_reason='toxic')
-				report.save()
-			persons_profile.received_ratings += 1
-			persons_profile.save()
+		# Update how the user feels about playing with the rest of the session.
+		record_session_rating(self.profile, self.session, session_profile.rating)
+
+		# Apply commendations and reports, updating each player and the sessions they are in together.
+		with transaction.atomic():
+			for i in range(0, self.player_count):
+				# Get profile.
+				persons_profile = Profile.objects.select_for_update().get(pk=self.cleaned_data['player_%s_id' % i])
+				old_ratios = session_aggregates.get_profile_ratios(persons_profile)
+				commends = self.cleaned_data.get('player_%s_commends' % i)
+
+				# Apply commendations and reports.
+				if commends is not None:
+					for com in commends:
+						if com == 'Skill':
+							persons_profile.skill_commends += 1
+						elif com == 'Sportsmanship':
+							persons_profile.sportsmanship_commends += 1
+						elif com == 'Communication':
+							persons_profile.communication_commends += 1
+						elif com == 'Teamwork':
+							persons_profile.teamwork_commends += 1
+
+				if self.cleaned_data['player_%s_report' % i]:
+					report = Report.objects.create(session=self.session, user_reported=persons_profile, sent_by=self.profile, report_reason='toxic')
+					report.save()
+				persons_profile.received_ratings += 1
+
+				# Saved with an update query, so the dashboards showing them are dropped for every player at once below, outside the lock.
+				Profile.objects.filter(pk=persons_profile.pk).update(
+					teamwork_commends=persons_profile.teamwork_commends,
+					communication_commends=persons_profile.communication_commends,
+					skill_commends=persons_profile.skill_commends,
+					sportsmanship_commends=persons_profile.sportsmanship_commends,
+					received_ratings=persons_profile.received_ratings,
+				)
+
+				# Keep the aggregates of every session they are in up to date.
+				session_aggregates.update_player_ratios(persons_profile, old_ratios)
+
+		# Every session the rated players are in scores differently now.
+		rated_profiles = [self.cleaned_data['player_%s_id' % i] for i in range(0, self.player_count)]
+		bump_roster_versions(Session.objects.filter(session_profile__profile__in=rated_profiles))
+		dashboard_cache.invalidate_teammate_dashboards(rated_profiles)
 
 
 class SelectMatchmakingOptionsForm(forms.Form):
@@ -479,13 +487,13 @@ class SelectMatchmakingOptionsForm(forms.Form):
 		self.fields['commend_priority_2'].initial = self.user.profile.commend_priority_2
 		self.fields['commend_priority_3'].initial = self.user.profile.commend_priority_3
 		self.fields['commend_priority_4'].initial = self.user.profile.commend_priority_4
-		# Get preferred game.
-		games_a = Profile_Connected_Game_Account.objects.filter(profile=self.user.profile)
-		self.fields['pref_game'] = forms.ChoiceField(choices=[(g.game.id, g.game.name) for g in games_a])
-		if self.user.profile.pref_game is not None:
-			self.fields['pref_game'].initial = self.user.profile.pref_game.name
+		# Get preferred game, from the games the user has connected an account for.
+		games_a = [game_registry.get_game(game_id) for game_id in Profile_Connected_Game_Account.objects.filter(profile=self.user.profile).values_list('game_id', flat=True)]
+		self.fields['pref_game'] = forms.ChoiceField(choices=[(g.id, g.name) for g in games_a])
+		if self.user.profile.pref_game_id is not None:
+			self.fields['pref_game'].initial = game_registry.get_game(self.user.profile.pref_game_id).name
 		elif len(games_a) > 0:
-			self.fields['pref_game'].initial = games_a[0].game.name
+			self.fields['pref_game'].initial = games_a[0].name
 		# Set matchmaking override.
 		self.fields['ignore_matchmaking'].initial = self.user.profile.ignore_matchmaking
 
@@ -501,7 +509,7 @@ class SelectMatchmakingOptionsForm(forms.Form):
 		# Save override status.
 		self.user.profile.ignore_matchmaking = self.cleaned_data.get('ignore_matchmaking')
 		# Save preferred game.
-		self.user.profile.pref_game = Game.objects.get(id=self.cleaned_data.get('pref_game'))
+		self.user.profile.pref_game = game_registry.get_game(int(self.cleaned_data.get('pref_game')))
 		# Save changes made.
 		self.user.profile.save()
 
@@ -568,17 +576,9 @@ class CreateSessionForm(forms.ModelForm):
 	def __init__(self, *args, **kwargs):
 		self.user = kwargs.pop('user')
 		super(CreateSessionForm, self).__init__(*args, **kwargs)
-		game_accounts = Profile_Connected_Game_Account.objects.filter(profile=self.user.profile)
-		new_choices = list(self.fields['game'].choices)
-		games_available = []
-		for i, g in enumerate(game_accounts):
-			games_available.append(g.game.name)
-
-		for choice in new_choices:
-			if choice[1] not in games_available:
-				new_choices.remove(choice)
-
-		self.fields['game'].choices = new_choices
+		# Only the games the user has connected an account for can be chosen.
+		games_available = set(Profile_Connected_Game_Account.objects.filter(profile=self.user.profile).values_list('game_id', flat=True))
+		self.fields['game'].choices = [(g.id, g.name) for g in game_registry.get_games() if g.id in games_available]
 
 
 	def clean(self):
@@ -615,11 +615,13 @@ class CreateSessionForm(forms.ModelForm):
 
 		# Create a new session.
 		session = Session()
-		session.game = Game.objects.get(pk=self.data['game'])
+		session.game = game_registry.get_game(int(self.data['game']))
 		session.start = start
 		session.end_time = self.data['end_time']
 		if self.data.get('competitive', False):
 			session.competitive = True
+		session.region = self.user.profile.pref_server
+		session_aggregates.add_player(session, self.user.profile)
 
 		session.save()
 
@@ -628,4 +630,5 @@ class CreateSessionForm(forms.ModelForm):
 		session_profile.session = session
 		session_profile.profile = self.user.profile
 
-		session_profile.save()
\ No newline at end of file
+		session_profile.save()
+		bump_roster_versions(Session.objects.filter(pk=session.pk))
\ No newline at end of file
@@ -0,0 +1,113 @@
+'''
+Process-local catalog of the games we support and their roles, used by views, forms and the API instead of querying
+the handful of rows in the Game and Game_Role tables on every request.
+The catalog is loaded from the database on first use, dropped by the signals at the bottom of this file whenever
+a game or role is saved or deleted in this process (including through the admin), and reloaded every
+GAME_REGISTRY_MAX_AGE seconds to pick up changes made by other processes. Games and roles added by other processes
+in the meantime are found by reloading when one isn't in the catalog.
+Games are held as Game instances with their image's URL resolved into image_url, and roles as Game_Role instances.
+They are shared by every request of the process, so must not be changed.
+'''
+import threading, time
+from apps.api.models import Game, Game_Role
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+
+class GameRegistry:
+	'''
+	Every game and role by id, in the order they were added.
+	'''
+	def __init__(self, max_age=None):
+		self.lock = threading.RLock()
+		self.max_age = max_age
+		self.clear()
+
+	def clear(self):
+		'''
+		Empties the registry, causing it to be reloaded on next use.
+		'''
+		with self.lock:
+			# Game id -> Game.
+			self.games = {}
+			# Game_Role id -> Game_Role.
+			self.roles = {}
+			self.loaded_at = None
+
+	def load(self):
+		'''
+		Loads every game and role from the database.
+		'''
+		with self.lock:
+			games = {}
+			for game in Game.objects.order_by('id'):
+				game.image_url = game.image.url if game.image else None
+				games[game.id] = game
+			self.games = games
+			self.roles = dict((role.id, role) for role in Game_Role.objects.order_by('id'))
+			self.loaded_at = time.monotonic()
+
+	def ensure_loaded(self):
+		'''
+		Loads the registry if it hasn't been loaded yet, or if it is older than max_age.
+		'''
+		with self.lock:
+			if self.loaded_at is None or (self.max_age is not None and time.monotonic() - self.loaded_at > self.max_age):
+				self.load()
+
+	def get_games(self):
+		'''
+		Returns a list of every game.
+		'''
+		with self.lock:
+			self.ensure_loaded()
+			return list(self.games.values())
+
+	def get_game(self, game_id):
+		'''
+		Returns the game with the given id, reloading the registry once if it isn't there, as it may have been added by another process.
+		Raises Game.DoesNotExist if there is no such game.
+		'''
+		with self.lock:
+			self.ensure_loaded()
+			if game_id not in self.games:
+				self.load()
+			if game_id not in self.games:
+				raise Game.DoesNotExist('There is no game with id %s.' % game_id)
+			return self.games[game_id]
+
+	def get_roles(self, game_id=None):
+		'''
+		Returns a list of every role, or only the roles of the given game.
+		'''
+		with self.lock:
+			self.ensure_loaded()
+			return [role for role in self.roles.values() if game_id is None or role.game_id == game_id]
+
+	def get_role(self, role_id):
+		'''
+		Returns the role with the given id, reloading the registry once if it isn't there, as it may have been added by another process.
+		Raises Game_Role.DoesNotExist if there is no such role.
+		'''
+		with self.lock:
+			self.ensure_loaded()
+			if role_id not in self.roles:
+				self.load()
+			if role_id not in self.roles:
+				raise Game_Role.DoesNotExist('There is no role with id %s.' % role_id)
+			return self.roles[role_id]
+
+
+game_registry = GameRegistry(max_age=getattr(settings, 'GAME_REGISTRY_MAX_AGE', None))
+
+
+@receiver(post_save, sender=Game)
+@receiver(post_delete, sender=Game)
+@receiver(post_save, sender=Game_Role)
+@receiver(post_delete, sender=Game_Role)
+def reload_games(sender, **kwargs):
+	'''
+	Drops the registry when a game or role changes, so it is reloaded on next use.
+	'''
+	game_registry.clear()
@@ -0,0 +1,101 @@
+import datetime, threading, time
+from apps.api.models import Profile, Availability, Session, Session_Profile, Game
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from mysite.views import join_session
+
+
+class Command(BaseCommand):
+	'''
+	Has many players join the same sessions at once, to measure join_session throughput and check that sessions are never overfilled.
+	Creates its own game, players and sessions, and deletes them afterwards.
+	Usage: python manage.py benchmark_join_session [--sessions N] [--joiners N] [--threads N] [--max-players N]
+	'''
+	help = 'Benchmarks concurrent joins of the same sessions and checks none are overfilled.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--sessions', type=int, default=20, help='Sessions to fill.')
+		parser.add_argument('--joiners', type=int, default=20, help='Players competing to join each session.')
+		parser.add_argument('--threads', type=int, default=8, help='Players joining at the same time.')
+		parser.add_argument('--max-players', type=int, default=5, help='Size of each session.')
+
+	def handle(self, *args, **options):
+		if options['joiners'] < options['max_players']:
+			raise CommandError('There must be at least as many joiners as spaces in a session.')
+
+		game = Game.objects.create(name='Join Benchmark', max_players=options['max_players'])
+		start = (timezone.now() + datetime.timedelta(days=1)).replace(hour=12, minute=0, second=0, microsecond=0)
+		users = []
+		try:
+			# Players with an availability covering the sessions.
+			avails = []
+			for i in range(options['joiners']):
+				user = User.objects.create_user('join_benchmark_%s' % i)
+				users.append(user)
+				avails.append(Availability.objects.create(
+					profile=user.profile,
+					start_time=datetime.time(11, 0),
+					end_time=datetime.time(15, 0),
+					pref_day=start.strftime('%A'),
+				))
+			sessions = [Session.objects.create(game=game, start=start, end_time=datetime.time(14, 0)) for i in range(options['sessions'])]
+
+			# Every player tries to join every session, several at a time.
+			attempts = [(session, user, avail) for session in sessions for user, avail in zip(users, avails)]
+			joined = []
+			errors = []
+			lock = threading.Lock()
+
+			def join_sessions():
+				try:
+					while True:
+						with lock:
+							if not attempts:
+								return
+							session, user, avail = attempts.pop()
+						session_profile = Session_Profile.objects.create(profile=user.profile)
+						try:
+							if join_session(session_profile, Session.objects.get(pk=session.pk), avail):
+								with lock:
+									joined.append(session.pk)
+							else:
+								session_profile.delete()
+						except Exception as e:
+							session_profile.delete()
+							with lock:
+								errors.append(e)
+				finally:
+					connection.close()
+
+			threads = [threading.Thread(target=join_sessions) for i in range(options['threads'])]
+			started = time.monotonic()
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+			elapsed = time.monotonic() - started
+
+			# Check every session holds exactly as many players as it has spaces, and agrees with the joins reported.
+			overfilled = 0
+			for session in sessions:
+				players = Session_Profile.objects.filter(session=session).count()
+				if players > options['max_players'] or players != joined.count(session.pk):
+					overfilled += 1
+
+			attempted = options['sessions'] * options['joiners']
+			self.stdout.write('%s joins of %s attempts in %.3fs (%.1f attempts/s) using %s threads' % (len(joined), attempted, elapsed, attempted / elapsed, options['threads']))
+			self.stdout.write('%s errors, %s sessions overfilled or inconsistent' % (len(errors), overfilled))
+			for error in sorted(set(repr(e) for e in errors)):
+				self.stdout.write('  %s' % error)
+			if overfilled:
+				raise CommandError('Sessions were overfilled.')
+		finally:
+			# Remove everything the benchmark created.
+			Session_Profile.objects.filter(profile__user__in=users).delete()
+			Session.objects.filter(game=game).delete()
+			Availability.objects.filter(profile__user__in=users).delete()
+			Profile.objects.filter(user__in=users).delete()
+			User.objects.filter(pk__in=[user.pk for user in users]).delete()
+			game.delete()
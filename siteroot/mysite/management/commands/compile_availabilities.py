@@ -0,0 +1,19 @@
+from apps.api.models import Profile
+from django.core.management.base import BaseCommand
+from mysite.weekly_slots import update_profile_mask
+
+
+class Command(BaseCommand):
+	'''
+	Recompiles every profile's weekly availability mask from their availabilities.
+	Run once after the mask is added, as availabilities saved before then haven't been compiled.
+	Usage: python manage.py compile_availabilities
+	'''
+	help = 'Recompiles the availability masks of all profiles.'
+
+	def handle(self, *args, **options):
+		count = 0
+		for profile_id in Profile.objects.values_list('id', flat=True).iterator():
+			update_profile_mask(profile_id)
+			count += 1
+		self.stdout.write('Compiled the availabilities of %s profiles' % count)
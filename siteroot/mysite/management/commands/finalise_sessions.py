@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from mysite.session_history import finalise_sessions
+
+
+class Command(BaseCommand):
+	'''
+	Snapshots the viability and players of every session that has ended, for each of its players' history.
+	Meant to be run periodically, e.g. from cron alongside the discord bot's end of session messages.
+	Usage: python manage.py finalise_sessions [--batch-size N]
+	'''
+	help = 'Snapshots sessions that have ended into their players\' history.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--batch-size', type=int, default=settings.SESSION_HISTORY_BATCH_SIZE, help='Session profiles snapshotted per query.')
+
+	def handle(self, *args, **options):
+		count = finalise_sessions(options['batch_size'])
+		self.stdout.write('Finalised %s session profiles' % count)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from mysite.matchmaking import get_shard_metrics
+
+
+class Command(BaseCommand):
+	'''
+	Reports the queue depth and match rate of each shard of the matchmaking queue.
+	Usage: python manage.py matchmaking_metrics
+	'''
+	help = 'Reports per-shard matchmaking queue depth and match rate.'
+
+	def handle(self, *args, **options):
+		shard_metrics = get_shard_metrics()
+		if not shard_metrics:
+			self.stdout.write('No shards have been queued or processed')
+		for shard, metrics in shard_metrics.items():
+			match_rate = '%.1f%%' % (metrics.match_rate * 100) if metrics.match_rate is not None else '-'
+			self.stdout.write('Game %s, %s, %s: %s queued, %s of %s matched (%s) over %s ticks, last tick %s of %s matched in %.3fs' % (
+				shard.game_id, shard.region, 'competitive' if shard.competitive else 'casual', metrics.queue_depth,
+				metrics.matched, metrics.attempted, match_rate, metrics.ticks, metrics.last_matched, metrics.last_attempted, metrics.last_elapsed))
@@ -0,0 +1,91 @@
+import argparse, time
+from apps.api.models import Profile
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from mysite.game_registry import game_registry
+from mysite.matchmaking import Shard, IncrementalMatcher, run_shard_ticks, run_batch_matchmaking_tick
+from mysite.session_index import session_index
+
+# Playlist names accepted by --shard.
+PLAYLISTS = {'casual': False, 'competitive': True}
+
+
+def parse_shard(value):
+	'''
+	Parses a shard given as GAME_ID:REGION:casual|competitive.
+	'''
+	try:
+		game_id, region, playlist = value.split(':')
+		shard = Shard(int(game_id), region, PLAYLISTS[playlist])
+	except (ValueError, KeyError):
+		raise argparse.ArgumentTypeError('Shards are given as GAME_ID:REGION:casual|competitive, not %r.' % value)
+	if region not in dict(Profile.PREF_SERVER_CHOICES):
+		raise argparse.ArgumentTypeError('Unknown region %r.' % region)
+	return shard
+
+
+class Command(BaseCommand):
+	'''
+	Long-running worker that matches queued players into sessions, so the web requests don't have to.
+	Usage: python manage.py matchmaking_worker [--tick SECONDS] [--batch-size N] [--once] [--batch | --incremental] [--seed] [--time-budget SECONDS] [--shard GAME_ID:REGION:PLAYLIST ...]
+	In batch mode the whole queue is grouped into new sessions each tick, rather than each player taking their best session in turn.
+	In incremental mode, after the first tick only the players that could fit a new or changed session, or whose search has widened, are attempted.
+	With --seed, players left without a session are grouped into new sessions with the queued players most compatible with them.
+	Each shard of the queue is matched independently, so shards can be split between several workers with --shard.
+	'''
+	help = 'Matches queued players into sessions every tick.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--tick', type=float, default=settings.MATCHMAKING_TICK, help='Seconds between matchmaking runs.')
+		parser.add_argument('--batch-size', type=int, default=settings.MATCHMAKING_BATCH_SIZE, help='Queue entries loaded at a time.')
+		parser.add_argument('--once', action='store_true', help='Run a single tick and exit.')
+		parser.add_argument('--batch', action='store_true', help='Group the queue into new sessions before matching into existing ones.')
+		parser.add_argument('--time-budget', type=float, default=settings.MATCHMAKING_BATCH_TIME_BUDGET, help='Seconds each bucket (or seeded group) may spend improving its sessions.')
+		parser.add_argument('--incremental', action='store_true', help='After the first tick, only attempt players that could have a new match.')
+		parser.add_argument('--seed', action='store_true', help='Seed new sessions for players that can\'t join an existing one.')
+		parser.add_argument('--shard', type=parse_shard, action='append', dest='shards', help='Only process this shard, given as GAME_ID:REGION:casual|competitive. Can be repeated. Defaults to every shard.')
+
+	def handle(self, *args, **options):
+		if options['shards']:
+			game_ids = set(shard.game_id for shard in options['shards'])
+			missing = game_ids - set(game.id for game in game_registry.get_games())
+			if missing:
+				raise CommandError('There is no game with id %s.' % ', '.join(str(game_id) for game_id in sorted(missing)))
+		if options['batch'] and (options['incremental'] or options['seed']):
+			raise CommandError('--batch can\'t be used with --incremental or --seed.')
+
+		seed_time_budget = options['time_budget'] if options['seed'] else None
+		matcher = IncrementalMatcher(options['batch_size'], options['shards'], seed_time_budget)
+
+		# Start from the sessions in the database. After this, the index follows changes made by this process,
+		# and is rebuilt every SESSION_INDEX_MAX_AGE seconds for those made by others.
+		session_index.rebuild()
+
+		while True:
+			# Drop database connections that have timed out, as is done between web requests.
+			close_old_connections()
+
+			started = time.monotonic()
+			if options['batch']:
+				reports, attempted, matched = run_batch_matchmaking_tick(options['batch_size'], options['time_budget'], options['shards'])
+				for report in reports:
+					self.stdout.write('Bucket %s: %s players into %s sessions (%s placed), viability %.3f (greedy %.3f, %s moves) in %.3fs' % (
+						report.bucket, report.players, report.teams, report.placed, report.viability, report.greedy_viability, report.moves, report.elapsed))
+			else:
+				if options['incremental']:
+					reports = matcher.tick()
+				else:
+					reports = run_shard_ticks(options['batch_size'], options['shards'], seed_time_budget)
+				for report in reports:
+					self.stdout.write('Shard %s: matched %s of %s (%s into seeded sessions) in %.3fs' % (report.shard, report.matched, report.attempted, report.seeded, report.elapsed))
+				attempted = sum(report.attempted for report in reports)
+				matched = sum(report.matched for report in reports)
+			elapsed = time.monotonic() - started
+			self.stdout.write('Matched %s of %s queued players in %.3fs' % (matched, attempted, elapsed))
+
+			if options['once']:
+				break
+
+			# Wait out the rest of the tick.
+			time.sleep(max(0, options['tick'] - elapsed))
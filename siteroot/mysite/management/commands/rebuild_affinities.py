@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from mysite.affinity import rebuild_affinities
+
+
+class Command(BaseCommand):
+	'''
+	Recalculates the affinity table from existing session ratings.
+	Run once after the table is created, or if it is suspected to have drifted.
+	Usage: python manage.py rebuild_affinities
+	'''
+	help = 'Recalculates player affinities from session ratings.'
+
+	def handle(self, *args, **options):
+		count = rebuild_affinities()
+		self.stdout.write('Stored %s affinities' % count)
@@ -0,0 +1,23 @@
+from apps.api.models import Session
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from mysite.session_aggregates import rebuild_session_aggregates
+
+
+class Command(BaseCommand):
+	'''
+	Recalculates the commend aggregates of sessions from their players.
+	Run once after the aggregates are added, or if they are suspected to have drifted.
+	Usage: python manage.py rebuild_session_aggregates [--all]
+	'''
+	help = 'Recalculates session commend aggregates.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--all', action='store_true', help='Include sessions that have already started.')
+
+	def handle(self, *args, **options):
+		sessions = Session.objects.all()
+		if not options['all']:
+			sessions = sessions.filter(start__gte=timezone.now())
+		count = rebuild_session_aggregates(sessions)
+		self.stdout.write('Rebuilt the aggregates of %s sessions' % count)
@@ -0,0 +1,44 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from mysite import simulator
+
+
+class Command(BaseCommand):
+	'''
+	Measures matchmaking against seeded synthetic populations of each of the given sizes.
+	Writes to the configured database, so point it at a scratch one. Everything generated is removed afterwards.
+	Usage: python manage.py simulate_matchmaking [--profiles N [N ...]] [--sessions-per-profile R] [--events N] [--seed N]
+	                                             [--mode shards|batch|incremental] [--tick-events N] [--seed-sessions]
+	The queue is matched by the matchmaking worker's own ticks in the given mode, every --tick-events events.
+	'''
+	help = 'Replays queue events against synthetic populations and reports latency, queries and viability.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--profiles', type=int, nargs='+', default=[1000, 10000, 100000], help='Population sizes to simulate.')
+		parser.add_argument('--sessions-per-profile', type=float, default=0.1, help='Open sessions generated per profile.')
+		parser.add_argument('--events', type=int, default=1000, help='Queue events replayed at each size.')
+		parser.add_argument('--seed', type=int, default=0, help='Seed for the population and events.')
+		parser.add_argument('--mode', choices=simulator.MODES, default='shards', help='How the matchmaking worker matches the queue.')
+		parser.add_argument('--tick-events', type=int, default=10, help='Queue events between matchmaking ticks.')
+		parser.add_argument('--batch-size', type=int, default=settings.MATCHMAKING_BATCH_SIZE, help='Queue entries loaded at a time.')
+		parser.add_argument('--time-budget', type=float, default=settings.MATCHMAKING_BATCH_TIME_BUDGET, help='Seconds each bucket (or seeded group) may spend improving its sessions.')
+		parser.add_argument('--seed-sessions', action='store_true', help='Seed new sessions for players that can\'t join an existing one.')
+
+	def handle(self, *args, **options):
+		for profile_count in options['profiles']:
+			session_count = int(profile_count * options['sessions_per_profile'])
+			self.stdout.write('%s profiles, %s sessions, seed %s, %s mode' % (profile_count, session_count, options['seed'], options['mode']))
+
+			started = time.monotonic()
+			population = simulator.generate_population(profile_count, session_count, options['seed'])
+			try:
+				self.stdout.write('  Generated in %.1fs' % (time.monotonic() - started))
+				stats = simulator.replay_events(
+					population, options['events'], options['seed'], mode=options['mode'], tick_events=options['tick_events'],
+					batch_size=options['batch_size'], time_budget=options['time_budget'], seed_sessions=options['seed_sessions'],
+				)
+				for line in simulator.summarise(stats):
+					self.stdout.write('  ' + line)
+			finally:
+				simulator.remove_population(population)
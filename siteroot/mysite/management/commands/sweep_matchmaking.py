@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from mysite.sweeper import sweep
+
+
+class Command(BaseCommand):
+	'''
+	Deletes orphaned queue entries and dead sessions, and closes expired sessions that still have space, in bounded batches.
+	Meant to be run periodically, e.g. from cron.
+	Usage: python manage.py sweep_matchmaking [--batch-size N] [--queue-entry-age SECONDS] [--session-age SECONDS] [--dry-run]
+	'''
+	help = 'Reclaims orphaned queue entries and dead sessions.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--batch-size', type=int, default=settings.SWEEP_BATCH_SIZE, help='Rows removed per query.')
+		parser.add_argument('--queue-entry-age', type=int, default=settings.SWEEP_QUEUE_ENTRY_AGE, help='Seconds old an orphaned queue entry must be to be swept.')
+		parser.add_argument('--session-age', type=int, default=settings.SWEEP_SESSION_AGE, help='Seconds since its start before a session can be swept.')
+		parser.add_argument('--dry-run', action='store_true', help='Only count the rows that would be reclaimed.')
+
+	def handle(self, *args, **options):
+		report = sweep(options['batch_size'], options['queue_entry_age'], options['session_age'], options['dry_run'])
+		self.stdout.write('%s %s orphaned queue entries and %s dead sessions, and %s %s expired open sessions' % (
+			'Would delete' if options['dry_run'] else 'Deleted', report.queue_entries, report.dead_sessions,
+			'would close' if options['dry_run'] else 'closed', report.closed_sessions))
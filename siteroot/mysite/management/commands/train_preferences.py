@@ -0,0 +1,21 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from mysite.preferences import train_preferences
+
+
+class Command(BaseCommand):
+	'''
+	Trains every player's preference model from past session ratings, replacing the Profile_Preference table.
+	Meant to be run periodically, e.g. nightly from cron.
+	Usage: python manage.py train_preferences [--regularisation R]
+	'''
+	help = 'Trains the preference models used to recommend sessions.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--regularisation', type=float, default=settings.PREFERENCE_REGULARISATION, help='How strongly each model is pulled towards the model of everyone\'s ratings.')
+
+	def handle(self, *args, **options):
+		started = time.monotonic()
+		models, ratings = train_preferences(options['regularisation'])
+		self.stdout.write('Trained %s preference models from %s ratings in %.3fs' % (models, ratings, time.monotonic() - started))
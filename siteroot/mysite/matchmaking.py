@@ -0,0 +1,479 @@
+'''
+Queue processing for the matchmaking worker (see management/commands/matchmaking_worker.py).
+Players entering the queue get a Session_Profile with no session attached, which the worker
+picks up in batches and tries to match into an existing session.
+
+The queue is partitioned into (game, region, competitive) shards, and players are only matched with sessions
+of their own shard's game and playlist type, in their own region until their search window widens (see search_window.py),
+so each shard is processed independently and can be given its own worker process.
+A player is in the shard of every game they have an account for and every playlist type they have an
+availability for. The queue depth and match rate of each shard are reported by get_shard_metrics.
+In batch mode, each shard of the queue is first grouped into new sessions as a whole (see team_formation.py).
+In incremental mode, only the players that could have a new match are attempted each tick (see IncrementalMatcher).
+Players that can't join an existing session can seed new ones with the queued players most compatible with them (see seed_sessions).
+'''
+import collections, datetime, logging, time
+import numpy as np
+from apps.api.models import Profile_Connected_Game_Account, Availability, Session, Session_Profile, Report, Matchmaking_Shard
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Max, Q
+from django.utils import timezone
+from mysite import team_formation, weekly_slots
+from mysite.blocklist import get_blocked_profiles
+from mysite.game_registry import game_registry
+from mysite.search_window import get_search_window, get_reaching_regions
+from mysite.session_changes import get_latest_change_id, get_session_changes, prune_session_changes
+from mysite.session_index import session_index
+from mysite.teammate_search import CommendTree
+from mysite.views import get_suitable_sessions, join_session, get_commend_weights, get_game_accounts
+
+logger = logging.getLogger(__name__)
+
+# A partition of the queue, and of the sessions its players can be matched into.
+Shard = collections.namedtuple('Shard', ['game_id', 'region', 'competitive'])
+
+# What a tick achieved for one shard.
+# Players matched includes those placed in sessions seeded for players left without one (see seed_sessions).
+ShardReport = collections.namedtuple('ShardReport', ['shard', 'attempted', 'matched', 'seeded', 'elapsed'])
+
+# Most compatible queued players considered for each space in a seeded session.
+SEED_CANDIDATES_PER_SPACE = 2
+
+# What a batch tick achieved for one bucket.
+BucketReport = collections.namedtuple('BucketReport', ['bucket', 'players', 'teams', 'placed', 'greedy_viability', 'viability', 'moves', 'elapsed'])
+
+
+def get_queue(batch_size, after=0, shard=None):
+	'''
+	Gets the next batch of queue entries (session profiles without a session, whose profile is queueing), oldest first.
+	If shard is given, only entries in that shard are included.
+	'''
+	queue = Session_Profile.objects.filter(
+		session__isnull=True,
+		profile__in_queue=True,
+		id__gt=after,
+	)
+	if shard is not None:
+		queue = queue.filter(
+			profile__pref_server=shard.region,
+			profile__profile_connected_game_account__game__id=shard.game_id,
+			profile__availability__competitive=shard.competitive,
+		).distinct()
+	return list(queue.select_related('profile').order_by('id')[:batch_size])
+
+
+def get_queue_depths():
+	'''
+	Counts the queue entries in each shard.
+	Returns an ordered dictionary of Shard -> queue depth, for the shards with anyone queueing.
+	'''
+	depths = Session_Profile.objects.filter(
+		session__isnull=True,
+		profile__in_queue=True,
+		profile__profile_connected_game_account__isnull=False,
+		profile__availability__isnull=False,
+	).values_list(
+		'profile__profile_connected_game_account__game_id',
+		'profile__pref_server',
+		'profile__availability__competitive',
+	).annotate(depth=Count('id', distinct=True)).order_by()
+	return collections.OrderedDict((Shard(game_id, region, competitive), depth) for game_id, region, competitive, depth in sorted(depths))
+
+
+def match_queue_entry(session_profile, shard=None):
+	'''
+	Attempts to place a queue entry into the most viable session available, in the given shard if there is one.
+	The search widens to more regions and ranks the longer the entry has been queueing (see search_window.py).
+	Returns True if the player joined a session.
+	'''
+	window = get_search_window(session_profile.profile.pref_server, session_profile.queued_at)
+	sessions = get_suitable_sessions(session_profile.profile, shard=shard, window=window)
+	if not sessions:
+		return False
+
+	# The session and availability.
+	session = sessions[0]
+	return join_session(session_profile, session[1][0], session[1][1])
+
+
+def match_entries(shard, entries):
+	'''
+	Attempts to match each of the given queue entries into the sessions of a shard, skipping any already placed.
+	Returns the number of entries attempted and the number that were matched.
+	'''
+	attempted = 0
+	matched = 0
+	for session_profile in entries:
+		if session_profile.session_id is not None:
+			continue
+		attempted += 1
+		try:
+			if match_queue_entry(session_profile, shard):
+				matched += 1
+		except Exception:
+			logger.exception('Failed to match queue entry %s in shard %s', session_profile.id, shard)
+	return attempted, matched
+
+
+def seed_sessions(shard, entries, time_budget):
+	'''
+	Seeds new sessions for queue entries of a shard that couldn't join an existing session. Oldest first, each entry is
+	grouped (see form_bucket_sessions) with the other entries whose players are most compatible with its commend weights,
+	found with a CommendTree (see teammate_search.py).
+	time_budget is the number of seconds each group may spend improving its teams.
+	Returns the number of entries placed.
+	'''
+	entries = [entry for entry in entries if entry.session_id is None]
+	if len(entries) < 2:
+		return 0
+	max_players = game_registry.get_game(shard.game_id).max_players
+	profile_entries = dict((entry.profile_id, entry) for entry in entries)
+	tree = CommendTree.from_profiles(entry.profile for entry in entries)
+
+	placed = 0
+	for entry in entries:
+		if entry.session_id is not None:
+			continue
+		tree.remove(entry.profile_id)
+		candidates = tree.best(get_commend_weights(entry.profile), SEED_CANDIDATES_PER_SPACE * (max_players - 1), get_blocked_profiles(entry.profile))
+		if not candidates:
+			continue
+		group = [entry] + [profile_entries[profile_id] for score, profile_id in candidates]
+		try:
+			placed += form_bucket_sessions(shard, group, time_budget).placed
+		except Exception:
+			logger.exception('Failed to seed a session for queue entry %s in shard %s', entry.id, shard)
+		for member in group:
+			if member.session_id is not None:
+				tree.remove(member.profile_id)
+	return placed
+
+
+def run_shard_tick(shard, batch_size, seed_time_budget=None):
+	'''
+	Attempts to match every player in a shard of the queue into the shard's sessions, loading them batch_size at a time.
+	If seed_time_budget is given, new sessions are then seeded for the players left over (see seed_sessions).
+	Returns a ShardReport, which is also added to the shard's metrics.
+	'''
+	started = time.monotonic()
+	attempted = 0
+	matched = 0
+	leftovers = []
+	batch = get_queue(batch_size, shard=shard)
+	while batch:
+		batch_attempted, batch_matched = match_entries(shard, batch)
+		attempted += batch_attempted
+		matched += batch_matched
+		leftovers.extend(entry for entry in batch if entry.session_id is None)
+		batch = get_queue(batch_size, after=batch[-1].id, shard=shard)
+
+	seeded = seed_sessions(shard, leftovers, seed_time_budget) if seed_time_budget is not None else 0
+	report = ShardReport(shard, attempted, matched + seeded, seeded, time.monotonic() - started)
+	record_shard_metrics(report)
+	return report
+
+
+def run_shard_ticks(batch_size, shards=None, seed_time_budget=None):
+	'''
+	Runs a tick for each of the given shards, or every shard with anyone queueing.
+	Sessions are found with the session index, which is kept current by signals between ticks and rebuilt
+	every SESSION_INDEX_MAX_AGE seconds to pick up sessions changed by other processes.
+	Returns a ShardReport for each shard.
+	'''
+	if shards is None:
+		shards = list(get_queue_depths())
+	return [run_shard_tick(shard, batch_size, seed_time_budget) for shard in shards]
+
+
+def run_matchmaking_tick(batch_size, shards=None):
+	'''
+	Attempts to match every player in the given shards of the queue (or all of it), shard by shard.
+	Returns the number of queue entries attempted and the number that were matched.
+	Players in several shards are attempted in each until they are matched.
+	'''
+	reports = run_shard_ticks(batch_size, shards)
+	return sum(report.attempted for report in reports), sum(report.matched for report in reports)
+
+
+def record_shard_metrics(report):
+	'''
+	Adds a tick's results to the running totals of its shard, creating them on the shard's first tick.
+	Totals are only ever changed by update queries, so the reports of workers running the same shard at once are all kept.
+	'''
+	shard = report.shard
+	metrics = Matchmaking_Shard.objects.filter(game_id=shard.game_id, region=shard.region, competitive=shard.competitive)
+	changes = {
+		'ticks': F('ticks') + 1,
+		'attempted': F('attempted') + report.attempted,
+		'matched': F('matched') + report.matched,
+		'last_attempted': report.attempted,
+		'last_matched': report.matched,
+		'last_elapsed': report.elapsed,
+		'last_tick': timezone.now(),
+	}
+	if metrics.update(**changes):
+		return
+
+	try:
+		with transaction.atomic():
+			Matchmaking_Shard.objects.create(game_id=shard.game_id, region=shard.region, competitive=shard.competitive)
+	except IntegrityError:
+		# Another worker created the shard's totals first.
+		pass
+	metrics.update(**changes)
+
+
+def get_shard_metrics():
+	'''
+	Returns the queue depth and match rate (matched / attempted over every tick so far) of every shard that
+	has anyone queueing or has been processed, as an ordered dictionary of Shard -> Matchmaking_Shard,
+	with queue_depth and match_rate (None before anyone has been attempted) set on each.
+	'''
+	depths = get_queue_depths()
+	recorded = dict((Shard(metrics.game_id, metrics.region, metrics.competitive), metrics) for metrics in Matchmaking_Shard.objects.all())
+
+	shard_metrics = collections.OrderedDict()
+	for shard in sorted(set(depths) | set(recorded)):
+		metrics = recorded.get(shard) or Matchmaking_Shard(game_id=shard.game_id, region=shard.region, competitive=shard.competitive)
+		metrics.queue_depth = depths.get(shard, 0)
+		metrics.match_rate = metrics.matched / metrics.attempted if metrics.attempted else None
+		shard_metrics[shard] = metrics
+	return shard_metrics
+
+
+def get_entry_shards(entries):
+	'''
+	Returns a dictionary of queue entry id -> the shards the entry is in, in order.
+	'''
+	profile_ids = set(entry.profile_id for entry in entries)
+	games = collections.defaultdict(set)
+	for profile_id, game_id in Profile_Connected_Game_Account.objects.filter(profile__id__in=profile_ids).values_list('profile_id', 'game_id'):
+		games[profile_id].add(game_id)
+	playlists = collections.defaultdict(set)
+	for profile_id, competitive in Availability.objects.filter(profile__id__in=profile_ids).values_list('profile_id', 'competitive'):
+		playlists[profile_id].add(competitive)
+
+	return dict((entry.id, [
+		Shard(game_id, entry.profile.pref_server, competitive)
+		for game_id in sorted(games[entry.profile_id])
+		for competitive in sorted(playlists[entry.profile_id])
+	]) for entry in entries)
+
+
+def get_queue_buckets(shards=None):
+	'''
+	Splits the queue into its shards, or only the given shards.
+	Returns a dictionary of Shard -> queue entries, oldest first.
+	'''
+	queue = list(Session_Profile.objects.filter(session__isnull=True, profile__in_queue=True).select_related('profile').order_by('id'))
+	entry_shards = get_entry_shards(queue)
+
+	buckets = collections.OrderedDict()
+	for entry in queue:
+		for shard in entry_shards[entry.id]:
+			if shards is None or shard in shards:
+				buckets.setdefault(shard, []).append(entry)
+	return buckets
+
+
+def get_session_start(slot, now):
+	'''
+	Returns the next datetime falling in the given weekly slot.
+	'''
+	day, slot_of_day = divmod(slot, weekly_slots.SLOTS_PER_DAY)
+	start = now.replace(hour=0, minute=0, second=0, microsecond=0) + datetime.timedelta(days=(day - now.weekday()) % 7, minutes=slot_of_day * weekly_slots.SLOT_MINUTES)
+	if start < now:
+		start += datetime.timedelta(days=7)
+	return start
+
+
+def form_bucket_sessions(bucket, entries, time_budget):
+	'''
+	Groups the queue entries of a bucket into new sessions, maximising the total viability of the sessions formed.
+	Returns a BucketReport.
+	'''
+	started = time.monotonic()
+	game_id, region, competitive = bucket
+	game = game_registry.get_game(game_id)
+	profiles = [entry.profile for entry in entries]
+	profile_ids = [profile.id for profile in profiles]
+
+	# Each player's availability for this playlist type.
+	availabilities = collections.defaultdict(list)
+	for avail in Availability.objects.filter(profile__id__in=profile_ids, competitive=competitive):
+		availabilities[avail.profile_id].append(avail)
+	masks = [weekly_slots.get_availability_mask(availabilities[profile_id]) for profile_id in profile_ids]
+
+	# How viable each player is to each other player (see calc_match_viablity).
+	weights = np.array([get_commend_weights(profile) for profile in profiles])
+	commends = np.array([[p.teamwork_commends, p.communication_commends, p.skill_commends, p.sportsmanship_commends] for p in profiles], dtype=float)
+	num_sess = np.array([profile.received_ratings for profile in profiles], dtype=float)
+	rated = num_sess > 0
+	ratios = np.zeros(commends.shape)
+	ratios[rated] = commends[rated] / num_sess[rated, None]
+	scores = weights.dot(ratios.T)
+	scores[:, ~rated] = 0.5
+
+	# Players can only play together if their ranks are within the search window of either of them, and neither has reported the other.
+	accounts = get_game_accounts(profile_ids, [game_id])
+	ranks = np.array([getattr(accounts.get((game_id, profile_id)), 'comp_rank' if competitive else 'cas_rank', None) or 0 for profile_id in profile_ids])
+	now = timezone.now()
+	mmr_ranges = np.array([get_search_window(region, entry.queued_at, now).mmr_range for entry in entries])
+	compatible = np.abs(ranks[:, None] - ranks[None, :]) <= np.maximum(mmr_ranges[:, None], mmr_ranges[None, :])
+	positions = dict((profile_id, i) for i, profile_id in enumerate(profile_ids))
+	for sent_by, user_reported in Report.objects.filter(sent_by__in=profile_ids, user_reported__in=profile_ids).values_list('sent_by_id', 'user_reported_id'):
+		compatible[positions[sent_by], positions[user_reported]] = False
+		compatible[positions[user_reported], positions[sent_by]] = False
+
+	remaining_budget = max(0, time_budget - (time.monotonic() - started))
+	formation = team_formation.form_teams(scores, compatible, masks, game.max_players, remaining_budget)
+
+	# Create a session for each team, at the next time they are all available.
+	now = timezone.now()
+	after = now.weekday() * weekly_slots.SLOTS_PER_DAY + (now.hour * 60 + now.minute) // weekly_slots.SLOT_MINUTES + 1
+	placed = 0
+	for team in formation.teams:
+		mask = masks[team[0]]
+		for player in team[1:]:
+			mask &= masks[player]
+		start_slot, end_slot = team_formation.get_session_window(mask, after % weekly_slots.SLOTS_PER_WEEK)
+		start = get_session_start(start_slot, now)
+		end_time = (start + datetime.timedelta(minutes=(end_slot - start_slot) * weekly_slots.SLOT_MINUTES)).time()
+		if end_slot % weekly_slots.SLOTS_PER_DAY == 0:
+			end_time = datetime.time(23, 59)
+
+		# The session is only kept if someone joins it.
+		with transaction.atomic():
+			session = Session.objects.create(game=game, start=start, end_time=end_time, competitive=competitive, region=region)
+			team_placed = 0
+			for player in team:
+				# The availability of this player that the session starts in, unless it has changed since the bucket was loaded.
+				avail = next((a for a in availabilities[profile_ids[player]] if a.pref_day == weekly_slots.DAYS[start.weekday()] and a.start_time <= start.time() < a.end_time), None)
+				if avail is not None and join_session(entries[player], session, avail):
+					team_placed += 1
+			if not team_placed:
+				transaction.set_rollback(True)
+		if not team_placed:
+			session_index.remove(session.id)
+		placed += team_placed
+
+	return BucketReport(bucket, len(entries), len(formation.teams), placed, formation.greedy_score, formation.score, formation.moves, time.monotonic() - started)
+
+
+def run_batch_matchmaking_tick(batch_size, time_budget, shards=None):
+	'''
+	Groups each shard of the queue (or only the given shards) into new sessions, then tries to match anyone left over into existing sessions.
+	time_budget is the number of seconds each shard may spend improving its teams.
+	Returns a BucketReport for each shard, then the number of leftover queue entries attempted and matched.
+	'''
+	reports = []
+	placed_profiles = set()
+	for bucket, entries in get_queue_buckets(shards).items():
+		# Players can be in several buckets, but only join one session.
+		entries = [entry for entry in entries if entry.profile_id not in placed_profiles]
+		if len(entries) < 2:
+			continue
+		try:
+			reports.append(form_bucket_sessions(bucket, entries, time_budget))
+		except Exception:
+			logger.exception('Failed to form sessions for bucket %s', bucket)
+			continue
+		placed_profiles.update(entry.profile_id for entry in entries if entry.session_id is not None)
+
+	attempted, matched = run_matchmaking_tick(batch_size, shards)
+	return reports, attempted, matched
+
+
+class IncrementalMatcher:
+	'''
+	Matches the queue tick by tick, but after the first tick, which matches the whole queue, only attempts the entries that
+	could have a new match: entries that have joined the queue, entries whose search window has widened, and entries
+	whose shard, search window and availability touch a session in the feed of changed sessions (see session_changes.py).
+	Entries are only attempted in the shards that could have changed for them.
+	'''
+	def __init__(self, batch_size, shards=None, seed_time_budget=None):
+		self.batch_size = batch_size
+		self.shards = shards
+		self.seed_time_budget = seed_time_budget
+		# Latest change and queue entry handled, and when the last tick ran.
+		self.change_id = None
+		self.entry_id = None
+		self.last_tick = None
+
+	def tick(self):
+		'''
+		Runs a tick.
+		Returns a ShardReport for each shard attempted.
+		'''
+		now = timezone.now()
+		change_id = get_latest_change_id()
+		entry_id = Session_Profile.objects.aggregate(latest=Max('id'))['latest'] or 0
+		if self.change_id is None:
+			reports = run_shard_ticks(self.batch_size, self.shards, self.seed_time_budget)
+			self.change_id, self.entry_id, self.last_tick = change_id, entry_id, now
+			return reports
+
+		# Shard -> {entry id: entry} to attempt.
+		attempts = collections.defaultdict(dict)
+
+		# Entries that are new, or have waited long enough for a wider search window since the last tick, in every shard.
+		waits = set(step[0] for step in settings.MATCHMAKING_SEARCH_SCHEDULE if step[0] > 0)
+		widened = Q(id__gt=self.entry_id, id__lte=entry_id)
+		for seconds in waits:
+			widened |= Q(queued_at__gt=self.last_tick - datetime.timedelta(seconds=seconds), queued_at__lte=now - datetime.timedelta(seconds=seconds))
+		entries = list(Session_Profile.objects.filter(widened, session__isnull=True, profile__in_queue=True).select_related('profile'))
+		entry_shards = get_entry_shards(entries)
+		for entry in entries:
+			for shard in entry_shards[entry.id]:
+				attempts[shard][entry.id] = entry
+
+		# Entries that could fit a changed session, in the shards of those sessions.
+		sessions, self.change_id = get_session_changes(self.change_id)
+		for shard, entries in self.get_affected_entries(sessions, now).items():
+			attempts[shard].update(entries)
+
+		reports = []
+		for shard in sorted(attempts):
+			if self.shards is not None and shard not in self.shards:
+				continue
+			started = time.monotonic()
+			entries = [attempts[shard][entry_id] for entry_id in sorted(attempts[shard])]
+			attempted, matched = match_entries(shard, entries)
+			seeded = seed_sessions(shard, entries, self.seed_time_budget) if self.seed_time_budget is not None else 0
+			report = ShardReport(shard, attempted, matched + seeded, seeded, time.monotonic() - started)
+			record_shard_metrics(report)
+			reports.append(report)
+
+		prune_session_changes()
+		self.entry_id, self.last_tick = entry_id, now
+		return reports
+
+	def get_affected_entries(self, sessions, now):
+		'''
+		Finds the queue entries whose shard, search window and availability touch each of the given sessions.
+		Returns a dictionary of Shard -> {entry id: entry}.
+		'''
+		affected = collections.defaultdict(dict)
+		for session in sessions:
+			# Other processes changed the session, so bring it up to date in the index.
+			session_index.remove(session.id)
+			session_index.update(session)
+
+			queue = Session_Profile.objects.filter(
+				session__isnull=True,
+				profile__in_queue=True,
+				profile__profile_connected_game_account__game__id=session.game_id,
+				profile__availability__competitive=session.competitive,
+			)
+			if session.region:
+				queue = queue.filter(profile__pref_server__in=get_reaching_regions(session.region))
+
+			session_mask = weekly_slots.get_session_mask(session)
+			for entry in queue.distinct().select_related('profile'):
+				if session.region and session.region not in get_search_window(entry.profile.pref_server, entry.queued_at, now).regions:
+					continue
+				if not weekly_slots.from_bytes(entry.profile.availability_mask) & session_mask:
+					continue
+				affected[Shard(session.game_id, entry.profile.pref_server, session.competitive)][entry.id] = entry
+		return affected
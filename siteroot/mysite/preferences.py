@@ -0,0 +1,145 @@
+'''
+Offline model of the sessions each player enjoys, used alongside Profile_Affinity to recommend sessions.
+train_preferences (run by the train_preferences command) fits a Profile_Preference for every player who has rated
+a session: a linear model from the average commend ratios of the other players in a session to the player's rating
+of it, centred on a neutral rating of 3 and scaled to between -1 and 1.
+Each player's model is a ridge regression pulled towards a model fitted on everyone's ratings, so that players with
+few ratings get sensible predictions. Commend ratios are taken from the players' current commends.
+
+At match time a prediction only needs the player's cached Profile_Preference and the session's commend aggregates
+(see session_aggregates.py), so recommending sessions doesn't need any other queries.
+Models are cached against the profile's preference_version, which training increments in the database for every
+profile whose model it replaces or removes, so every process stops using old models as soon as it loads the profile again.
+'''
+import collections
+import numpy as np
+from apps.api.models import Profile, Profile_Preference, Session_Profile
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from mysite.session_aggregates import COMMEND_FIELDS, UNRATED_VIABILITY, get_mean_ratios
+
+# Fields of Profile_Preference holding the weight of each commend ratio, in the order of COMMEND_FIELDS.
+WEIGHT_FIELDS = ('teamwork_weight', 'communication_weight', 'skill_weight', 'sportsmanship_weight')
+
+# Neutral rating, and the distance from it to the best and worst ratings.
+NEUTRAL_RATING = 3
+RATING_SPREAD = 2
+
+
+def get_preference_key(profile):
+	'''
+	Returns the cache key of a profile's preference model.
+	'''
+	return 'preference:%s:%s' % (profile.id, profile.preference_version)
+
+
+def get_preference(profile):
+	'''
+	Returns a profile's preference model as (weights, bias), or None if they haven't got one.
+	'''
+	key = get_preference_key(profile)
+	preference = cache.get(key)
+	if preference is None:
+		stored = Profile_Preference.objects.filter(profile__id=profile.id).values_list(*(WEIGHT_FIELDS + ('bias',))).first()
+		# Profiles without a model are cached too, as an empty tuple.
+		preference = (stored[:-1], stored[-1]) if stored is not None else ()
+		cache.set(key, preference, settings.PREFERENCE_CACHE_TIMEOUT)
+	return preference or None
+
+
+def predict_rating(preference, session, excluded_profile=None):
+	'''
+	Returns the rating (between -1 and 1) that a preference model predicts for a session, or 0 if it has no other players.
+	excluded_profile is a player in the session to leave out, usually the user viewing it.
+	'''
+	mean_ratios = get_mean_ratios(session, excluded_profile)
+	if preference is None or mean_ratios is None:
+		return 0.0
+	weights, bias = preference
+	return float(np.clip(np.dot(weights, mean_ratios) + bias, -1.0, 1.0))
+
+
+def get_training_samples():
+	'''
+	Returns the profile id, the other players' average commend ratios and the centred rating of every rated session.
+	Only the first rating a profile gave a session is counted.
+	'''
+	ratings = collections.OrderedDict()
+	for profile_id, session_id, rating in Session_Profile.objects.exclude(rating=None).exclude(session=None).order_by('id').values_list('profile_id', 'session_id', 'rating'):
+		ratings.setdefault((profile_id, session_id), rating)
+
+	rosters = collections.defaultdict(list)
+	session_ids = set(session_id for profile_id, session_id in ratings)
+	for session_id, profile_id in Session_Profile.objects.filter(session__id__in=session_ids).values_list('session_id', 'profile_id'):
+		rosters[session_id].append(profile_id)
+
+	# Every player's commend ratios, as used by session_aggregates.
+	vectors = {}
+	roster_profiles = set(profile_id for roster in rosters.values() for profile_id in roster)
+	for values in Profile.objects.filter(id__in=roster_profiles).values_list('id', 'received_ratings', *COMMEND_FIELDS):
+		received_ratings = int(values[1])
+		if received_ratings > 0:
+			vectors[values[0]] = np.array(values[2:], dtype=float) / received_ratings
+		else:
+			vectors[values[0]] = np.full(len(COMMEND_FIELDS), UNRATED_VIABILITY)
+
+	profile_ids = []
+	features = []
+	targets = []
+	for (profile_id, session_id), rating in ratings.items():
+		others = [vectors[other] for other in rosters[session_id] if other != profile_id]
+		if not others:
+			continue
+		profile_ids.append(profile_id)
+		features.append(np.mean(others, axis=0))
+		targets.append((int(rating) - NEUTRAL_RATING) / RATING_SPREAD)
+	return profile_ids, np.array(features).reshape(-1, len(COMMEND_FIELDS)), np.array(targets)
+
+
+def fit_ridge(features, targets, regularisation, prior):
+	'''
+	Returns the weights and bias closest to fitting the targets, pulled towards prior (weights then bias) by regularisation.
+	'''
+	design = np.hstack([features, np.ones((len(features), 1))])
+	gram = design.T.dot(design) + regularisation * np.eye(design.shape[1])
+	solution = np.linalg.solve(gram, design.T.dot(targets) + regularisation * prior)
+	return solution[:-1], solution[-1]
+
+
+def train_preferences(regularisation=None):
+	'''
+	Trains a preference model for every player who has rated a session with other players, replacing the table.
+	Returns the number of models stored and the number of ratings they were trained on.
+	'''
+	if regularisation is None:
+		regularisation = settings.PREFERENCE_REGULARISATION
+	profile_ids, features, targets = get_training_samples()
+
+	# The model of everyone's ratings, pulled towards predicting a neutral rating.
+	preferences = []
+	if len(targets):
+		global_weights, global_bias = fit_ridge(features, targets, regularisation, np.zeros(len(COMMEND_FIELDS) + 1))
+		prior = np.append(global_weights, global_bias)
+
+		samples = collections.defaultdict(list)
+		for i, profile_id in enumerate(profile_ids):
+			samples[profile_id].append(i)
+		now = timezone.now()
+		for profile_id, indices in samples.items():
+			weights, bias = fit_ridge(features[indices], targets[indices], regularisation, prior)
+			preference = Profile_Preference(profile_id=profile_id, bias=float(bias), samples=len(indices), trained_at=now)
+			for field, weight in zip(WEIGHT_FIELDS, weights):
+				setattr(preference, field, float(weight))
+			preferences.append(preference)
+
+	with transaction.atomic():
+		# Everyone whose model is replaced or removed.
+		changed = set(Profile_Preference.objects.values_list('profile_id', flat=True))
+		changed.update(preference.profile_id for preference in preferences)
+		Profile_Preference.objects.all().delete()
+		Profile_Preference.objects.bulk_create(preferences, batch_size=1000)
+		Profile.objects.filter(pk__in=changed).update(preference_version=F('preference_version') + 1)
+	return len(preferences), len(targets)
@@ -0,0 +1,52 @@
+'''
+Search windows that widen the longer a player waits in the queue, so players in small regions or at unusual ranks
+are eventually matched rather than re-queueing forever.
+The steps are set by MATCHMAKING_SEARCH_SCHEDULE, and the neighbouring regions of each region are tried in the
+order of REGION_NEIGHBOURS.
+'''
+import collections
+from apps.api.models import Profile
+from django.conf import settings
+from django.utils import timezone
+
+# The other regions of each region, nearest first.
+REGION_NEIGHBOURS = {
+	Profile.USWEST: (Profile.USEAST, Profile.OCEANIA, Profile.ASIA, Profile.SOUTHAMERICA, Profile.EUROPE, Profile.MIDDLEEAST, Profile.SOUTHAFRICA),
+	Profile.USEAST: (Profile.USWEST, Profile.EUROPE, Profile.SOUTHAMERICA, Profile.MIDDLEEAST, Profile.SOUTHAFRICA, Profile.ASIA, Profile.OCEANIA),
+	Profile.EUROPE: (Profile.MIDDLEEAST, Profile.USEAST, Profile.SOUTHAFRICA, Profile.ASIA, Profile.USWEST, Profile.SOUTHAMERICA, Profile.OCEANIA),
+	Profile.OCEANIA: (Profile.ASIA, Profile.USWEST, Profile.MIDDLEEAST, Profile.USEAST, Profile.SOUTHAFRICA, Profile.EUROPE, Profile.SOUTHAMERICA),
+	Profile.ASIA: (Profile.OCEANIA, Profile.MIDDLEEAST, Profile.USWEST, Profile.EUROPE, Profile.SOUTHAFRICA, Profile.USEAST, Profile.SOUTHAMERICA),
+	Profile.SOUTHAMERICA: (Profile.USEAST, Profile.USWEST, Profile.SOUTHAFRICA, Profile.EUROPE, Profile.MIDDLEEAST, Profile.ASIA, Profile.OCEANIA),
+	Profile.SOUTHAFRICA: (Profile.MIDDLEEAST, Profile.EUROPE, Profile.SOUTHAMERICA, Profile.USEAST, Profile.ASIA, Profile.OCEANIA, Profile.USWEST),
+	Profile.MIDDLEEAST: (Profile.EUROPE, Profile.SOUTHAFRICA, Profile.ASIA, Profile.OCEANIA, Profile.USEAST, Profile.SOUTHAMERICA, Profile.USWEST),
+}
+
+# MMR range above/below the player, and the regions (their own first) that sessions can be in.
+SearchWindow = collections.namedtuple('SearchWindow', ['mmr_range', 'regions'])
+
+
+def get_search_window(region, queued_at=None, now=None):
+	'''
+	Returns the SearchWindow of a player in the given region who entered the queue at queued_at,
+	or the narrowest window if they aren't queueing.
+	'''
+	schedule = sorted(settings.MATCHMAKING_SEARCH_SCHEDULE)
+	waited = 0
+	if queued_at is not None:
+		waited = ((now or timezone.now()) - queued_at).total_seconds()
+
+	# The last step the player has waited long enough for.
+	mmr_range, neighbours = schedule[0][1:]
+	for seconds, step_mmr_range, step_neighbours in schedule:
+		if waited >= seconds:
+			mmr_range, neighbours = step_mmr_range, step_neighbours
+
+	return SearchWindow(mmr_range, (region,) + REGION_NEIGHBOURS.get(region, ())[:neighbours])
+
+
+def get_reaching_regions(region):
+	'''
+	Returns the regions whose players can be matched with sessions in the given region once their search window is at its widest.
+	'''
+	neighbours = max(step[2] for step in settings.MATCHMAKING_SEARCH_SCHEDULE)
+	return [other for other, name in Profile.PREF_SERVER_CHOICES if other == region or region in REGION_NEIGHBOURS.get(other, ())[:neighbours]]
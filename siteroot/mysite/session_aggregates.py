@@ -0,0 +1,129 @@
+'''
+Per-session commend aggregates, so a session's viability (see calc_match_viablity) doesn't need its players loaded.
+Each session stores its player count, how many of its players are unrated, and the sum over its rated
+players of each commend ratio (commends / received ratings), in the same order as get_commend_weights.
+
+Anything that adds or removes a session's players must call add_player or remove_player on the session
+before saving it, and anything that changes a player's commends or received ratings must call
+update_player_ratios afterwards. rebuild_session_aggregates recalculates sessions from scratch.
+'''
+from apps.api.models import Session, Session_Profile
+from django.db.models import F
+
+# Commend counters of a profile, in the order of get_commend_weights.
+COMMEND_FIELDS = ('teamwork_commends', 'communication_commends', 'skill_commends', 'sportsmanship_commends')
+
+# Session fields holding the sum of each commend ratio, in the same order.
+RATIO_FIELDS = ('teamwork_ratio_sum', 'communication_ratio_sum', 'skill_ratio_sum', 'sportsmanship_ratio_sum')
+
+# Viability given to unrated players and empty sessions.
+UNRATED_VIABILITY = 0.5
+
+
+def get_profile_ratios(profile):
+	'''
+	Returns the commend ratios of a profile, or None if they haven't been rated.
+	'''
+	received_ratings = int(profile.received_ratings)
+	if received_ratings <= 0:
+		return None
+	# Counters of profiles that haven't been reloaded can still hold their string defaults.
+	return tuple(int(getattr(profile, field)) / received_ratings for field in COMMEND_FIELDS)
+
+
+def add_player(session, profile, sign=1):
+	'''
+	Adds a player's commend ratios to a session's aggregates, without saving the session.
+	'''
+	session.player_count += sign
+	ratios = get_profile_ratios(profile)
+	if ratios is None:
+		session.unrated_player_count += sign
+		return
+	for field, ratio in zip(RATIO_FIELDS, ratios):
+		setattr(session, field, getattr(session, field) + sign * ratio)
+
+
+def remove_player(session, profile):
+	'''
+	Removes a player's commend ratios from a session's aggregates, without saving the session.
+	'''
+	add_player(session, profile, sign=-1)
+
+
+def update_player_ratios(profile, old_ratios):
+	'''
+	Moves every session the profile is in from its old ratios (from get_profile_ratios before the change) to its current ones.
+	'''
+	new_ratios = get_profile_ratios(profile)
+	if new_ratios == old_ratios:
+		return
+
+	changes = {}
+	if old_ratios is None:
+		changes['unrated_player_count'] = F('unrated_player_count') - 1
+	if new_ratios is None:
+		changes['unrated_player_count'] = F('unrated_player_count') + 1
+	for i, field in enumerate(RATIO_FIELDS):
+		delta = (new_ratios[i] if new_ratios is not None else 0.0) - (old_ratios[i] if old_ratios is not None else 0.0)
+		changes[field] = F(field) + delta
+	Session.objects.filter(session_profile__profile=profile).update(**changes)
+
+
+def get_remaining_aggregates(session, excluded_profile=None):
+	'''
+	Returns the player count, unrated player count and ratio sums of a session, leaving out excluded_profile if given.
+	'''
+	player_count = session.player_count
+	unrated = session.unrated_player_count
+	sums = [getattr(session, field) for field in RATIO_FIELDS]
+	if excluded_profile is not None:
+		excluded_ratios = get_profile_ratios(excluded_profile)
+		player_count -= 1
+		if excluded_ratios is None:
+			unrated -= 1
+		else:
+			sums = [total - ratio for total, ratio in zip(sums, excluded_ratios)]
+	return player_count, unrated, sums
+
+
+def get_viability(session, weights, excluded_profile=None):
+	'''
+	Returns the viability of a session for the given commend weights.
+	excluded_profile is a player in the session to leave out, usually the user viewing it.
+	'''
+	player_count, unrated, sums = get_remaining_aggregates(session, excluded_profile)
+	if player_count <= 0:
+		return UNRATED_VIABILITY
+	total = sum(weight * total for weight, total in zip(weights, sums)) + UNRATED_VIABILITY * unrated
+	return float(total / player_count)
+
+
+def get_mean_ratios(session, excluded_profile=None):
+	'''
+	Returns the average commend ratios of a session's players, counting unrated players as UNRATED_VIABILITY
+	in every commend, or None if it has no players.
+	excluded_profile is a player in the session to leave out, usually the user viewing it.
+	'''
+	player_count, unrated, sums = get_remaining_aggregates(session, excluded_profile)
+	if player_count <= 0:
+		return None
+	return [(total + UNRATED_VIABILITY * unrated) / player_count for total in sums]
+
+
+def rebuild_session_aggregates(sessions):
+	'''
+	Recalculates the aggregates of the given sessions from their players.
+	Returns the number of sessions updated.
+	'''
+	count = 0
+	for session in sessions.iterator():
+		session.player_count = 0
+		session.unrated_player_count = 0
+		for field in RATIO_FIELDS:
+			setattr(session, field, 0.0)
+		for session_profile in Session_Profile.objects.filter(session=session).select_related('profile'):
+			add_player(session, session_profile.profile)
+		session.save(update_fields=('player_count', 'unrated_player_count') + RATIO_FIELDS)
+		count += 1
+	return count
@@ -0,0 +1,62 @@
+'''
+Feed of the sessions that may have made space for queued players: sessions that have been created, and sessions
+that a player has left. Changes are recorded by the signals at the bottom of this file, whichever process makes them,
+and read by the matchmaking worker in incremental mode, so that only the queued players who could fit one of the
+changed sessions are rematched (see matchmaking.IncrementalMatcher).
+Changes are kept for SESSION_CHANGE_RETENTION seconds, and each reader keeps its own position in the feed.
+'''
+import datetime
+from apps.api.models import Session, Session_Profile, Session_Change
+from django.conf import settings
+from django.db.models import Max
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+
+def get_latest_change_id():
+	'''
+	Returns the id of the latest change in the feed, or 0 if it is empty.
+	'''
+	return Session_Change.objects.aggregate(latest=Max('id'))['latest'] or 0
+
+
+def get_session_changes(after):
+	'''
+	Gets the changes after the given change id.
+	Returns the upcoming sessions with space available that changed, and the id of the last change read.
+	'''
+	changes = list(Session_Change.objects.filter(id__gt=after).order_by('id').values_list('id', 'session_id'))
+	if not changes:
+		return [], after
+	sessions = Session.objects.filter(
+		pk__in=set(session_id for change_id, session_id in changes),
+		start__gte=timezone.now(),
+		space_available=True,
+	).order_by('id')
+	return list(sessions), changes[-1][0]
+
+
+def prune_session_changes():
+	'''
+	Deletes changes older than SESSION_CHANGE_RETENTION.
+	'''
+	Session_Change.objects.filter(datetime_created__lt=timezone.now() - datetime.timedelta(seconds=settings.SESSION_CHANGE_RETENTION)).delete()
+
+
+@receiver(post_save, sender=Session)
+def record_created_session(sender, instance=None, created=False, **kwargs):
+	'''
+	Records new sessions in the feed.
+	'''
+	if created:
+		Session_Change.objects.create(session=instance)
+
+
+@receiver(post_delete, sender=Session_Profile)
+def record_left_session(sender, instance=None, **kwargs):
+	'''
+	Records players leaving sessions in the feed.
+	'''
+	if instance.session_id is not None:
+		Session_Change.objects.create(session_id=instance.session_id)
@@ -0,0 +1,81 @@
+'''
+Snapshots of finished sessions, so each player's history shows a session as it was when it ended
+rather than being recalculated from commends that keep changing.
+finalise_sessions (run by the finalise_sessions command) takes a Session_History for every player of every session
+that has ended without one, holding the session's viability for them and the players shown on the dashboard.
+A session ends at its end time on the day it starts, or at the end of that day if its end time is earlier than its start.
+'''
+import datetime, json
+from apps.api.models import Session_History, Session_Profile
+from django.db import transaction
+from django.utils import timezone
+from mysite import dashboard_cache, session_aggregates
+from mysite.views import get_commend_weights, get_game_accounts, get_roster_players
+
+
+def get_session_end(session):
+	'''
+	Returns the datetime that a session ends.
+	'''
+	start = timezone.localtime(session.start) if timezone.is_aware(session.start) else session.start
+	end = start.replace(hour=session.end_time.hour, minute=session.end_time.minute, second=session.end_time.second, microsecond=0)
+	if end <= start:
+		end = start.replace(hour=0, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1)
+	return end
+
+
+def finalise_session_profiles(session_profiles, now):
+	'''
+	Takes the snapshots of the given session profiles (with their sessions and profiles), whose sessions have ended.
+	Returns the number of snapshots taken.
+	'''
+	if not session_profiles:
+		return 0
+
+	# Everyone in the sessions, and their accounts for each session's game.
+	sessions = dict((ses_p.session_id, ses_p.session) for ses_p in session_profiles)
+	rosters = dict((session_id, []) for session_id in sessions)
+	for ses_p in Session_Profile.objects.filter(session__id__in=sessions.keys()).select_related('profile').order_by('id'):
+		rosters[ses_p.session_id].append(ses_p)
+	game_accounts = get_game_accounts(
+		set(ses_p.profile_id for roster in rosters.values() for ses_p in roster),
+		set(session.game_id for session in sessions.values()),
+	)
+	players = dict((session_id, json.dumps(get_roster_players(sessions[session_id], roster, game_accounts))) for session_id, roster in rosters.items())
+
+	histories = []
+	for ses_p in session_profiles:
+		session = ses_p.session
+		histories.append(Session_History(
+			session_profile=ses_p,
+			viability=session_aggregates.get_viability(session, get_commend_weights(ses_p.profile), ses_p.profile),
+			roster=players[session.id],
+			finalised_at=now,
+		))
+	with transaction.atomic():
+		Session_History.objects.bulk_create(histories)
+
+	# The players' dashboards now show the snapshots.
+	dashboard_cache.invalidate_dashboards([ses_p.profile_id for ses_p in session_profiles])
+	return len(histories)
+
+
+def finalise_sessions(batch_size, now=None):
+	'''
+	Takes the snapshots of every player of every session that has ended, batch_size session profiles at a time.
+	Returns the number of snapshots taken.
+	'''
+	now = now or timezone.now()
+	count = 0
+	after = 0
+	while True:
+		pending = list(Session_Profile.objects.filter(
+			id__gt=after,
+			session__start__lt=now,
+			session__end_time__isnull=False,
+			history__isnull=True,
+		).select_related('session', 'profile').order_by('id')[:batch_size])
+		if not pending:
+			return count
+		after = pending[-1].id
+		count += finalise_session_profiles([ses_p for ses_p in pending if get_session_end(ses_p.session) <= now], now)
@@ -0,0 +1,359 @@
+'''
+Process-local index of the upcoming sessions that still have space available.
+Used by the matchmaking algorithm to find candidate sessions for an availability
+without running a query per availability.
+
+Sessions are bucketed by (game, competitive, week day, region), and each bucket is kept sorted
+on the time of day at which the session has been running for an hour, so the sessions that fit
+inside an availability are found with a single bisect.
+Sessions are also bucketed by (game, competitive) and sorted on the lowest rank of their players,
+so sessions whose players are outside a rank range are pruned with a bisect before any rosters are loaded.
+The index is built from the database on first use, kept current by the signals at the bottom of
+this file, and rebuilt every SESSION_INDEX_MAX_AGE seconds to pick up changes made by other processes.
+'''
+import bisect, datetime, sys, threading, time
+from apps.api.models import Profile, Session, Session_Profile, Profile_Connected_Game_Account
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+
+def get_week_day(start):
+	'''
+	Returns the day of the week for a datetime, numbered the same as the database week_day lookup (1 = Sunday, 7 = Saturday).
+	'''
+	if timezone.is_aware(start):
+		start = timezone.localtime(start)
+	return start.isoweekday() % 7 + 1
+
+
+def get_hour_mark(start):
+	'''
+	Returns the time of day at which a session starting at the given datetime has been running for an hour.
+	'''
+	if timezone.is_naive(start):
+		start = timezone.make_aware(start)
+	return (start.astimezone(timezone.utc) + datetime.timedelta(hours=1)).time()
+
+
+class SessionIndex:
+	'''
+	Open sessions bucketed by (game id, competitive, week day, region), along with the profiles attached to each session.
+	'''
+	def __init__(self, max_age=None):
+		self.lock = threading.RLock()
+		self.max_age = max_age
+		self.clear()
+
+	def clear(self):
+		'''
+		Empties the index, causing it to be rebuilt on next use.
+		'''
+		with self.lock:
+			# Bucket key -> sorted list of (hour mark, session id).
+			self.buckets = {}
+			# Session id -> (bucket key, sort key, start).
+			self.entries = {}
+			# Session id -> {Session_Profile id: profile id} for the players in the session.
+			self.rosters = {}
+			# Session_Profile id -> session id, used to detach profiles when they leave.
+			self.members = {}
+			# Session id -> {Session_Profile id: rank of the player for the session's game and playlist, or None without one}.
+			self.ranks = {}
+			# (game id, competitive) -> sorted list of (lowest rank, session id) of sessions where every player has a rank.
+			self.rank_buckets = {}
+			# (game id, competitive) -> ids of sessions without players, which fit any rank.
+			self.empty_sessions = {}
+			# Session id -> (rank bucket key, sort key, highest rank), with no sort key for sessions without players.
+			self.rank_entries = {}
+			self.built_at = None
+
+	def rebuild(self):
+		'''
+		Loads every open session and its roster from the database.
+		'''
+		with self.lock:
+			self.clear()
+			sessions = Session.objects.filter(
+				start__gte=timezone.now(),
+				space_available=True,
+			).exclude(start__isnull=True)
+			for session in sessions:
+				self._insert(session)
+
+			# Attach the players of every indexed session, along with their ranks.
+			members = list(Session_Profile.objects.filter(session__in=sessions).values_list('id', 'session_id', 'profile_id'))
+			accounts = self._load_accounts(set(profile_id for session_profile_id, session_id, profile_id in members))
+			for session_profile_id, session_id, profile_id in members:
+				self._attach(session_profile_id, session_id, profile_id, accounts)
+			for session_id in self.entries:
+				self._index_ranks(session_id)
+
+			self.built_at = time.monotonic()
+
+	def ensure_built(self):
+		'''
+		Builds the index if it hasn't been built yet, or if it is older than max_age.
+		'''
+		with self.lock:
+			if self.built_at is None or (self.max_age is not None and time.monotonic() - self.built_at > self.max_age):
+				self.rebuild()
+
+	def update(self, session, created=False):
+		'''
+		Adds, moves or removes a session depending on whether it is still open.
+		'''
+		with self.lock:
+			if self.built_at is None:
+				return
+			indexed = session.id in self.entries
+			self._remove(session.id)
+			if not self._insert(session):
+				self._detach_session(session.id)
+
+			# Existing sessions that have just opened up need their players loaded.
+			elif not indexed and not created:
+				members = list(Session_Profile.objects.filter(session=session).values_list('id', 'profile_id'))
+				accounts = self._load_accounts(set(profile_id for session_profile_id, profile_id in members))
+				for session_profile_id, profile_id in members:
+					self._attach(session_profile_id, session.id, profile_id, accounts)
+			self._index_ranks(session.id)
+
+	def remove(self, session_id):
+		'''
+		Removes a session from the index.
+		'''
+		with self.lock:
+			if self.built_at is None:
+				return
+			self._remove(session_id)
+			self._detach_session(session_id)
+
+	def attach(self, session_profile):
+		'''
+		Records a profile joining (or moving between) sessions.
+		'''
+		with self.lock:
+			if self.built_at is None:
+				return
+			self.detach(session_profile.id)
+			if session_profile.session_id in self.entries:
+				accounts = self._load_accounts([session_profile.profile_id])
+				self._attach(session_profile.id, session_profile.session_id, session_profile.profile_id, accounts)
+				self._index_ranks(session_profile.session_id)
+
+	def detach(self, session_profile_id):
+		'''
+		Records a profile leaving its session.
+		'''
+		with self.lock:
+			session_id = self.members.pop(session_profile_id, None)
+			if session_id is not None:
+				self.rosters[session_id].pop(session_profile_id, None)
+				self.ranks[session_id].pop(session_profile_id, None)
+				self._index_ranks(session_id)
+
+	def update_account(self, account):
+		'''
+		Records a change to a player's rank in the sessions they are in for that game.
+		'''
+		with self.lock:
+			if self.built_at is None:
+				return
+			changed = set()
+			for session_profile_id, session_id in self.members.items():
+				if self.rosters[session_id][session_profile_id] == account.profile_id and self.entries[session_id][0][0] == account.game_id:
+					changed.add(session_id)
+			if not changed:
+				return
+
+			# Players with several accounts for a game are ranked by their first.
+			accounts = self._load_accounts([account.profile_id])
+			for session_id in changed:
+				for session_profile_id, profile_id in self.rosters[session_id].items():
+					if profile_id == account.profile_id:
+						self.ranks[session_id][session_profile_id] = self._get_rank(session_id, profile_id, accounts)
+				self._index_ranks(session_id)
+
+	def candidates(self, games, competitive, week_day, end_time, ranks=None, rank_range=None, regions=None):
+		'''
+		Returns the ids of upcoming sessions, in any of the given game ids, on the given day and playlist type,
+		that have been running for at least an hour by end_time.
+		If ranks (game id -> rank) and rank_range are given, only sessions where every player's rank
+		is within rank_range of the rank for that game are returned.
+		If regions are given, only sessions in those regions (or without one) are returned.
+		'''
+		self.ensure_built()
+		now = timezone.now()
+		if regions is None:
+			regions = [choice[0] for choice in Profile.PREF_SERVER_CHOICES]
+		regions = list(regions) + [None]
+		session_ids = []
+		with self.lock:
+			for game in games:
+				# Sessions that can't be played at this rank.
+				rank = ranks.get(game) if ranks is not None else None
+				in_range = None
+				if rank is not None and rank_range is not None:
+					in_range = self._in_rank_range(game, competitive, rank - rank_range, rank + rank_range)
+
+				for session_region in regions:
+					bucket = self.buckets.get((game, competitive, week_day, session_region))
+					if not bucket:
+						continue
+
+					# Every session before this point reaches its hour mark by the end of the availability.
+					upper = bisect.bisect_right(bucket, (end_time, sys.maxsize))
+					for hour_mark, session_id in bucket[:upper]:
+						if self.entries[session_id][2] >= now and (in_range is None or session_id in in_range):
+							session_ids.append(session_id)
+
+		return sorted(session_ids)
+
+	def roster(self, session_id):
+		'''
+		Returns the ids of the profiles attached to an indexed session.
+		'''
+		self.ensure_built()
+		with self.lock:
+			return frozenset(self.rosters.get(session_id, {}).values())
+
+	def _in_rank_range(self, game, competitive, lowest, highest):
+		# Sessions without players fit any rank.
+		session_ids = set(self.empty_sessions.get((game, competitive), ()))
+
+		# Sessions whose lowest ranked player is in range, then whose highest ranked player is too.
+		bucket = self.rank_buckets.get((game, competitive), [])
+		lower = bisect.bisect_left(bucket, (lowest, -1))
+		upper = bisect.bisect_right(bucket, (highest, sys.maxsize))
+		for sort_key in bucket[lower:upper]:
+			if self.rank_entries[sort_key[1]][2] <= highest:
+				session_ids.add(sort_key[1])
+		return session_ids
+
+	def _load_accounts(self, profile_ids):
+		# The first account of each of the profiles for each game, as (game id, profile id) -> (casual rank, competitive rank).
+		accounts = {}
+		for profile_id, game_id, cas_rank, comp_rank in Profile_Connected_Game_Account.objects.filter(profile__id__in=profile_ids).order_by('id').values_list('profile_id', 'game_id', 'cas_rank', 'comp_rank'):
+			accounts.setdefault((game_id, profile_id), (cas_rank, comp_rank))
+		return accounts
+
+	def _get_rank(self, session_id, profile_id, accounts):
+		game_id, competitive, week_day, region = self.entries[session_id][0]
+		account = accounts.get((game_id, profile_id))
+		if account is None:
+			return None
+		return account[1] if competitive else account[0]
+
+	def _index_ranks(self, session_id):
+		# Move the session to wherever its players' ranks now put it.
+		entry = self.rank_entries.pop(session_id, None)
+		if entry is not None:
+			key, sort_key, highest = entry
+			if sort_key is None:
+				self.empty_sessions[key].discard(session_id)
+			else:
+				bucket = self.rank_buckets[key]
+				del bucket[bisect.bisect_left(bucket, sort_key)]
+				if not bucket:
+					del self.rank_buckets[key]
+
+		if session_id not in self.entries:
+			return
+		key = self.entries[session_id][0][:2]
+		ranks = list(self.ranks[session_id].values())
+		if not ranks:
+			self.empty_sessions.setdefault(key, set()).add(session_id)
+			self.rank_entries[session_id] = (key, None, None)
+			return
+
+		# Players without a rank can't be matched with, so the session is left out.
+		if None in ranks:
+			return
+		sort_key = (min(ranks), session_id)
+		bisect.insort(self.rank_buckets.setdefault(key, []), sort_key)
+		self.rank_entries[session_id] = (key, sort_key, max(ranks))
+
+	def _insert(self, session):
+		if not session.space_available or session.start is None or session.game_id is None:
+			return False
+
+		start = session.start
+		if timezone.is_naive(start):
+			start = timezone.make_aware(start)
+		key = (session.game_id, session.competitive, get_week_day(start), session.region or None)
+		sort_key = (get_hour_mark(start), session.id)
+		bisect.insort(self.buckets.setdefault(key, []), sort_key)
+		self.entries[session.id] = (key, sort_key, start)
+		self.rosters.setdefault(session.id, {})
+		self.ranks.setdefault(session.id, {})
+		return True
+
+	def _remove(self, session_id):
+		entry = self.entries.pop(session_id, None)
+		if entry is None:
+			return
+		key, sort_key, start = entry
+		bucket = self.buckets[key]
+		del bucket[bisect.bisect_left(bucket, sort_key)]
+		if not bucket:
+			del self.buckets[key]
+		self._index_ranks(session_id)
+
+	def _attach(self, session_profile_id, session_id, profile_id, accounts):
+		# Only players of indexed sessions are tracked.
+		roster = self.rosters.get(session_id)
+		if roster is not None:
+			roster[session_profile_id] = profile_id
+			self.ranks[session_id][session_profile_id] = self._get_rank(session_id, profile_id, accounts)
+			self.members[session_profile_id] = session_id
+
+	def _detach_session(self, session_id):
+		for session_profile_id in self.rosters.pop(session_id, {}):
+			del self.members[session_profile_id]
+		self.ranks.pop(session_id, None)
+
+
+# The index shared by everything in this process.
+session_index = SessionIndex(max_age=getattr(settings, 'SESSION_INDEX_MAX_AGE', None))
+
+
+@receiver(post_save, sender=Session)
+def index_session(sender, instance=None, created=False, **kwargs):
+	'''
+	Keeps the index current when a session is created or changed.
+	'''
+	session_index.update(instance, created)
+
+
+@receiver(post_delete, sender=Session)
+def unindex_session(sender, instance=None, **kwargs):
+	'''
+	Removes deleted sessions from the index.
+	'''
+	session_index.remove(instance.id)
+
+
+@receiver(post_save, sender=Session_Profile)
+def index_session_profile(sender, instance=None, **kwargs):
+	'''
+	Keeps session rosters current when a profile joins a session.
+	'''
+	session_index.attach(instance)
+
+
+@receiver(post_save, sender=Profile_Connected_Game_Account)
+def index_game_account(sender, instance=None, **kwargs):
+	'''
+	Keeps session ranks current when a player's rank is updated.
+	'''
+	session_index.update_account(instance)
+
+
+@receiver(post_delete, sender=Session_Profile)
+def unindex_session_profile(sender, instance=None, **kwargs):
+	'''
+	Keeps session rosters current when a profile leaves a session.
+	'''
+	session_index.detach(instance.id)
@@ -166,6 +166,69 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media/')
 LOGIN_URL = '/login/'
 LOGIN_REDIRECT_URL = '/dashboard/'
 
+# Seconds before the in-memory session index is rebuilt from the database,
+# picking up sessions changed by other processes.
+SESSION_INDEX_MAX_AGE = 60
+
+# Seconds before the in-memory catalog of games and roles is reloaded from the database,
+# picking up games and roles changed by other processes (see mysite/game_registry.py).
+GAME_REGISTRY_MAX_AGE = 10 * 60
+
+# Seconds that the feed of changed sessions read by the incremental matchmaking worker is kept (see mysite/session_changes.py).
+SESSION_CHANGE_RETENTION = 60 * 60
+
+# Seconds between runs of the matchmaking worker, and the number of queued players it loads at a time.
+MATCHMAKING_TICK = 5
+MATCHMAKING_BATCH_SIZE = 100
+
+# Seconds the matchmaking worker may spend improving the sessions formed for each bucket in batch mode.
+MATCHMAKING_BATCH_TIME_BUDGET = 0.5
+
+# Seconds a profile's cached report blocklist is kept. Blocklists are cached against a version kept in the database,
+# so they don't go stale, this just limits how long unused blocklists stay in the cache.
+BLOCKLIST_CACHE_TIMEOUT = 300
+
+# Seconds the cached sections of a profile's dashboard are kept (see mysite/dashboard_cache.py). Sections are cached
+# against a version kept in the database, so they don't go stale, this just limits how long unused sections stay in the cache.
+DASHBOARD_CACHE_TIMEOUT = 10 * 60
+
+# Seconds a cached session viability is kept. Viabilities are cached against the session's roster version,
+# so they don't go stale, this just limits how long unused scores stay in the cache.
+VIABILITY_CACHE_TIMEOUT = 24 * 60 * 60
+
+# Times joining a session is retried when it fails on a database error, such as a deadlock with another joining player.
+JOIN_SESSION_RETRIES = 3
+
+# Sessions shown per page of the manual matchmaking list.
+MANUAL_MATCHMAKING_PAGE_SIZE = 10
+
+# Previous sessions shown per page of the dashboard's session history.
+SESSION_HISTORY_PAGE_SIZE = 10
+
+# How far matchmaking searches for a queued player, widening the longer they wait (see mysite/search_window.py).
+# Each step is (seconds waited, MMR range above/below the player, number of neighbouring regions also searched).
+MATCHMAKING_SEARCH_SCHEDULE = (
+	(0, 100, 0),
+	(60, 200, 0),
+	(3 * 60, 300, 1),
+	(10 * 60, 500, 2),
+)
+
+# Seconds a player's preference model is cached. Models are cached against a version kept in the database, which
+# retraining increments, so this only limits how long unused models stay in the cache.
+# Regularisation pulls each model towards one of everyone's ratings.
+PREFERENCE_CACHE_TIMEOUT = 60 * 60
+PREFERENCE_REGULARISATION = 1.0
+
+# Session profiles snapshotted per query by the finalise_sessions command (see mysite/session_history.py).
+SESSION_HISTORY_BATCH_SIZE = 500
+
+# Rows removed per query by the sweep_matchmaking command, how many seconds old a queue entry
+# must be before it can be swept, and how many seconds after its start a session can be swept.
+SWEEP_BATCH_SIZE = 500
+SWEEP_QUEUE_ENTRY_AGE = 10 * 60
+SWEEP_SESSION_AGE = 24 * 60 * 60
+
 # Crispy Forms.
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
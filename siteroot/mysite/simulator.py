@@ -0,0 +1,262 @@
+'''
+Matchmaking simulator, used by the simulate_matchmaking command to measure matchmaking at scale.
+Generates a seeded synthetic population of profiles, availabilities, connected accounts and open sessions,
+then replays a stream of enter/exit queue events through the real views, matching the queue with ticks of the
+matchmaking worker's own code in any of its modes, and records the latency, database queries and viability of each event.
+
+Everything generated belongs to a game named SIMULATION_GAME and is removed by remove_population,
+but the simulator still writes to the configured database, so it should be pointed at a scratch one.
+'''
+import collections, datetime, random, time
+import numpy as np
+from apps.api.models import Profile, Profile_Connected_Game_Account, Profile_Affinity, Availability, Session, Session_Profile, Game, Report
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from mysite import matchmaking, views, session_aggregates
+from mysite.matchmaking import Shard
+from mysite.session_index import session_index
+
+# Name of the game everything generated is attached to.
+SIMULATION_GAME = 'Simulation'
+
+# Most rows created per insert when generating a population.
+BULK_SIZE = 1000
+
+# Generated data, see generate_population.
+Population = collections.namedtuple('Population', ['game', 'prefix', 'user_ids', 'session_count'])
+
+# Modes the queue can be matched in, as with the matchmaking worker's --batch and --incremental.
+MODES = ('shards', 'batch', 'incremental')
+
+# Latency (seconds) and query counts of every event of one type, and the viability of each session joined.
+EventStats = collections.namedtuple('EventStats', ['latencies', 'queries', 'viabilities'])
+
+
+def bulk_create(model, objs):
+	'''
+	Inserts the objects BULK_SIZE at a time, or fewer if the database can't take that many.
+	'''
+	objs = list(objs)
+	fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+	batch_size = max(1, min(BULK_SIZE, connection.ops.bulk_batch_size(fields, objs)))
+	model.objects.bulk_create(objs, batch_size=batch_size)
+
+
+def generate_population(profile_count, session_count, seed, max_players=5):
+	'''
+	Creates profile_count profiles with connected accounts and availabilities, and session_count upcoming sessions
+	that are partly filled with those profiles. The same seed always generates the same population.
+	Returns a Population.
+	'''
+	rng = random.Random(seed)
+	game = Game.objects.create(name=SIMULATION_GAME, max_players=max_players)
+	prefix = 'sim_%s_%s_' % (game.id, seed)
+
+	bulk_create(User, (User(username='%s%s' % (prefix, i)) for i in range(profile_count)))
+	user_ids = list(User.objects.filter(username__startswith=prefix).order_by('id').values_list('id', flat=True))
+
+	# Players with a spread of commends, priorities, regions and ranks.
+	commends = [choice[0] for choice in Profile.COMMENDS_CHOICES]
+	servers = [choice[0] for choice in Profile.PREF_SERVER_CHOICES]
+	profiles = []
+	for user_id in user_ids:
+		received_ratings = rng.randint(0, 50)
+		priorities = rng.sample(commends, len(commends))
+		profiles.append(Profile(
+			user_id=user_id,
+			pref_server=rng.choice(servers),
+			received_ratings=received_ratings,
+			teamwork_commends=rng.randint(0, received_ratings),
+			communication_commends=rng.randint(0, received_ratings),
+			skill_commends=rng.randint(0, received_ratings),
+			sportsmanship_commends=rng.randint(0, received_ratings),
+			commend_priority_1=priorities[0],
+			commend_priority_2=priorities[1],
+			commend_priority_3=priorities[2],
+			commend_priority_4=priorities[3],
+		))
+	bulk_create(Profile, profiles)
+	profile_ids = list(Profile.objects.filter(user__username__startswith=prefix).order_by('id').values_list('id', flat=True))
+
+	accounts = []
+	availabilities = []
+	days = [choice[0] for choice in Availability.PREF_DAY_CHOICES]
+	for profile_id in profile_ids:
+		rank = max(0, int(rng.gauss(2500, 500)))
+		accounts.append(Profile_Connected_Game_Account(
+			profile_id=profile_id,
+			game=game,
+			game_player_tag='sim_%s' % profile_id,
+			cas_rank=rank,
+			comp_rank=rank + rng.randint(-100, 100),
+		))
+
+		# A few evenings a week, in whole hours.
+		for i in range(rng.randint(1, 3)):
+			start_hour = rng.randint(8, 20)
+			availabilities.append(Availability(
+				profile_id=profile_id,
+				pref_day=rng.choice(days),
+				start_time=datetime.time(start_hour, 0),
+				end_time=datetime.time(min(23, start_hour + rng.randint(2, 5)), 0),
+				competitive=rng.random() < 0.5,
+			))
+	bulk_create(Profile_Connected_Game_Account, accounts)
+	bulk_create(Availability, availabilities)
+
+	# Sessions over the next week, starting on the quarter hour, partly filled.
+	profiles = Profile.objects.in_bulk(profile_ids)
+	today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1)
+	sessions = []
+	rosters = []
+	for i in range(session_count):
+		start = today + datetime.timedelta(days=rng.randint(0, 6), hours=rng.randint(8, 19), minutes=15 * rng.randint(0, 3))
+		session = Session(
+			game=game,
+			start=start,
+			end_time=(start + datetime.timedelta(hours=rng.randint(2, 4))).time(),
+			competitive=rng.random() < 0.5,
+			region=rng.choice(servers),
+		)
+		roster = rng.sample(profile_ids, min(len(profile_ids), rng.randint(1, max_players - 1)))
+		for profile_id in roster:
+			session_aggregates.add_player(session, profiles[profile_id])
+		sessions.append(session)
+		rosters.append(roster)
+	bulk_create(Session, sessions)
+
+	members = []
+	session_ids = Session.objects.filter(game=game).order_by('id').values_list('id', flat=True)
+	for session_id, roster in zip(session_ids, rosters):
+		for profile_id in roster:
+			members.append(Session_Profile(session_id=session_id, profile_id=profile_id))
+	bulk_create(Session_Profile, members)
+
+	return Population(game, prefix, user_ids, session_count)
+
+
+def get_simulation_shards(population):
+	'''
+	Returns every shard of the queue that the population can be in, so that the matchmaking worker only processes them.
+	'''
+	return [
+		Shard(population.game.id, region, competitive)
+		for region in sorted(choice[0] for choice in Profile.PREF_SERVER_CHOICES)
+		for competitive in (False, True)
+	]
+
+
+def replay_events(population, event_count, seed, exit_ratio=0.2, mode='shards', tick_events=10, batch_size=None, time_budget=None, seed_sessions=False):
+	'''
+	Replays event_count queue events against the population: players entering the queue, or players leaving their
+	session or the queue. Every tick_events events, and after the last, the queue is matched by a tick of the
+	matchmaking worker in the given mode, restricted to the population's shards:
+	 - 'shards' runs each shard in turn (see matchmaking.run_shard_ticks).
+	 - 'batch' groups each shard into new sessions first (see matchmaking.run_batch_matchmaking_tick).
+	 - 'incremental' only attempts the entries that could have a new match (see matchmaking.IncrementalMatcher).
+	With seed_sessions, players left without a session seed new ones, as with the worker's --seed.
+	batch_size and time_budget default to MATCHMAKING_BATCH_SIZE and MATCHMAKING_BATCH_TIME_BUDGET.
+	Returns a dictionary of event type ('enter', 'exit' or 'tick') -> EventStats, where ticks record the viability
+	of each session joined for the player that joined it.
+	'''
+	if mode not in MODES:
+		raise ValueError('Unknown matchmaking mode %r.' % mode)
+	batch_size = batch_size or settings.MATCHMAKING_BATCH_SIZE
+	time_budget = settings.MATCHMAKING_BATCH_TIME_BUDGET if time_budget is None else time_budget
+	seed_time_budget = time_budget if seed_sessions else None
+	shards = get_simulation_shards(population)
+	matcher = matchmaking.IncrementalMatcher(batch_size, shards, seed_time_budget)
+
+	rng = random.Random(seed)
+	factory = RequestFactory()
+	stats = collections.defaultdict(lambda: EventStats([], [], []))
+	queueing = set()
+	idle = list(population.user_ids)
+
+	# Bulk inserts skip the signals that keep the session index current.
+	session_index.rebuild()
+
+	def measure(event, run):
+		connection.queries_log.clear()
+		with CaptureQueriesContext(connection) as queries:
+			started = time.perf_counter()
+			run()
+			elapsed = time.perf_counter() - started
+		stats[event].latencies.append(elapsed)
+		stats[event].queries.append(len(queries))
+
+	def tick():
+		# Queue entries waiting for a session, so the sessions they join can be scored afterwards.
+		waiting = list(Session_Profile.objects.filter(profile__user__id__in=queueing, session__isnull=True).values_list('id', flat=True))
+		if mode == 'batch':
+			measure('tick', lambda: matchmaking.run_batch_matchmaking_tick(batch_size, time_budget, shards))
+		elif mode == 'incremental':
+			measure('tick', matcher.tick)
+		else:
+			measure('tick', lambda: matchmaking.run_shard_ticks(batch_size, shards, seed_time_budget))
+		for entry in Session_Profile.objects.filter(pk__in=waiting, session__isnull=False).select_related('session', 'profile'):
+			stats['tick'].viabilities.append(views.calc_match_viablity(entry.profile, entry.session))
+
+	users = User.objects.in_bulk(population.user_ids)
+	for i in range(event_count):
+		if queueing and (not idle or rng.random() < exit_ratio):
+			event = 'exit'
+			user = users[rng.choice(sorted(queueing))]
+		else:
+			event = 'enter'
+			user = users[idle.pop(rng.randrange(len(idle)))]
+		request = factory.get('/dashboard/%s_queue/' % event)
+		request.user = user
+		# Work from a fresh profile, as a request would.
+		user.profile = Profile.objects.get(user=user)
+
+		measure(event, lambda: (views.enter_queue if event == 'enter' else views.exit_queue)(request))
+		if event == 'enter':
+			queueing.add(user.id)
+		else:
+			queueing.discard(user.id)
+			idle.append(user.id)
+
+		if (i + 1) % tick_events == 0 or i + 1 == event_count:
+			tick()
+
+	return stats
+
+
+def summarise(stats):
+	'''
+	Returns a line of percentiles and averages for each event type in the stats from replay_events.
+	'''
+	lines = []
+	for event, event_stats in sorted(stats.items()):
+		latencies = np.array(event_stats.latencies) * 1000
+		p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+		line = '%s: %s events, p50 %.2fms, p95 %.2fms, p99 %.2fms, %.1f queries/event' % (
+			event, len(latencies), p50, p95, p99, np.mean(event_stats.queries))
+		if event == 'tick':
+			matched = len(event_stats.viabilities)
+			line += ', %s matched, average viability %.3f' % (matched, np.mean(event_stats.viabilities) if matched else 0.0)
+		lines.append(line)
+	return lines
+
+
+def remove_population(population):
+	'''
+	Deletes everything generated for and during a simulation.
+	'''
+	generated_profiles = {'profile__user__username__startswith': population.prefix}
+	Report.objects.filter(session__game=population.game).delete()
+	Session_Profile.objects.filter(**generated_profiles).delete()
+	Session_Profile.objects.filter(session__game=population.game).delete()
+	Session.objects.filter(game=population.game).delete()
+	Availability.objects.filter(**generated_profiles).delete()
+	Profile_Connected_Game_Account.objects.filter(game=population.game).delete()
+	Profile_Affinity.objects.filter(**generated_profiles).delete()
+	Profile.objects.filter(user__username__startswith=population.prefix).delete()
+	User.objects.filter(username__startswith=population.prefix).delete()
+	population.game.delete()
+	session_index.clear()
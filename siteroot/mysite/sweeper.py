@@ -0,0 +1,94 @@
+'''
+Removes matchmaking rows that nothing will use again, so they don't slow down every scan of the queue and sessions.
+Used by the sweep_matchmaking command, which is meant to be run periodically.
+
+Swept rows are:
+ - Orphaned queue entries: session profiles without a session whose profile isn't queueing.
+ - Dead sessions: sessions that started long enough ago and have no players (or reports) left, which are deleted.
+ - Expired open sessions: sessions that started long enough ago but still have space available, which are closed,
+   keeping their players' history.
+Rows are handled batch_size at a time, so no single query locks much of a table.
+'''
+import collections, datetime
+from apps.api.models import Session, Session_Profile
+from django.db import transaction
+from django.utils import timezone
+
+# Rows reclaimed by a sweep.
+SweepReport = collections.namedtuple('SweepReport', ['queue_entries', 'dead_sessions', 'closed_sessions'])
+
+
+def get_orphaned_queue_entries(age):
+	'''
+	Returns queue entries at least age seconds old whose profile isn't queueing.
+	'''
+	return Session_Profile.objects.filter(
+		session__isnull=True,
+		profile__in_queue=False,
+		queued_at__lt=timezone.now() - datetime.timedelta(seconds=age),
+	)
+
+
+def get_dead_sessions(age):
+	'''
+	Returns sessions that started at least age seconds ago, with no players or reports.
+	'''
+	return Session.objects.filter(
+		start__lt=timezone.now() - datetime.timedelta(seconds=age),
+		session_profile__isnull=True,
+		report__isnull=True,
+	)
+
+
+def get_expired_open_sessions(age):
+	'''
+	Returns sessions that started at least age seconds ago, but still have space available.
+	'''
+	return Session.objects.filter(
+		start__lt=timezone.now() - datetime.timedelta(seconds=age),
+		space_available=True,
+	)
+
+
+def delete_in_batches(queryset, batch_size, dry_run=False):
+	'''
+	Deletes the rows of a queryset batch_size at a time.
+	Returns the number of rows deleted, or that would be if dry_run.
+	'''
+	if dry_run:
+		return queryset.count()
+	count = 0
+	while True:
+		with transaction.atomic():
+			ids = list(queryset.order_by('pk').values_list('pk', flat=True)[:batch_size])
+			if not ids:
+				return count
+			# Deleting each batch through the model sends the signals that keep the session index current.
+			queryset.model.objects.filter(pk__in=ids).delete()
+		count += len(ids)
+
+
+def close_in_batches(sessions, batch_size, dry_run=False):
+	'''
+	Marks sessions as having no space available, batch_size at a time.
+	Returns the number of sessions closed, or that would be if dry_run.
+	'''
+	if dry_run:
+		return sessions.count()
+	count = 0
+	while True:
+		ids = list(sessions.order_by('pk').values_list('pk', flat=True)[:batch_size])
+		if not ids:
+			return count
+		count += Session.objects.filter(pk__in=ids).update(space_available=False)
+
+
+def sweep(batch_size, queue_entry_age, session_age, dry_run=False):
+	'''
+	Sweeps orphaned queue entries and dead or expired sessions.
+	Returns a SweepReport.
+	'''
+	queue_entries = delete_in_batches(get_orphaned_queue_entries(queue_entry_age), batch_size, dry_run)
+	dead_sessions = delete_in_batches(get_dead_sessions(session_age), batch_size, dry_run)
+	closed_sessions = close_in_batches(get_expired_open_sessions(session_age), batch_size, dry_run)
+	return SweepReport(queue_entries, dead_sessions, closed_sessions)
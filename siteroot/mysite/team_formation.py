@@ -0,0 +1,168 @@
+'''
+Batch team formation for queued players.
+Groups players into teams of up to a game's max_players, maximising the total viability of the teams,
+by forming teams greedily and then improving them with local search until the time budget runs out.
+If the budget runs out while forming teams greedily, the players not yet reached are left without a team
+for the next run, though the first team is always formed so the longest waiting player is never starved.
+
+A team's viability is the sum, over its members, of calc_match_viablity for that member
+in a session holding the rest of the team.
+
+Availabilities are compared as weekly bitmasks of 15 minute slots (see weekly_slots.py).
+A team can only play together if the masks of all its members share at least an hour on the same day.
+'''
+import collections, random, time
+import numpy as np
+from mysite.weekly_slots import SLOT_MINUTES, SLOTS_PER_HOUR, SLOTS_PER_DAY, SLOTS_PER_WEEK, DAYS, get_availability_mask
+
+# The number of slots a session needs, and the slots a session that long can start in without running into the next day.
+MIN_SESSION_SLOTS = SLOTS_PER_HOUR
+SESSION_START_SLOTS = sum(
+	((1 << (SLOTS_PER_DAY - MIN_SESSION_SLOTS + 1)) - 1) << (day * SLOTS_PER_DAY) for day in range(len(DAYS))
+)
+
+# Result of form_teams. Teams are lists of player indexes, scores are the total viability of all teams.
+TeamFormation = collections.namedtuple('TeamFormation', ['teams', 'greedy_score', 'score', 'moves'])
+
+
+def get_session_starts(mask):
+	'''
+	Returns a bitmask of the slots in which an hour long session can start inside the given mask.
+	'''
+	starts = mask
+	for shift in range(1, MIN_SESSION_SLOTS):
+		starts &= mask >> shift
+	return starts & SESSION_START_SLOTS
+
+
+def get_session_window(mask, after=0):
+	'''
+	Finds the first window of at least an hour inside the mask, starting at or after the given slot (wrapping around the week).
+	Returns the (start, end) slots of the window, extended for as long as the mask allows on that day, or None.
+	'''
+	starts = get_session_starts(mask)
+	if not starts:
+		return None
+	later = starts >> after << after
+	starts = later if later else starts
+	start = (starts & -starts).bit_length() - 1
+
+	# Keep going until the mask or the day ends.
+	end = start + MIN_SESSION_SLOTS
+	day_end = (start // SLOTS_PER_DAY + 1) * SLOTS_PER_DAY
+	while end < day_end and mask >> end & 1:
+		end += 1
+	return start, end
+
+
+def get_team_score(scores, team):
+	'''
+	Total viability of a team, where scores[m, o] is how viable player o is to player m.
+	'''
+	if len(team) < 2:
+		return 0.0
+	team_scores = scores[np.ix_(team, team)]
+	return (team_scores.sum() - np.trace(team_scores)) / (len(team) - 1)
+
+
+def form_teams(scores, compatible, masks, team_size, time_budget, seed=0):
+	'''
+	Groups players into teams of between 2 and team_size players.
+	scores: players x players array, scores[m, o] is how viable player o is to player m.
+	compatible: players x players boolean array of the players allowed to play together.
+	masks: availability bitmask of each player.
+	Players are seeded into teams in the order given, so the longest waiting players should come first.
+	Returns a TeamFormation.
+	'''
+	deadline = time.monotonic() + time_budget
+	player_count = len(masks)
+	unassigned = set(range(player_count))
+	teams = []
+
+	# Greedy: grow a team around each unassigned player, adding whoever adds the most viability.
+	for seed_player in range(player_count):
+		if teams and time.monotonic() >= deadline:
+			break
+		if seed_player not in unassigned:
+			continue
+		unassigned.discard(seed_player)
+		team = [seed_player]
+		mask = masks[seed_player]
+
+		while len(team) < team_size and unassigned:
+			candidates = np.array(sorted(unassigned))
+			allowed = compatible[np.ix_(candidates, team)].all(axis=1)
+			gains = scores[np.ix_(team, candidates)].sum(axis=0) + scores[np.ix_(candidates, team)].sum(axis=1)
+
+			best = None
+			for index in np.argsort(-gains, kind='stable'):
+				if allowed[index] and get_session_starts(mask & masks[candidates[index]]):
+					best = int(candidates[index])
+					break
+			if best is None:
+				break
+			team.append(best)
+			unassigned.discard(best)
+			mask &= masks[best]
+
+		if len(team) > 1:
+			teams.append(team)
+		else:
+			unassigned.add(seed_player)
+
+	greedy_score = sum(get_team_score(scores, team) for team in teams)
+
+	def is_feasible(team):
+		mask = masks[team[0]]
+		for player in team[1:]:
+			mask &= masks[player]
+		return compatible[np.ix_(team, team)].all() and get_session_starts(mask) != 0
+
+	# Local search: swap players between teams, or bring in players left without a team, while it improves the total.
+	rng = random.Random(seed)
+	team_scores = [get_team_score(scores, team) for team in teams]
+	moves = 0
+	improved = True
+	while improved and time.monotonic() < deadline:
+		improved = False
+		order = list(range(len(teams)))
+		rng.shuffle(order)
+		for a in order:
+			if time.monotonic() >= deadline:
+				break
+
+			# Insert an unassigned player into a team with space, or replace a team member with them.
+			for player in sorted(unassigned):
+				options = []
+				if len(teams[a]) < team_size:
+					options.append((teams[a] + [player], None))
+				options.extend((teams[a][:i] + [player] + teams[a][i + 1:], teams[a][i]) for i in range(len(teams[a])))
+				for new_team, removed in options:
+					new_score = get_team_score(scores, new_team)
+					if new_score > team_scores[a] + 1e-12 and is_feasible(new_team):
+						teams[a] = new_team
+						team_scores[a] = new_score
+						unassigned.discard(player)
+						if removed is not None:
+							unassigned.add(removed)
+						moves += 1
+						improved = True
+						break
+
+			# Swap a member with a member of another team.
+			for b in order:
+				if b == a:
+					continue
+				for i in range(len(teams[a])):
+					for j in range(len(teams[b])):
+						new_a = teams[a][:i] + [teams[b][j]] + teams[a][i + 1:]
+						new_b = teams[b][:j] + [teams[a][i]] + teams[b][j + 1:]
+						score_a = get_team_score(scores, new_a)
+						score_b = get_team_score(scores, new_b)
+						if score_a + score_b > team_scores[a] + team_scores[b] + 1e-12 and is_feasible(new_a) and is_feasible(new_b):
+							teams[a], teams[b] = new_a, new_b
+							team_scores[a], team_scores[b] = score_a, score_b
+							moves += 1
+							improved = True
+
+	return TeamFormation(teams, greedy_score, sum(team_scores), moves)
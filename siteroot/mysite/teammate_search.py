@@ -0,0 +1,103 @@
+'''
+Search for the queued players most compatible with a set of commend weights, used to seed new sessions.
+Each player is a point in commend space: their four commend ratios (see session_aggregates.get_profile_ratios),
+or UNRATED_VIABILITY in every dimension if they haven't been rated, so a player's compatibility with some weights
+is the same as their viability in calc_match_viablity.
+
+The points are held in a KD-tree, where every node keeps the bounding box of its points. Commend weights are
+never negative, so no point in a box can score more than the weights at the box's upper corner, and the k best
+players are found by visiting nodes best bound first and stopping once no remaining node can beat them.
+'''
+import heapq, itertools
+import numpy as np
+from mysite.session_aggregates import COMMEND_FIELDS, UNRATED_VIABILITY, get_profile_ratios
+
+# Most points kept in a leaf of the tree.
+LEAF_SIZE = 16
+
+
+def get_commend_vector(profile):
+	'''
+	Returns the point in commend space of a profile.
+	'''
+	ratios = get_profile_ratios(profile)
+	if ratios is None:
+		return np.full(len(COMMEND_FIELDS), UNRATED_VIABILITY)
+	return np.array(ratios)
+
+
+class CommendTree:
+	'''
+	KD-tree over the commend vectors of a set of profiles (or anything else with an id).
+	'''
+	def __init__(self, ids, vectors, leaf_size=LEAF_SIZE):
+		self.ids = list(ids)
+		self.vectors = np.asarray(vectors, dtype=float).reshape(len(self.ids), len(COMMEND_FIELDS))
+		# Ids removed since the tree was built, which are skipped by searches.
+		self.removed = set()
+		# Nodes are (lower corner, upper corner, (left, right) or None, point indices or None).
+		self.root = self._build(np.arange(len(self.ids)), leaf_size) if self.ids else None
+
+	@classmethod
+	def from_profiles(cls, profiles, leaf_size=LEAF_SIZE):
+		'''
+		Builds a tree over profiles, keyed by profile id.
+		'''
+		profiles = list(profiles)
+		return cls([profile.id for profile in profiles], [get_commend_vector(profile) for profile in profiles], leaf_size)
+
+	def remove(self, id):
+		'''
+		Leaves an id out of future searches.
+		'''
+		self.removed.add(id)
+
+	def best(self, weights, k, exclude=()):
+		'''
+		Returns the k ids that score highest for the given commend weights, as a list of (score, id), best first.
+		Ids in exclude are skipped. Ties go to the id given to the tree first.
+		'''
+		if self.root is None or k <= 0:
+			return []
+		weights = np.asarray(weights, dtype=float)
+
+		# Min-heap of the best (score, -index) found so far, and max-heap of the nodes left to visit by bound.
+		best = []
+		counter = itertools.count()
+		frontier = [(-self._bound(self.root, weights), next(counter), self.root)]
+		while frontier:
+			negative_bound, order, node = heapq.heappop(frontier)
+			if len(best) == k and -negative_bound <= best[0][0]:
+				break
+			lower, upper, children, indices = node
+			if children is not None:
+				for child in children:
+					heapq.heappush(frontier, (-self._bound(child, weights), next(counter), child))
+				continue
+
+			for index, score in zip(indices, self.vectors[indices].dot(weights)):
+				id = self.ids[index]
+				if id in self.removed or id in exclude:
+					continue
+				if len(best) < k:
+					heapq.heappush(best, (score, -index))
+				elif (score, -index) > best[0]:
+					heapq.heapreplace(best, (score, -index))
+
+		return [(float(score), self.ids[-index]) for score, index in sorted(best, reverse=True)]
+
+	def _build(self, indices, leaf_size):
+		points = self.vectors[indices]
+		lower = points.min(axis=0)
+		upper = points.max(axis=0)
+		if len(indices) <= leaf_size:
+			return (lower, upper, None, indices)
+
+		# Split the widest dimension at its median.
+		axis = int(np.argmax(upper - lower))
+		order = indices[np.argsort(points[:, axis], kind='mergesort')]
+		middle = len(order) // 2
+		return (lower, upper, (self._build(order[:middle], leaf_size), self._build(order[middle:], leaf_size)), None)
+
+	def _bound(self, node, weights):
+		return float(np.maximum(weights * node[0], weights * node[1]).sum())
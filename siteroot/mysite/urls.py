@@ -57,6 +57,7 @@ urlpatterns = [
     path('dashboard/availability/<int:pk>/edit/', site_views.edit_availability, name='edit_availability'),
     path('dashboard/session/rate/', site_views.rate_session, name='rate_session'),
     path('dashboard/session/<int:pk>/rate/', site_views.rate_session, name='rate_session'),
+    path('dashboard/session/history/', site_views.session_history, name='session_history'),
     path('dashboard/manual_matchmaking/', site_views.manual_matchmaking, name='manual_matchmaking'),
     path('dashboard/manual_matchmaking/<int:pk>/join/', site_views.manual_matchmaking, name='manual_matchmaking'),
     path('dashboard/create_session/', site_views.create_session, name='create_session'),
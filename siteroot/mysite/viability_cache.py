@@ -0,0 +1,42 @@
+'''
+Cache of session viabilities (see calc_sessions_viability).
+A viability only changes when the session's players change, when one of its players is rated,
+or when the user changes their commend priorities, so scores are cached against the session's
+roster_version and the user's commend weights. Anything that changes a session's players, or the
+commends of its players, must call bump_roster_versions.
+'''
+from apps.api.models import Session
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+
+
+def get_viability_key(profile_id, session, weights):
+	'''
+	Returns the cache key of the viability of a session to a profile with the given commend weights.
+	'''
+	return 'viability:%s:%s:%s:%s' % (session.id, session.roster_version, profile_id, ','.join(str(weight) for weight in weights))
+
+
+def get_cached_viabilities(profile_id, sessions, weights):
+	'''
+	Returns a dictionary of session id -> cached viability, for the sessions that have one.
+	'''
+	keys = dict((get_viability_key(profile_id, session, weights), session.id) for session in sessions)
+	return dict((keys[key], viability) for key, viability in cache.get_many(keys.keys()).items())
+
+
+def set_cached_viabilities(profile_id, sessions, weights, viabilities):
+	'''
+	Caches the viability of each of the sessions, given in the same order.
+	'''
+	cache.set_many(dict(
+		(get_viability_key(profile_id, session, weights), viability) for session, viability in zip(sessions, viabilities)
+	), settings.VIABILITY_CACHE_TIMEOUT)
+
+
+def bump_roster_versions(sessions):
+	'''
+	Invalidates the cached viabilities of a queryset of sessions.
+	'''
+	sessions.update(roster_version=F('roster_version') + 1)
@@ -1,9 +1,19 @@
-from apps.api.models import Profile, Profile_Connected_Game_Account, Availability, Session, Session_Profile, Game, Report
+from apps.api.models import Profile, Profile_Connected_Game_Account, Profile_Affinity, Availability, Session, Session_Profile, Game, Report
 from rest_framework import viewsets
 from django.http import HttpResponse, HttpResponseRedirect, HttpRequest, JsonResponse
 from django.shortcuts import render, redirect
-import requests, requests.auth, json, urllib.parse, datetime, math
+import requests, requests.auth, json, urllib.parse, datetime, math, random, time, heapq
+import numpy as np
 from mysite.forms import FeedbackForm, DeactivateUser, RegistrationForm, EditProfileForm, ConnectAccountForm, UserAvailabilityForm, RateSessionForm, LoginForm, SelectMatchmakingOptionsForm, CreateSessionForm
+from mysite.session_index import session_index
+from mysite.game_registry import game_registry
+from mysite.blocklist import get_blocked_profiles
+from mysite.viability_cache import get_cached_viabilities, set_cached_viabilities, bump_roster_versions
+from mysite.search_window import get_search_window
+from mysite.preferences import get_preference, predict_rating
+# Imported for its signals, which record the sessions that queued players may now fit.
+from mysite import session_changes
+from mysite import weekly_slots, session_aggregates, dashboard_cache
 from django.contrib import messages
 from django.contrib.auth import login, logout, authenticate
 from django.contrib.auth.models import User, Group
@@ -13,9 +23,12 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.signals import user_logged_in
 from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
 from django.core.signals import request_finished
+from django.db import transaction, OperationalError
+from django.db.models import Min, Q
 from django.dispatch import receiver
 from django.urls import reverse, resolve
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.core.mail import send_mail
 from django.template.loader import render_to_string
 
@@ -43,10 +56,8 @@ def index(request):
 	'''
 	Page displaying an overview of the service.
 	'''
-	data = Game.objects.all()
-
 	context = {'games':{}}
-	for game in data:
+	for game in game_registry.get_games():
 		context['games'][game.name] = game
 
 	# Give back the context to the index page.
@@ -64,10 +75,11 @@ def dashboard(request):
 	profile.<username/first_name/last_name/pref_server/birth_date/sessions_played/teamwork_commends/sportsmanship_commends/skill_commends/communcation_commends/discord_id>
 	connected_accounts.*
 	availabilities.*
-	prev_sessions.{id}.session_profile_id
+	prev_sessions.{id}.session_profile_id (the first page of previous sessions, see session_history)
 	prev_sessions.{id}.game.<icon/name>
 	prev_sessions.{id}.session.<start/end_time/viability/rating>
 	prev_sessions.{id}.players.{id}.<name/teamwork_commends/sportsmanship_commends/skill_commends/communication_commends>
+	prev_sessions_next (cursor of the next page of previous sessions)
 	queue.session.<game_name, start, end_time, viability>
 	'''
 	context = {
@@ -91,97 +103,230 @@ def dashboard(request):
 		}
 	}
 
-	connected_accounts = Profile_Connected_Game_Account.objects.filter(profile=request.user.profile)
-	games = Game.objects.all()
+	# The sections that change rarely are cached per profile, see dashboard_cache.py.
+	user_profile = request.user.profile
+	context['connected_accounts'] = dashboard_cache.get_section(user_profile, 'connected_accounts', build_dashboard_connected_accounts, user_profile)
+	context['availabilities'] = dashboard_cache.get_section(user_profile, 'availabilities', build_dashboard_availabilities, user_profile)
+	context['prev_sessions'], context['prev_sessions_next'] = dashboard_cache.get_section(user_profile, 'prev_sessions', build_dashboard_prev_sessions, user_profile)
+
+	# Get the current queue's session if it exists.
+	if user_profile.in_queue:
+		p_ses = Session_Profile.objects.filter(profile=user_profile, session__start__gt=timezone.now()).select_related('session').first()
+		context['queue'] = {}
+		if p_ses is not None and p_ses.session is not None:
+			context['queue']['session'] = {
+				'game_name':game_registry.get_game(p_ses.session.game_id).name,
+				'start':p_ses.session.start,
+				'end_time':p_ses.session.end_time,
+				'viability':str(math.floor(calc_match_viablity(user_profile, p_ses.session) * 10000) / 100) + " %"
+			}
+
+	return render(request, 'mysite/dashboard.html', context)
+
 
-	context['connected_accounts'] = {}
+def build_dashboard_connected_accounts(user_profile):
+	'''
+	Builds the connected_accounts section of the dashboard context, with an entry for every game.
+	Returns the section and the seconds it can be cached for (None for the default).
+	'''
+	connected_accounts = {}
+	for account in Profile_Connected_Game_Account.objects.filter(profile=user_profile).order_by('id'):
+		connected_accounts[account.game_id] = account
+	section = {}
 	i = 0
-	for game in games:
-		context['connected_accounts'][str(i)] = {}
-		context['connected_accounts'][str(i)]['game'] = {}
-		context['connected_accounts'][str(i)]['game']['pk'] = game.id
-		context['connected_accounts'][str(i)]['game']['name'] = game.name
-		context['connected_accounts'][str(i)]['game']['image_url'] = game.image.url
-		for account in connected_accounts:
-			if account.game == game:
-				context['connected_accounts'][str(i)]['id'] = account.id
-				context['connected_accounts'][str(i)]['game_player_tag'] = account.game_player_tag
-				context['connected_accounts'][str(i)]['platform'] = account.platform
-				context['connected_accounts'][str(i)]['cas_rank'] = account.cas_rank
-				context['connected_accounts'][str(i)]['comp_rank'] = account.comp_rank
+	for game in game_registry.get_games():
+		section[str(i)] = {}
+		section[str(i)]['game'] = {}
+		section[str(i)]['game']['pk'] = game.id
+		section[str(i)]['game']['name'] = game.name
+		section[str(i)]['game']['image_url'] = game.image_url
+		account = connected_accounts.get(game.id)
+		if account is not None:
+			section[str(i)]['id'] = account.id
+			section[str(i)]['game_player_tag'] = account.game_player_tag
+			section[str(i)]['platform'] = account.platform
+			section[str(i)]['cas_rank'] = account.cas_rank
+			section[str(i)]['comp_rank'] = account.comp_rank
 		i += 1
-	context['availabilities'] = Availability.objects.filter(profile=request.user.profile)
+	return section, None
+
+
+def build_dashboard_availabilities(user_profile):
+	'''
+	Builds the availabilities section of the dashboard context.
+	Returns the section and the seconds it can be cached for (None for the default).
+	'''
+	return list(Availability.objects.filter(profile=user_profile)), None
+
+
+def build_dashboard_prev_sessions(user_profile):
+	'''
+	Builds the prev_sessions section of the dashboard context, the first page of the user's session history
+	(see get_session_history) and the cursor of the next page.
+	Returns the section and the seconds it can be cached for, which is no longer than until the user's next session starts.
+	'''
+	now = timezone.now()
+	page, cursor = get_session_history(user_profile)
+
+	# The next session becomes a previous session once it starts.
+	timeout = settings.DASHBOARD_CACHE_TIMEOUT
+	next_start = Session_Profile.objects.filter(profile=user_profile, session__start__gte=now).exclude(session__end_time__isnull=True).aggregate(next_start=Min('session__start'))['next_start']
+	if next_start is not None:
+		timeout = min(timeout, max(1, math.ceil((next_start - now).total_seconds())))
+	return (page, format_history_cursor(cursor)), timeout
+
+
+def format_history_cursor(cursor):
+	'''
+	Returns the string given to the client for a cursor returned by get_session_history, or None for no cursor.
+	'''
+	if cursor is None:
+		return None
+	return '%s,%s' % (cursor[0].isoformat(), cursor[1])
+
 
-	# Get all required data for displaying previous sessions.
-	usr_ses_prof = Session_Profile.objects.filter(profile=request.user.profile, session__start__lt=timezone.now()).exclude(session__end_time__isnull=True).order_by('-session__start')
-	sessions = Session.objects.filter(pk__in=usr_ses_prof.values_list('session__id', flat=True))
-	context['prev_sessions'] = {}
+def parse_history_cursor(value):
+	'''
+	Returns the cursor for get_session_history given by the client as formatted by format_history_cursor, or None if it isn't valid.
+	'''
+	start, _, session_profile_id = value.rpartition(',')
+	try:
+		start = parse_datetime(start)
+		session_profile_id = int(session_profile_id)
+	except ValueError:
+		return None
+	if start is None:
+		return None
+	return start, session_profile_id
+
+
+def get_session_history(user_profile, before=None, limit=None):
+	'''
+	Builds a page of the user's previous sessions in the layout of the dashboard's prev_sessions, most recent first,
+	from a fixed number of queries however many sessions there are.
+	Pages are keyset paginated on the session's start: before is the cursor of the last session of the previous page.
+	Sessions that have ended are shown from their snapshot (see session_history.py), the rest are worked out live.
+	Returns the page, and the cursor of its last session if there are more sessions after it (else None).
+	'''
+	if limit is None:
+		limit = settings.SESSION_HISTORY_PAGE_SIZE
+
+	usr_ses_prof = Session_Profile.objects.filter(profile=user_profile, session__start__lt=timezone.now()).exclude(session__end_time__isnull=True)
+	if before is not None:
+		usr_ses_prof = usr_ses_prof.filter(Q(session__start__lt=before[0]) | Q(session__start=before[0], id__lt=before[1]))
+
+	# Get one more session than fits on the page, to know if there is another page.
+	usr_ses_prof = list(usr_ses_prof.select_related('session', 'history').order_by('-session__start', '-id')[:limit + 1])
+	cursor = None
+	if len(usr_ses_prof) > limit:
+		usr_ses_prof = usr_ses_prof[:limit]
+		cursor = (usr_ses_prof[-1].session.start, usr_ses_prof[-1].id)
+	user_session_profiles = {}
+	for ses_p in usr_ses_prof:
+		user_session_profiles.setdefault(ses_p.session_id, ses_p)
+
+	# The viability and players of each session, from its snapshot if it has one.
+	viabilities = {}
+	players = {}
+	live_sessions = []
+	for ses_p in user_session_profiles.values():
+		try:
+			history = ses_p.history
+		except ObjectDoesNotExist:
+			live_sessions.append(ses_p.session)
+			continue
+		viabilities[ses_p.session_id] = history.viability
+		players[ses_p.session_id] = json.loads(history.roster)
+
+	# The players of every live session, and their accounts for each session's game.
+	viabilities.update(zip((session.id for session in live_sessions), calc_sessions_viability(user_profile, live_sessions)))
+	session_profiles = dict((session.id, []) for session in live_sessions)
+	for ses_p in Session_Profile.objects.filter(session__id__in=session_profiles.keys()).select_related('profile').order_by('id'):
+		session_profiles[ses_p.session_id].append(ses_p)
+	game_accounts = get_game_accounts(
+		set(ses_p.profile_id for roster in session_profiles.values() for ses_p in roster),
+		set(session.game_id for session in live_sessions),
+	)
+	for session in live_sessions:
+		players[session.id] = get_roster_players(session, session_profiles[session.id], game_accounts)
+
+	section = {}
 	i = 0
 
 	# Get what is to be displayed from each session.
-	for session in sessions:
-
-		# Find the session profiles, viability, game details.
-		session_profiles = Session_Profile.objects.filter(session=session)
-		user_session_profile = session_profiles.filter(profile=request.user.profile)
-		session_viability = math.floor(calc_match_viablity(request.user.profile, session) * 100)
-		game_icon = session.game.image.url
-		game_name = session.game.name
-		start_time = session.start
-		context['prev_sessions'][str(i)] = {
+	for user_session_profile in user_session_profiles.values():
+		session = user_session_profile.session
+		game = game_registry.get_game(session.game_id)
+		section[str(i)] = {
 			'game':{
-				'icon':session.game.image.url,
-				'name':session.game.name,
+				'icon':game.image_url,
+				'name':game.name,
 			},
 			'session':{
 				'id':session.id,
 				'start':session.start,
 				'end_time':session.end_time,
-				'viability':session_viability,
-				'rating':user_session_profile[0].rating,
+				'viability':math.floor(viabilities[session.id] * 100),
+				'rating':user_session_profile.rating,
 			},
-			'session_profile_id':user_session_profile[0].id,
+			'session_profile_id':user_session_profile.id,
 		}
 
-		count = 0
-		context['prev_sessions'][str(i)]['players'] = {}
-
 		# Assign each player to this session.
-		for ses_p in session_profiles:
+		section[str(i)]['players'] = {}
+		for count, (name, teamwork, sportsmanship, skill, communication) in enumerate(players[session.id]):
+			section[str(i)]['players'][str(count)] = {
+				'name':name,
+				'teamwork_commends':teamwork,
+				'sportsmanship_commends':sportsmanship,
+				'skill_commends':skill,
+				'communication_commends':communication,
+			}
 
-			# Get their attached account.
-			game_account = Profile_Connected_Game_Account.objects.filter(game=session.game, profile=ses_p.profile).first()
-			if game_account is None:
-				break
+		# Go to next session.
+		i += 1
 
-			# Initialise the player storage.
-			context['prev_sessions'][str(i)]['players'][str(count)] = {}
-			# Assign details.
-			context['prev_sessions'][str(i)]['players'][str(count)]['name'] = game_account.game_player_tag
-			context['prev_sessions'][str(i)]['players'][str(count)]['teamwork_commends'] = ses_p.profile.teamwork_commends
-			context['prev_sessions'][str(i)]['players'][str(count)]['sportsmanship_commends'] = ses_p.profile.sportsmanship_commends
-			context['prev_sessions'][str(i)]['players'][str(count)]['skill_commends'] = ses_p.profile.skill_commends
-			context['prev_sessions'][str(i)]['players'][str(count)]['communication_commends'] = ses_p.profile.communication_commends
+	return section, cursor
 
-			# Go to next connnected user.
-			count += 1
 
-		# Go to next session.
-		i += 1
+def get_roster_players(session, session_profiles, game_accounts):
+	'''
+	Gets the players of a session shown on the dashboard, from its session profiles (with their profiles) in the order they joined
+	and the accounts returned by get_game_accounts.
+	Returns a list of [player tag, teamwork, sportsmanship, skill, communication commends], stopping at the first player without an account for the game.
+	'''
+	players = []
+	for ses_p in session_profiles:
 
-	# Get the current queue's session if it exists.
-	if request.user.profile.in_queue:
-		p_ses = Session_Profile.objects.filter(profile=request.user.profile, session__start__gt=datetime.datetime.now()).first()
-		context['queue'] = {}
-		if p_ses is not None and p_ses.session is not None:
-			context['queue']['session'] = {
-				'game_name':p_ses.session.game.name,
-				'start':p_ses.session.start,
-				'end_time':p_ses.session.end_time,
-				'viability':str(math.floor(calc_match_viablity(request.user.profile, p_ses.session) * 10000) / 100) + " %"
-			}
+		# Get their attached account.
+		game_account = game_accounts.get((session.game_id, ses_p.profile_id))
+		if game_account is None:
+			break
 
-	return render(request, 'mysite/dashboard.html', context)
+		players.append([
+			game_account.game_player_tag,
+			ses_p.profile.teamwork_commends,
+			ses_p.profile.sportsmanship_commends,
+			ses_p.profile.skill_commends,
+			ses_p.profile.communication_commends,
+		])
+	return players
+
+
+@login_required
+def session_history(request):
+	'''
+	Returns a JSON representation of the user's previous sessions, a page at a time, as rows to add to the dashboard's session history.
+	Pages after the first are requested with ?before=<cursor>, using the next_page cursor returned with the page before.
+	'''
+	before = parse_history_cursor(request.GET.get('before', ''))
+
+	data = dict()
+	context = {}
+	context['prev_sessions'], cursor = get_session_history(request.user.profile, before)
+	data['next_page'] = format_history_cursor(cursor)
+	data['html_session_rows'] = render_to_string('mysite/session_history_rows.html', context, request=request)
+	return JsonResponse(data)
 
 
 @login_required
@@ -657,6 +802,7 @@ def create_session(request):
 def enter_queue(request):
 	'''
 	Handles the user entering the queue for a session when the button on the nav bar is pressed.
+	The player is only recorded as queueing here, the matchmaking worker finds them a session.
 	'''
 	# Get user details.
 	django_user = request.user
@@ -666,30 +812,16 @@ def enter_queue(request):
 	if user_profile.in_queue:
 		return redirect('dashboard')
 
-	# Create a user session.
-	player_session = Session_Profile.objects.create(profile=user_profile)
-	player_session.save()
-
 	# Get user's availabilities, or send to availability page.
 	user_availabilities = Availability.objects.filter(profile=user_profile)
 	if not user_availabilities:
 		return redirect('dashboard')
-	else:
-		sessions = get_suitable_sessions(user_profile)
-		if sessions:
-			session = sessions[0] # The session and availability.
-		else:
-			session = None
-
-
-	# Join the session if one is found.
-	if session:
-		join_session(player_session, session[1][0], session[1][1])
 
-	# TODO Replace with a redirection to session creation form.
-	else:
+	# Create a user session and queue the player for the matchmaking worker together, so the sweeper never sees one without the other.
+	with transaction.atomic():
+		player_session = Session_Profile.objects.create(profile=user_profile)
 		user_profile.in_queue = True
-		user_profile.save()
+		user_profile.save(update_fields=['in_queue'])
 
 	return redirect('dashboard')
 
@@ -697,32 +829,73 @@ def enter_queue(request):
 def join_session(session_profile, session, avail):
 	'''
 	Adds a user to a given session, overwriting the time of the session if necessary.
+	The session is locked while it is checked and joined, so it can never be overfilled by players joining at the same time.
+	Attempts that fail on a database error (e.g. a deadlock) are retried up to JOIN_SESSION_RETRIES times.
 	Returns True on success, False on failure.
 	'''
-	# Ensure space available.
-	if not session.space_available:
-		return False
-
-	# Attach the session.
+	for attempt in range(settings.JOIN_SESSION_RETRIES + 1):
+		try:
+			joined = try_join_session(session_profile, session, avail)
+		except OperationalError:
+			if attempt == settings.JOIN_SESSION_RETRIES:
+				raise
+			# Back off a little before trying again.
+			time.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+		else:
+			return joined
+
+
+def try_join_session(session_profile, session, avail):
+	'''
+	Makes a single attempt at join_session.
+	'''
+	with transaction.atomic():
+		# Lock the session until the join is committed, and work from the latest copy of it.
+		locked_session = Session.objects.select_for_update().get(pk=session.pk)
+		max_players = game_registry.get_game(locked_session.game_id).max_players
+
+		# Ensure space available.
+		connected_players = Session_Profile.objects.filter(session=locked_session).count()
+		if not locked_session.space_available or connected_players >= max_players:
+			return False
+
+		# Workers for other shards may have placed this queue entry since it was loaded.
+		if session_profile.session_id is None and not Session_Profile.objects.select_for_update().filter(pk=session_profile.pk, session__isnull=True).exists():
+			return False
+
+		# Attach the session.
+		session_profile.session = locked_session
+		session_profile.profile.in_queue = True
+
+		# Set the session begin and end time to where it intersected.
+		if avail.start_time > locked_session.start.time():
+			locked_session.start = locked_session.start.replace(hour=avail.start_time.hour, minute=avail.start_time.minute, second=avail.start_time.second, microsecond=avail.start_time.microsecond)
+		if avail.end_time < locked_session.end_time:
+			locked_session.end_time = avail.end_time
+
+		# Set session remaining spaces.
+		if connected_players + 1 >= max_players:
+			locked_session.space_available = False
+
+		# The players have changed, so cached viabilities are no longer valid.
+		locked_session.roster_version += 1
+		session_aggregates.add_player(locked_session, session_profile.profile)
+
+		# Save database.
+		session_profile.profile.save(update_fields=['in_queue'])
+		session_profile.save()
+		locked_session.save()
+
+	# Let the caller see the session as it was saved.
+	session.start = locked_session.start
+	session.end_time = locked_session.end_time
+	session.space_available = locked_session.space_available
+	session.roster_version = locked_session.roster_version
+	session.player_count = locked_session.player_count
+	session.unrated_player_count = locked_session.unrated_player_count
+	for field in session_aggregates.RATIO_FIELDS:
+		setattr(session, field, getattr(locked_session, field))
 	session_profile.session = session
-	session_profile.profile.in_queue = True
-
-	# Set the session begin and end time to where it intersected.
-	if avail.start_time > session.start.time():
-		session.start.time = avail.start_time
-	if avail.end_time < session.end_time:
-		session.end_time = avail.end_time
-
-	# Set session remaining spaces.
-	connected_players = Session_Profile.objects.filter(session=session)
-	if len(connected_players) >= session.game.max_players:
-		session.space_available = False
-
-	# Save database.
-	session_profile.profile.save()
-	session_profile.save()
-	session.save()
-
 	return True
 
 
@@ -733,55 +906,78 @@ def exit_queue(request):
 	Deletes session if it's empty.
 	'''
 	if not request.user.profile.in_queue:
-		redirect('dashboard')
+		return redirect('dashboard')
+
+	# Get the queue entry if the player hasn't been matched yet, otherwise their most recent session (since we could have played before).
+	player_session = Session_Profile.objects.filter(profile=request.user.profile, session__isnull=True).first()
+	if player_session is None:
+		player_session = Session_Profile.objects.filter(profile=request.user.profile).order_by('-session__start').first()
 
-	# Get the most recent queue (since we could have played before).
-	player_session = Session_Profile.objects.filter(profile=request.user.profile).order_by('-session__start').first()
-	print(player_session.id)
-	# Remove our player session.
-	player_session.delete()
-	print(player_session.id)
+	with transaction.atomic():
+		# Lock the session while the player leaves it.
+		session = None
+		if player_session.session_id is not None:
+			session = Session.objects.select_for_update().get(pk=player_session.session_id)
 
-	# Session now has spaces (regardless of if there were spaces before).
-	session = player_session.session
-	session.space_available = True
-	session.save()
+		# Remove our player session.
+		player_session.delete()
 
-	# Delete session if nobody is in it.
-	sp = Session_Profile.objects.filter(session=session)
-	if not sp:
-		session.delete()
+		# Session now has spaces (regardless of if there were spaces before).
+		if session is not None:
+			session.space_available = True
+			session.roster_version += 1
+			session_aggregates.remove_player(session, request.user.profile)
+			session.save()
+
+			# Delete session if nobody is in it.
+			sp = Session_Profile.objects.filter(session=session)
+			if not sp:
+				session.delete()
 
 	request.user.profile.in_queue = False
-	request.user.profile.save()
+	request.user.profile.save(update_fields=['in_queue'])
 	return redirect('dashboard')
 
 
-def get_suitable_sessions(profile):
+def get_suitable_sessions(profile, limit=None, offset=0, shard=None, window=None):
 	'''
-	Availability existence should be verified prior to this point.
+	Availability existence should be verified prior to this point, and the profile loaded since, as sessions are first
+	checked against its compiled availability mask (see weekly_slots.py).
 	Gets all suitable sessions for a user, above the minimum amount specified.
-	Returns the sessions as a list of 2 elements [viability, [session, availability]].
+	Only sessions within the MMR range and regions of the search window (see search_window.py) are considered,
+	which defaults to the narrowest window. If shard (see matchmaking.Shard) is given, only sessions of its game
+	and playlist type are too, so that each shard can be matched independently.
+	If limit is given, only the most viable sessions up to that position are kept, and sessions before offset are skipped,
+	so recommendation levels are only looked up for the sessions returned.
+	Returns the sessions as a list of 3 elements [viability, [session, availability], recommend level], or None if there are none.
 	'''
 	# Modifiers.
-	acceptable_mmr_range = 100 # Range above/below the prfile that is considered viable.
+	if window is None:
+		window = get_search_window(profile.pref_server)
+	acceptable_mmr_range = window.mmr_range # Range above/below the prfile that is considered viable.
 	min_accepted_viability = 0.0 # A value (out of 1) which states how viable a session must be to be included.
 	# Queueing players details.
 	user_availabilities = Availability.objects.filter(profile=profile)
 	user_connected_accounts = Profile_Connected_Game_Account.objects.filter(profile=profile)
+	if shard is not None:
+		user_availabilities = user_availabilities.filter(competitive=shard.competitive)
+		user_connected_accounts = user_connected_accounts.filter(game__id=shard.game_id)
 
-	# Create a list of games to filter based off.
+	# Create a list of games to filter based off, and the account used for each game.
 	user_accounts = []
+	user_game_accounts = {}
 	for acc in user_connected_accounts:
-		user_accounts.append(acc.game)
+		user_accounts.append(acc.game_id)
+		user_game_accounts.setdefault(acc.game_id, acc)
 
 	# All the sessions which meet basic requirements (mmr, time/day, playlist, game).
 	viable_sessions = []
 
 	# Get any players that the profile queuing has reported before, for filtration.
-	player_reports = Report.objects.filter(sent_by=profile)
+	player_reports = get_blocked_profiles(profile)
 
-	# Get any session that matches the availability given (1 hour min.).
+	# Look up the sessions that match each availability (1 hour min.) in the session index.
+	avail_session_ids = []
 	for avail in user_availabilities:
 		# The value of the days for filtering by day.
 		day = -1
@@ -800,38 +996,53 @@ def get_suitable_sessions(profile):
 		elif avail.pref_day == Availability.SUNDAY:
 			day = 1
 
-		# Get any sessions that haven't happened yet, match our day, is one of our games we have set up, is the right playlist type, and has spaces available.
-		avail_match_sessions = Session.objects.filter(
-			start__gte=datetime.datetime.now(),
-			game__in=user_accounts,
-			competitive=avail.competitive,
-			start__week_day=day,
-			space_available=True,
-		).exclude(start__isnull=True)
+		# Our rank in each game for this playlist type, so that sessions with players outside our MMR range are skipped.
+		user_ranks = dict((game_id, acc.comp_rank if avail.competitive else acc.cas_rank) for game_id, acc in user_game_accounts.items())
+
+		# Any sessions that haven't happened yet, match our day, are one of our games we have set up, are the right playlist type, are within our MMR range, and have spaces available.
+		avail_session_ids.append((avail, session_index.candidates(user_accounts, avail.competitive, day, avail.end_time, user_ranks, acceptable_mmr_range, window.regions)))
+
+	# Load every candidate session at once, rechecking the index against the database.
+	candidate_ids = set()
+	for avail, session_ids in avail_session_ids:
+		candidate_ids.update(session_ids)
+	candidate_sessions = Session.objects.filter(
+		start__gte=timezone.now(),
+		space_available=True,
+	).exclude(start__isnull=True).select_related('game').in_bulk(candidate_ids)
+
+	# Get the players attached to every candidate session.
+	rosters = get_session_rosters(candidate_sessions.keys())
+
+	# Get the account each of those players has connected for the session's game.
+	roster_profiles = set()
+	for roster in rosters.values():
+		roster_profiles.update(roster)
+	roster_accounts = get_game_accounts(roster_profiles, user_accounts)
 
-		# Check the viability of the session.
-		for session in avail_match_sessions:
+	# Check the viability of each session.
+	availability_mask = weekly_slots.from_bytes(profile.availability_mask)
+	for avail, session_ids in avail_session_ids:
+		for session_id in session_ids:
+			session = candidate_sessions.get(session_id)
 
 			# Only check them if user availability time overlaps by an hour at least.
-			if is_time_acceptable(session, avail):
+			if session is not None and is_time_acceptable(session, avail, availability_mask):
 
 				# Get user account connected to this game.
-				user_acc = Profile_Connected_Game_Account.objects.filter(profile=profile, game=session.game).first()
-
-				# Get the stats of each player that is attached to the session.
-				player_sessions = Session_Profile.objects.filter(session=session)
+				user_acc = user_game_accounts[session.game_id]
 
 				# All sessions are suitable until proven otherwise.
 				suitable = True
 
-				# Check if their MMR is within the range we want.
-				for player_s in player_sessions:
+				# Check if their MMR is within the range we want, in case the index is behind the database.
+				for player_profile in rosters.get(session.id, []):
 
-					# Cancel if player has reported them before.
-					if player_reports.filter(user_reported=player_s.profile).first() is not None:
+					# Cancel if player has reported them before, or they have no account for this game.
+					prof_acc = roster_accounts.get((session.game_id, player_profile))
+					if player_profile in player_reports or prof_acc is None:
 						suitable = False
 						break
-					prof_acc = Profile_Connected_Game_Account.objects.filter(profile=player_s.profile, game=session.game).first()
 
 					# Cancel if mmr out of range.
 					if session.competitive:
@@ -852,21 +1063,24 @@ def get_suitable_sessions(profile):
 		return None
 
 	# Add any sessions that meet viability requirements.
-	sorted_sessions = []
-	for session in viable_sessions:
-		viability = calc_match_viablity(profile, session[0])
+	viabilities = calc_sessions_viability(profile, [session[0] for session in viable_sessions])
+	scored_sessions = ([viability, session] for session, viability in zip(viable_sessions, viabilities) if viability > min_accepted_viability)
 
-		# Machine learning, disable on production due to Free Tier.
-		recommended = get_match_recommendation_level(profile, session[0])
-		if viability > min_accepted_viability:
-			sorted_sessions.append([viability, session, recommended])
+	# Sort based on viability, highest to lowest, keeping only a heap of the best if there is a limit.
+	if limit is None:
+		sorted_sessions = sorted(scored_sessions, key=lambda v: v[0], reverse=True)
+	else:
+		sorted_sessions = heapq.nlargest(limit, scored_sessions, key=lambda v: v[0])
+	sorted_sessions = sorted_sessions[offset:]
 
 	# Early return if there are no sorted sessions.
 	if len(sorted_sessions) < 1:
 		return None
 
-	# Sort based on viability, highest to lowest.
-	sorted_sessions.sort(key=lambda v: v[0], reverse=True)
+	# Recommendations from past encounters and the player's preference model, which are both cheap lookups.
+	recommendations = get_sessions_recommendation_level(profile, dict((v[1][0].id, rosters[v[1][0].id]) for v in sorted_sessions), dict((v[1][0].id, v[1][0]) for v in sorted_sessions))
+	for v in sorted_sessions:
+		v.append(recommendations[v[1][0].id])
 	return sorted_sessions
 
 
@@ -878,6 +1092,14 @@ def calc_match_viablity(user_profile, session):
 	Formula: sum(each_player:(c1/tsp*w1)+(c2/tsp*w2)+(c3/tsp*w3)+(c4/tsp*w4)) / pc
 	Where c=commendation type, tsp=total sessions played, w=weighting, pc=Player Count
 	'''
+	return calc_sessions_viability(user_profile, [session])[0]
+
+
+def get_commend_weights(user_profile):
+	'''
+	Returns what each commend is worth to the given profile, based on their commend priorities.
+	Ordered (Teamwork, Communication, Skill, Sportsmanship).
+	'''
 	# What each should be worth out of 1 (Team, Comm, Skill, Sport).
 	weight = [ 0.5, 0.25, 0.125, 0.125 ]
 
@@ -893,107 +1115,116 @@ def calc_match_viablity(user_profile, session):
 		elif user_profile.commend_priority_4 == key:
 			modifiers[key] = weight[3]
 
-	# Players connected to the session.
-	players = Session_Profile.objects.filter(session=session)
-	players = players.exclude(profile=user_profile)
+	return np.array([modifiers['Teamwork'], modifiers['Communication'], modifiers['Skill'], modifiers['Sportsmanship']])
 
-	# How much the sessions commends are worth after they have been weighted.
-	weighted_commends = { 'Teamwork':0.0, 'Communication':0.0, 'Skill':0.0, 'Sportsmanship':0.0, }
-	total_commends = { 'Teamwork':0, 'Communication':0, 'Skill':0, 'Sportsmanship':0, }
-	player_viability = {}
 
-	# Weigh their commendations based on what the user believes is important.
-	for player in players:
-		num_sess = player.profile.received_ratings
-
-		# If they've played a session, grade them.
-		if num_sess > 0:
-			teamwork = (player.profile.teamwork_commends / num_sess) * modifiers['Teamwork']
-			communication = (player.profile.communication_commends / num_sess) * modifiers['Communication']
-			skill = (player.profile.skill_commends / num_sess) * modifiers['Skill']
-			sportsmanship = (player.profile.sportsmanship_commends / num_sess) * modifiers['Sportsmanship']
+def calc_sessions_viability(user_profile, sessions):
+	'''
+	Calculates the viability (see calc_match_viablity) of many sessions at once.
+	The players of every session are loaded in one query and weighted together as a players x commends matrix.
+	Viabilities are cached until the session's players or the user's commend priorities change.
+	Returns a list of viabilities in the same order as the sessions given.
+	'''
+	weights = get_commend_weights(user_profile)
 
-			player_viability[player.id] = teamwork + communication + skill + sportsmanship
+	# Only calculate the sessions that aren't cached.
+	viabilities = get_cached_viabilities(user_profile.id, sessions, weights)
+	uncached = [session for session in sessions if session.id not in viabilities]
+	if uncached:
+		calculated = calc_uncached_viability(user_profile, uncached, weights)
+		set_cached_viabilities(user_profile.id, uncached, weights, calculated)
+		viabilities.update(zip((session.id for session in uncached), calculated))
 
-		# If not, we just give them 0.5.
-		else:
-			player_viability[player.id] = 0.5
+	return [viabilities[session.id] for session in sessions]
 
-	# Calculate the sum of the viability of all players.
-	total_viability = 0.0
-	for key in player_viability:
-		total_viability += player_viability[key]
 
-	# Get the average viability to return as our viability percentage.
-	if len(players) > 0:
-		averaged_viability = total_viability / len(players)
-	else:
-		averaged_viability = 0.5
+def calc_uncached_viability(user_profile, sessions, weights):
+	'''
+	Calculates the viabilities of sessions for calc_sessions_viability, without using the cache.
+	Each session's viability comes from its commend aggregates (see session_aggregates.py), leaving out the user if they are in it.
+	'''
+	# Sessions the user is in themselves.
+	user_sessions = set(Session_Profile.objects.filter(profile=user_profile, session__id__in=set(session.id for session in sessions)).values_list('session_id', flat=True))
 
-	return averaged_viability
+	return [session_aggregates.get_viability(session, weights, user_profile if session.id in user_sessions else None) for session in sessions]
 
 
 def get_match_recommendation_level(profile, session):
 	'''
-	Decides how to recommend a match based on previous encounters with players.
+	Decides how to recommend a match based on previous encounters with players,
+	and how the player's preference model (see preferences.py) predicts they would rate it.
 	'''
-	recommend_level = 0
+	return get_sessions_recommendation_level(profile, get_session_rosters([session.id]), {session.id: session})[session.id]
 
-	# Get session_profiles of the user which have been rated in the past.
-	prev_session_profiles = Session_Profile.objects.filter(profile=profile).exclude(rating=None)
 
-	# Cancel if our user hasn't played before.
-	if len(prev_session_profiles) == 0:
-		return 0
+def get_sessions_recommendation_level(profile, rosters, sessions=None):
+	'''
+	Decides how to recommend many matches at once, see get_match_recommendation_level.
+	Takes the rosters of the sessions as returned by get_session_rosters, and optionally a dictionary of
+	session id -> session, in which case the predicted rating of each session moves it up or down by up to one level.
+	Returns a dictionary of session id -> recommendation level.
+	'''
+	recommend_levels = dict.fromkeys(rosters, 0)
 
-	# Store the previous sessions so that they can be used to filter.
-	user_sessions = []
-	for sp in prev_session_profiles:
-		user_sessions.append(sp.session)
+	# How the player is predicted to rate each session, rounded to a whole level.
+	if sessions:
+		preference = get_preference(profile)
+		if preference is not None:
+			for session_id, session in sessions.items():
+				excluded_profile = profile if profile.id in rosters.get(session_id, ()) else None
+				recommend_levels[session_id] += int(round(predict_rating(preference, session, excluded_profile)))
 
-	# Get players in any session that the user has rated, excluding the user.
-	previous_session_players = Session_Profile.objects.filter(session__in=user_sessions).exclude(profile=profile)
+	# Net effect of previously playing with each of the players in the sessions (see Profile_Affinity).
+	roster_profiles = set(profile_id for roster in rosters.values() for profile_id in roster)
+	roster_profiles.discard(profile.id)
+	if not roster_profiles:
+		return recommend_levels
+	player_levels = dict(Profile_Affinity.objects.filter(profile=profile, other_profile__in=roster_profiles).values_list('other_profile_id', 'net_score'))
 
-	# Get players in current session.
-	current_session_players = Session_Profile.objects.filter(session=session)
-	current_session_players_profiles = []
-	for sp in current_session_players:
-		current_session_players_profiles.append(sp.profile)
+	# Move each session up or down based on the players in it that the user has rated before.
+	for session_id, roster in rosters.items():
+		for profile_id in roster:
+			recommend_levels[session_id] += player_levels.get(profile_id, 0)
 
-	# Get anyone that is in this session that the user has rated before.
-	profiles_to_check = previous_session_players.filter(profile__in=current_session_players_profiles)
+	return recommend_levels
 
-	# Check each player and move up or down recommendation based on how the session they were in was rated.
-	for p in profiles_to_check:
 
-		# Get the queuing users session_profile for that past session to check how they rated it.
-		user_profile = prev_session_profiles.filter(session=p.session).first()
+def get_session_rosters(session_ids):
+	'''
+	Gets the profile ids attached to each of the given sessions in a single query.
+	Returns a dictionary of session id -> list of profile ids, in the order they joined.
+	'''
+	rosters = dict((session_id, []) for session_id in session_ids)
+	players = Session_Profile.objects.filter(session__id__in=rosters.keys()).order_by('id').values_list('session_id', 'profile_id')
+	for session_id, profile_id in players:
+		rosters[session_id].append(profile_id)
+	return rosters
 
-		# Move up or down based on rating.
-		if user_profile is not None:
-			if user_profile.rating > 3:
-				recommend_level += 1
-			elif user_profile.rating < 3:
-				recommend_level -= 1
 
-	return recommend_level
+def get_game_accounts(profile_ids, game_ids):
+	'''
+	Gets the connected accounts of the given profiles for the given games in a single query.
+	Returns a dictionary of (game id, profile id) -> account, keeping the first account where there are several.
+	'''
+	accounts = {}
+	for account in Profile_Connected_Game_Account.objects.filter(profile__id__in=profile_ids, game__id__in=game_ids).order_by('id'):
+		accounts.setdefault((account.game_id, account.profile_id), account)
+	return accounts
 
 
 # Checks if the time is at least an hour inside availability.
+# availability_mask is the weekly mask of the availability (see weekly_slots.py), such as the profile's compiled mask, else it is worked out.
 # Returns True if so, else False.
-def is_time_acceptable(session, availability):
-	min_end = session.start + datetime.timedelta(hours=1)
-
-	# Check if the session exists within our availability.
-	if session.start.time() >= availability.start_time and min_end.time() <= availability.end_time:
-		return True
+def is_time_acceptable(session, availability, availability_mask=None):
+	if availability_mask is None:
+		availability_mask = weekly_slots.get_range_mask(availability.pref_day, availability.start_time, availability.end_time, touched=True)
 
-	# Check if the session is before our start time but goes at least an hour into our availability.
-	if session.start.time() <= availability.start_time and min_end.time() <= availability.end_time:
-		return True
+	# Most sessions are ruled out by their masks.
+	if not weekly_slots.has_hour_overlap(availability_mask, weekly_slots.get_session_mask(session)):
+		return False
 
-	# To reach here, the session isn't within our availability and it doesn't overlap.
-	return False
+	# Compared in exact times, as slots that are only partly shared would count as a whole.
+	return weekly_slots.get_overlap_seconds(session, availability) >= 60 * 60
 
 
 @login_required
@@ -1241,74 +1472,86 @@ def discord_put_user_on_server(access_token, discord_id):
 @login_required
 def manual_matchmaking(request, pk=None):
 	'''
-	Returns a JSON representation of available sessions
+	Returns a JSON representation of available sessions, a page at a time (?page=N, from 0).
 	User selects from a list of current sessions, given the viability and recommendation level
+	The first page is returned as the whole list, later pages as rows to add to it.
 	'''
 	if request.user.profile.in_queue:
 		return redirect('dashboard')
 
-	data = dict()
-	context = {'title':'Manual Matchmaking'}
-	context['manual_matchmaking'] = {}
-	sessions = get_suitable_sessions(request.user.profile)
-	i = 0
-	if sessions is not None:
+	# Join the selected session, if it is still suitable.
+	if pk is not None:
+		sessions = get_suitable_sessions(request.user.profile) or []
 		for sv in sessions:
+			if sv[1][0].id == pk:
+				session = sv[1][0]
+				avail = sv[1][1]
+
+				# Create a user session, removing it again if the session filled up first.
+				player_session = Session_Profile.objects.create(profile=request.user.profile)
+				if not join_session(player_session, session, avail):
+					player_session.delete()
+				break
+		return redirect('dashboard')
 
-			# Get the connected players.
-			session_profiles = Session_Profile.objects.filter(session=sv[1][0])
-
-			# Format: sv[<Viability, [Session, Availability], Recommend-Level>, players].
-			context['manual_matchmaking'][str(i)] = {}
-			context['manual_matchmaking'][str(i)]['session'] = {}
-			context['manual_matchmaking'][str(i)]['session']['pk'] = sv[1][0].id
-			context['manual_matchmaking'][str(i)]['session']['id'] = i
-			# Get the percentage to 2 decimal places.
-			context['manual_matchmaking'][str(i)]['session']['viability'] = math.floor(sv[0] * 10000) / 100
-			context['manual_matchmaking'][str(i)]['session']['start'] = sv[1][0].start
-			context['manual_matchmaking'][str(i)]['session']['end_time'] = sv[1][0].end_time
-			context['manual_matchmaking'][str(i)]['session']['competitive'] = sv[1][0].competitive
-			context['manual_matchmaking'][str(i)]['session']['recommend_level'] = sv[2]
-			context['manual_matchmaking'][str(i)]['game_image'] = sv[1][0].game.image.url
-
-			# Assign Players.
-			count = 0
-			context['manual_matchmaking'][str(i)]['players'] = {}
-			for ses_p in session_profiles:
-
-				# Get their attached account.
-				game_account = Profile_Connected_Game_Account.objects.filter(game=sv[1][0].game, profile=ses_p.profile).first()
-				if game_account is None:
-					break
-
-				# Initialise the player storage.
-				context['manual_matchmaking'][str(i)]['players'][str(count)] = {}
-				# Assign details.
-				context['manual_matchmaking'][str(i)]['players'][str(count)]['name'] = game_account.game_player_tag
-				context['manual_matchmaking'][str(i)]['players'][str(count)]['teamwork_commends'] = ses_p.profile.teamwork_commends
-				context['manual_matchmaking'][str(i)]['players'][str(count)]['sportsmanship_commends'] = ses_p.profile.sportsmanship_commends
-				context['manual_matchmaking'][str(i)]['players'][str(count)]['skill_commends'] = ses_p.profile.skill_commends
-				context['manual_matchmaking'][str(i)]['players'][str(count)]['communication_commends'] = ses_p.profile.communication_commends
-
-				# Go to next connnected user.
-				count += 1
-
-			# Go to the next session.
-			i += 1
+	try:
+		page = max(0, int(request.GET.get('page', 0)))
+	except ValueError:
+		page = 0
+	page_size = settings.MANUAL_MATCHMAKING_PAGE_SIZE
 
-	if pk is not None:
-		session_id = pk
-		session = sessions[int(session_id)][1][0]
-		avail = sessions[int(session_id)][1][1]
+	data = dict()
+	context = {'title':'Manual Matchmaking'}
+	context['manual_matchmaking'] = {}
 
-		# Create a user session.
-		player_session = Session_Profile.objects.create(profile=request.user.profile)
-		player_session.save()
+	# Get one more session than fits on the page, to know if there is another page.
+	sessions = get_suitable_sessions(request.user.profile, limit=(page + 1) * page_size + 1, offset=page * page_size) or []
+	data['next_page'] = page + 1 if len(sessions) > page_size else None
+	sessions = sessions[:page_size]
+
+	# Load the players of the page's sessions, with their accounts for the session's game.
+	rosters = get_session_rosters([sv[1][0].id for sv in sessions])
+	roster_profiles = Profile.objects.in_bulk(set(profile_id for roster in rosters.values() for profile_id in roster))
+	roster_accounts = get_game_accounts(roster_profiles.keys(), set(sv[1][0].game_id for sv in sessions))
+
+	for i, sv in enumerate(sessions, page * page_size):
+		# Format: sv[<Viability, [Session, Availability], Recommend-Level>, players].
+		context['manual_matchmaking'][str(i)] = {}
+		context['manual_matchmaking'][str(i)]['session'] = {}
+		context['manual_matchmaking'][str(i)]['session']['pk'] = sv[1][0].id
+		context['manual_matchmaking'][str(i)]['session']['id'] = i
+		# Get the percentage to 2 decimal places.
+		context['manual_matchmaking'][str(i)]['session']['viability'] = math.floor(sv[0] * 10000) / 100
+		context['manual_matchmaking'][str(i)]['session']['start'] = sv[1][0].start
+		context['manual_matchmaking'][str(i)]['session']['end_time'] = sv[1][0].end_time
+		context['manual_matchmaking'][str(i)]['session']['competitive'] = sv[1][0].competitive
+		context['manual_matchmaking'][str(i)]['session']['recommend_level'] = sv[2]
+		context['manual_matchmaking'][str(i)]['game_image'] = game_registry.get_game(sv[1][0].game_id).image_url
+
+		# Assign Players.
+		context['manual_matchmaking'][str(i)]['players'] = {}
+		for count, profile_id in enumerate(rosters[sv[1][0].id]):
 
-		join_session(player_session, session, avail)
-		return redirect('dashboard')
+			# Get their attached account.
+			game_account = roster_accounts.get((sv[1][0].game_id, profile_id))
+			if game_account is None:
+				break
+			player_profile = roster_profiles[profile_id]
 
-	data['html_match_list'] = render_to_string('mysite/manual_matchmaking_list.html', context, request=request)
+			# Initialise the player storage.
+			context['manual_matchmaking'][str(i)]['players'][str(count)] = {}
+			# Assign details.
+			context['manual_matchmaking'][str(i)]['players'][str(count)]['name'] = game_account.game_player_tag
+			context['manual_matchmaking'][str(i)]['players'][str(count)]['teamwork_commends'] = player_profile.teamwork_commends
+			context['manual_matchmaking'][str(i)]['players'][str(count)]['sportsmanship_commends'] = player_profile.sportsmanship_commends
+			context['manual_matchmaking'][str(i)]['players'][str(count)]['skill_commends'] = player_profile.skill_commends
+			context['manual_matchmaking'][str(i)]['players'][str(count)]['communication_commends'] = player_profile.communication_commends
+
+	context['next_page'] = data['next_page']
+	if page == 0:
+		data['html_match_list'] = render_to_string('mysite/manual_matchmaking_list.html', context, request=request)
+	else:
+		data['html_match_list'] = render_to_string('mysite/manual_matchmaking_rows.html', context, request=request)
 	return JsonResponse(data)
 
 
@@ -0,0 +1,143 @@
+'''
+Weekly availability bitsets.
+The week is split into 672 slots of 15 minutes, where slot 0 is Monday 00:00, and a set of times in the week
+is stored as an integer with a bit set for each slot, so overlaps between availabilities and sessions are
+found with a bitwise and.
+
+Each profile's availabilities are compiled into Profile.availability_mask, which is kept in sync by the
+signals at the bottom of this file. That mask covers every slot an availability touches, so it never
+misses an overlap, but may find overlaps that aren't there: masks are only used to narrow down matches,
+which are then checked in exact times (see get_overlap_seconds).
+Sessions are taken to run from their start until their end time, or until the end of the day if their
+end time is earlier than their start or they don't have one.
+'''
+from apps.api.models import Availability, Profile
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+SLOT_MINUTES = 15
+SLOTS_PER_HOUR = 60 // SLOT_MINUTES
+SLOTS_PER_DAY = 24 * SLOTS_PER_HOUR
+SLOTS_PER_WEEK = 7 * SLOTS_PER_DAY
+DAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+
+# Bytes needed to store a week of slots.
+MASK_BYTES = SLOTS_PER_WEEK // 8
+
+
+def get_slot(day, time_of_day, round_up=False):
+	'''
+	Returns the weekly slot that a day name and time fall into, or the next slot if round_up and the time is part way through a slot.
+	'''
+	minutes = time_of_day.hour * 60 + time_of_day.minute
+	slot = minutes // SLOT_MINUTES
+	if round_up and (minutes % SLOT_MINUTES or time_of_day.second or time_of_day.microsecond):
+		slot += 1
+	return DAYS.index(day) * SLOTS_PER_DAY + slot
+
+
+def get_range_mask(day, start_time, end_time, touched=False):
+	'''
+	Returns the slots between two times on a day.
+	Only slots entirely inside the range are included, unless touched, in which case every slot the range touches is.
+	'''
+	start = get_slot(day, start_time, round_up=not touched)
+	end = get_slot(day, end_time, round_up=touched)
+	if end <= start:
+		return 0
+	return ((1 << (end - start)) - 1) << start
+
+
+def get_availability_mask(availabilities, touched=False):
+	'''
+	Returns the slots covered by the given availabilities (see get_range_mask).
+	'''
+	mask = 0
+	for avail in availabilities:
+		mask |= get_range_mask(avail.pref_day, avail.start_time, avail.end_time, touched)
+	return mask
+
+
+def get_session_mask(session):
+	'''
+	Returns every slot a session touches, from its start until its end time, or the end of the day if the end time is earlier than the start.
+	'''
+	start = timezone.localtime(session.start) if timezone.is_aware(session.start) else session.start
+	day = DAYS[start.weekday()]
+	mask = 0
+	if session.end_time is not None:
+		mask = get_range_mask(day, start.time(), session.end_time, touched=True)
+	if not mask:
+		first = get_slot(day, start.time())
+		mask = ((1 << (SLOTS_PER_DAY - first % SLOTS_PER_DAY)) - 1) << first
+	return mask
+
+
+def get_seconds(time_of_day):
+	'''
+	Returns the number of seconds into its day that a time is.
+	'''
+	return time_of_day.hour * 3600 + time_of_day.minute * 60 + time_of_day.second + time_of_day.microsecond / 1e6
+
+
+def get_overlap_seconds(session, availability):
+	'''
+	Returns the exact number of seconds that a session, from its start until its end time
+	(or the end of the day if the end time is earlier than the start), falls inside an availability.
+	Unlike comparing masks, this doesn't count the parts of slots that either only partly covers.
+	'''
+	start = timezone.localtime(session.start) if timezone.is_aware(session.start) else session.start
+	if DAYS[start.weekday()] != availability.pref_day:
+		return 0
+	session_start = get_seconds(start.time())
+	session_end = get_seconds(session.end_time) if session.end_time is not None else 0
+	if session_end <= session_start:
+		session_end = 24 * 3600
+	return max(0, min(session_end, get_seconds(availability.end_time)) - max(session_start, get_seconds(availability.start_time)))
+
+
+def has_hour_overlap(mask, session_mask):
+	'''
+	Returns whether a mask and a session's mask (see get_session_mask) could share an hour.
+	As both cover every slot they touch, an hour inside both always shares at least an hour of slots.
+	'''
+	return count_slots(mask & session_mask) >= SLOTS_PER_HOUR
+
+
+def count_slots(mask):
+	'''
+	Returns the number of slots set in a mask.
+	'''
+	return bin(mask).count('1')
+
+
+def to_bytes(mask):
+	'''
+	Converts a mask to the bytes stored in the database.
+	'''
+	return mask.to_bytes(MASK_BYTES, 'little')
+
+
+def from_bytes(value):
+	'''
+	Converts stored bytes back into a mask.
+	'''
+	return int.from_bytes(bytes(value or b''), 'little')
+
+
+def update_profile_mask(profile_id):
+	'''
+	Recompiles the availability mask of a profile from its availabilities.
+	'''
+	mask = get_availability_mask(Availability.objects.filter(profile__id=profile_id), touched=True)
+	Profile.objects.filter(pk=profile_id).update(availability_mask=to_bytes(mask))
+
+
+@receiver(post_save, sender=Availability)
+@receiver(post_delete, sender=Availability)
+def compile_availabilities(sender, instance=None, **kwargs):
+	'''
+	Keeps a profile's availability mask in sync with their availabilities.
+	'''
+	update_profile_mask(instance.profile_id)
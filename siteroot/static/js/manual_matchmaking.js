@@ -11,5 +11,26 @@ $(function () {
         return false;
     };
 
+    // Add the next page of sessions to the list.
+    var showMoreMatches = function () {
+        var button = $(this);
+        $.ajax({
+            url: '/dashboard/manual_matchmaking/',
+            data: { page: button.data('page') },
+            type: 'get',
+            dataType: 'json',
+            success: function(data) {
+                $('#manual-matchmaking-list .js-match-rows').append(data.html_match_list);
+                if (data.next_page) {
+                    button.data('page', data.next_page);
+                } else {
+                    button.remove();
+                }
+            }
+        });
+        return false;
+    };
+
     $(".js-load-manual-matches").click(showMatchmakingList);
-});
\ No newline at end of file
+    $("#manual-matchmaking-list").on("click", ".js-load-more-matches", showMoreMatches);
+});
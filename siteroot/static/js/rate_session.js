@@ -39,6 +39,6 @@ $(function () {
     };
 
     // Bind to buttons
-    $(".js-rate-session").click(loadForm);
+    $("#session-history").on("click", ".js-rate-session", loadForm);
     $("#modal-rate-session").on("submit", ".js-rate-session-form", saveForm);
 });
\ No newline at end of file
@@ -0,0 +1,41 @@
+$(function () {
+    var loading = false;
+
+    // Add the next page of previous sessions to the history.
+    var showMoreSessions = function () {
+        var button = $("#session-history .js-load-more-sessions");
+        if (loading || !button.length) {
+            return false;
+        }
+        loading = true;
+        $.ajax({
+            url: button.data('url'),
+            data: { before: button.data('before') },
+            type: 'get',
+            dataType: 'json',
+            success: function(data) {
+                $('#session-history .js-session-rows').append(data.html_session_rows);
+                if (data.next_page) {
+                    button.data('before', data.next_page);
+                } else {
+                    button.remove();
+                }
+            },
+            complete: function() {
+                loading = false;
+            }
+        });
+        return false;
+    };
+
+    // Load more once the history is scrolled near its bottom.
+    var scrollHistory = function () {
+        var history = $(this);
+        if (history.scrollTop() + history.innerHeight() >= this.scrollHeight - 100) {
+            showMoreSessions();
+        }
+    };
+
+    $("#session-history").on("click", ".js-load-more-sessions", showMoreSessions);
+    $("#session-history").on("scroll", scrollHistory);
+});